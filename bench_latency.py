@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measure the command turnaround time of a BT-Q1300ST logger.
+
+Usage: bench_latency <device> [<speed> [<count>]]
+
+Sends <count> PMTK000 test commands and times each PMTK001 reply, first
+with the old sleep-polling packet reader and then with the select() based
+reader in btq1300st.py.  Defaults are speed 115200 and count 100.
+"""
+
+import sys
+import time
+import serial
+
+import log
+import btq1300st
+from btq1300st import BTQ1300ST
+
+
+class PollingBTQ1300ST(BTQ1300ST):
+    """BTQ1300ST using the old sleep-polling packet reader, for comparison."""
+
+    def __init__(self, device, speed):
+        self.poll_buffer = ''
+        BTQ1300ST.__init__(self, device, speed)
+
+    def recv(self, prefix, timeout=BTQ1300ST.Timeout):
+        """Receive message with given prefix."""
+
+        max_time = time.time() + timeout
+
+        while True:
+            pkt = self.read_pkt(timeout=timeout)
+            if pkt.startswith(prefix):
+                return pkt
+            if time.time() > max_time:
+                break
+            time.sleep(0.01)
+
+        return None
+
+    def read_pkt(self, timeout=None):
+        """Read a packet from the device, sleeping when nothing is there."""
+
+        then = time.time() + timeout
+
+        pkt = ''
+        while time.time() < then:
+            if '\n' in self.poll_buffer:
+                result = self.poll_buffer[:self.poll_buffer.index('\n')+1]
+                self.poll_buffer = self.poll_buffer[self.poll_buffer.index('\n')+1:]
+                return result[1:-5]
+            try:
+                data = self.serial.read(9999)
+            except serial.SerialException:
+                return pkt
+            if len(data) > 0:
+                self.poll_buffer += data
+            else:
+                time.sleep(0.05)
+
+        return pkt
+
+
+def turnaround(gps, count):
+    """Return list of 'count' PMTK000 turnaround times in msec."""
+
+    result = []
+    for _ in range(count):
+        start = time.time()
+        gps.send('PMTK000')
+        if gps.recv('PMTK001,0,') is None:
+            print('No reply to PMTK000, giving up')
+            break
+        result.append((time.time() - start) * 1000.0)
+    return result
+
+
+def report(name, times):
+    if not times:
+        print('%-10s no replies' % name)
+        return
+    times = sorted(times)
+    print('%-10s min %7.2f  median %7.2f  mean %7.2f  max %7.2f msec'
+          % (name, times[0], times[len(times)//2],
+             sum(times)/len(times), times[-1]))
+
+
+def main(argv):
+    if len(argv) < 1 or len(argv) > 3:
+        print(__doc__)
+        return 1
+
+    device = argv[0]
+    speed = int(argv[1]) if len(argv) > 1 else 115200
+    count = int(argv[2]) if len(argv) > 2 else 100
+
+    btq1300st.log = log.Log('bench_latency.log', log.Log.INFO)
+
+    print('%d PMTK000 round trips on %s at %d baud' % (count, device, speed))
+    for (name, cls) in (('polling', PollingBTQ1300ST), ('select', BTQ1300ST)):
+        gps = cls(device, speed)
+        if not gps.sane:
+            print('Device %s is not a BT-Q1300ST device' % device)
+            return 1
+        report(name, turnaround(gps, count))
+        del gps
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
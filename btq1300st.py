@@ -5,13 +5,270 @@
 Class encapsulating the QStarz BT-Q1300ST logger handling.
 """
 
+import os
 import sys
 import glob
 import time
+import select
+import zlib
+import Queue
+import struct
 import serial
+import threading
 import binascii
+import multiprocessing.pool
 
 import log
+import mtklog
+from mtklog import xor_checksum
+
+
+class PacketBuffer(object):
+    """Buffer framing NMEA packets out of bytes received from the device.
+
+    Received bytes are appended to one bytearray.  The search for the next
+    newline resumes where the last one stopped and consumed bytes are only
+    discarded once they make up half the buffer, so framing a backlog of
+    packets costs time proportional to the number of bytes.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.start = 0          # offset of first unconsumed byte
+        self.scan = 0           # offset the newline search resumes from
+        self.received = 0       # total bytes ever appended
+
+    def __len__(self):
+        return len(self.buffer) - self.start
+
+    def append(self, data):
+        """Append received bytes to the buffer."""
+
+        if self.start and self.start * 2 >= len(self.buffer):
+            del self.buffer[:self.start]
+            self.scan -= self.start
+            self.start = 0
+        self.buffer.extend(data)
+        self.received += len(data)
+
+    def packet(self):
+        """Remove the next complete packet from the buffer.
+
+        Returns a tuple (pkt, valid) where 'pkt' is the text between the
+        '$' and '*' and 'valid' is True if the checksum matched.  Returns
+        None if there is no complete packet in the buffer.
+        """
+
+        while True:
+            end = self.buffer.find('\n', self.scan)
+            if end < 0:
+                self.scan = len(self.buffer)
+                return None
+
+            start = self.buffer.find('$', self.start, end)
+            star = self.buffer.rfind('*', self.start, end)
+            self.start = self.scan = end + 1
+
+            if start < 0 or star < start:
+                log.debug('PacketBuffer.packet: discarding unframed line')
+                continue
+
+            try:
+                checksum = int(str(self.buffer[star+1:star+3]), 16)
+            except ValueError:
+                checksum = None
+
+            pkt = str(self.buffer[start+1:star])
+            return (pkt, checksum == xor_checksum(self.buffer, start+1, star))
+
+    def binary_packet(self):
+        """Remove the next complete binary mode packet from the buffer.
+
+        A binary packet is the two byte preamble, a 16 bit length of the
+        whole packet, a 16 bit message ID, the payload, an XOR checksum of
+        the length, ID and payload bytes and a CR/LF tail.
+
+        Returns a tuple (msg_id, payload, valid) where 'valid' is True if
+        the checksum and tail were correct.  Returns None if there is no
+        complete packet in the buffer.
+        """
+
+        while True:
+            start = self.buffer.find(BTQ1300ST.BIN_PREAMBLE, self.start)
+            if start < 0:
+                # keep the last byte, it may start a preamble
+                self.start = max(self.start, len(self.buffer) - 1)
+                self.scan = max(self.scan, self.start)
+                return None
+            self.start = start
+            self.scan = max(self.scan, self.start)
+
+            if len(self.buffer) - start < BTQ1300ST.BIN_OVERHEAD:
+                return None
+            (length, msg_id) = struct.unpack_from('<HH', self.buffer, start+2)
+            if length < BTQ1300ST.BIN_OVERHEAD:
+                log.debug('PacketBuffer.binary_packet: bad length %d' % length)
+                self.start += 1
+                continue
+            if len(self.buffer) - start < length:
+                return None
+
+            end = start + length
+            self.start = self.scan = end
+
+            valid = (self.buffer[end-2:end] == BTQ1300ST.BIN_TAIL and
+                     self.buffer[end-3] == xor_checksum(self.buffer, start+2, end-3))
+            return (msg_id, str(self.buffer[start+6:end-3]), valid)
+
+
+class SectorCache(object):
+    """Local copy of the log sectors of one device log, for incremental sync.
+
+    Each sector is kept in its own file holding as much of the sector as
+    was downloaded, starting with the sector header.  Comparing the cached
+    header with the one on the device shows if the cached copy is good.
+    """
+
+    def __init__(self, directory):
+        """Initialize the cache.
+
+        directory  directory holding the sector files, created if needed
+        """
+
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, sector):
+        """Return path to the file holding sector number 'sector'."""
+
+        return os.path.join(self.directory, 'sector%03d.bin' % sector)
+
+    def load(self, sector):
+        """Return the cached data of 'sector', None if not cached."""
+
+        try:
+            with open(self.path(sector), 'rb') as fd:
+                return fd.read()
+        except IOError:
+            return None
+
+    def store(self, sector, data):
+        """Save the data of 'sector' in the cache."""
+
+        # write and rename, so a crash can't leave a half-written sector
+        path = self.path(sector)
+        with open(path + '.tmp', 'wb') as fd:
+            fd.write(data)
+        os.rename(path + '.tmp', path)
+
+
+class DownloadJournal(object):
+    """On-disk journal of a download in progress, so it can be resumed.
+
+    Each chunk received is written at its flash offset in '<path>.data'
+    and then an (offset, size, crc32) record is appended to '<path>'.  The
+    journal starts with a key describing the download, a journal with a
+    different key is not resumed.  The CRC of a chunk is checked again
+    before the chunk is reused, so data torn by a crash is downloaded
+    again.
+    """
+
+    Magic = 'BTQJ0001'
+    Record = struct.Struct('<III')      # offset, size, crc32
+
+    def __init__(self, path, key, resume=False):
+        """Open the journal.
+
+        path    path of the journal file
+        key     string identifying the download, eg model ID and write address
+        resume  if True, keep the chunks of an earlier download with same key
+        """
+
+        self.path = path
+        self.key = key
+        self.chunks = {}        # (offset, size) -> crc32 of chunk
+
+        header = self.Magic + struct.pack('<H', len(key)) + key
+        if resume:
+            self.load(header)
+        if not self.chunks:
+            with open(path, 'wb') as fd:
+                fd.write(header)
+            open(self.data_path(), 'wb').close()
+        self.journal_fd = open(path, 'ab')
+        self.data_fd = open(self.data_path(), 'r+b')
+
+    def data_path(self):
+        """Return path to the file holding the downloaded data."""
+
+        return self.path + '.data'
+
+    def load(self, header):
+        """Read the chunk records of an earlier download with 'header'."""
+
+        try:
+            with open(self.path, 'rb') as fd:
+                journal = fd.read()
+        except IOError:
+            return
+        if not journal.startswith(header) or not os.path.isfile(self.data_path()):
+            log.info('DownloadJournal: %s is for another download, starting afresh' % self.path)
+            return
+
+        # a crash may leave a partial record at the end, ignore it
+        size = self.Record.size
+        for offset in range(len(header), len(journal) - size + 1, size):
+            (address, length, crc) = self.Record.unpack_from(journal, offset)
+            self.chunks[(address, length)] = crc
+        log.info('DownloadJournal: resuming with %d chunks from %s' % (len(self.chunks), self.path))
+
+    def get(self, offset, size):
+        """Return the journaled chunk of 'size' bytes at 'offset'.
+
+        Returns None if the chunk isn't in the journal or its data no longer
+        matches the CRC recorded for it.
+        """
+
+        crc = self.chunks.get((offset, size))
+        if crc is None:
+            return None
+        self.data_fd.seek(offset)
+        chunk = self.data_fd.read(size)
+        if len(chunk) != size or zlib.crc32(chunk) & 0xffffffff != crc:
+            log.info('DownloadJournal: chunk at 0x%06x failed CRC, reading again' % offset)
+            del self.chunks[(offset, size)]
+            return None
+        return chunk
+
+    def record(self, offset, chunk):
+        """Save 'chunk' downloaded from flash 'offset' in the journal."""
+
+        # data first, so a record never describes data that isn't written
+        crc = zlib.crc32(chunk) & 0xffffffff
+        self.data_fd.seek(offset)
+        self.data_fd.write(chunk)
+        self.data_fd.flush()
+        self.journal_fd.write(self.Record.pack(offset, len(chunk), crc))
+        self.journal_fd.flush()
+        self.chunks[(offset, len(chunk))] = crc
+
+    def close(self):
+        """Flush the journal to disk and close it."""
+
+        for fd in (self.data_fd, self.journal_fd):
+            if not fd.closed:
+                fd.flush()
+                os.fsync(fd.fileno())
+                fd.close()
+
+    def remove(self):
+        """Close and delete the journal, once the download is complete."""
+
+        self.close()
+        for path in (self.path, self.data_path()):
+            if os.path.exists(path):
+                os.remove(path)
 
 
 class BTQ1300ST(object):
@@ -23,10 +280,21 @@ class BTQ1300ST(object):
     PortSpeeds = [115200, 57600, 38400, 19200, 14400, 9600, 4800]
     PortSpeeds.sort()
 
+    # speeds find_devices() tries, most likely first: the MTK default,
+    # then the slow speeds loggers are often left at
+    DiscoverySpeeds = [115200, 9600, 4800, 38400, 57600, 19200, 14400]
+
     Timeout = 0.50          # sec, make bigger if device is slow
+    DiscoveryTimeout = 2.0  # sec, time find_devices() may take beyond one Timeout per speed
+    DiscoveryThreads = 16   # ports probed at once by find_devices()
+    SpeedSettleTime = 0.10  # sec, time the device takes to change speed
     TimeoutPktPreamble = 20 # sec
     TimeoutIdlePort = 500   # msec
 
+    PipelineDepth = 4       # chunk requests kept in flight while downloading
+    ChunkTimeout = 10       # sec, wait this long for a chunk before re-requesting
+    ChunkRetries = 3        # re-requests of one chunk before download fails
+
     SIZEOF_BYTE = 1
     SIZEOF_WORD = 2
     SIZEOF_LONG = 4
@@ -38,6 +306,7 @@ class BTQ1300ST(object):
     SIZEOF_SECTOR = 0x10000
     SIZEOF_SECTOR_HEADER = 0x200
     SIZEOF_SEPARATOR = 0x10
+    SIZEOF_PROBE = 0x100    # bytes read to find the first record of a sector
 
     LOG_FORMAT_UTC = 0x00000001
     LOG_FORMAT_VALID = 0x00000002
@@ -63,15 +332,31 @@ class BTQ1300ST(object):
     RCD_METHOD_OVF = 1
     RCD_METHOD_STP = 2
 
-    def __init__(self, device, speed):
+    SECTOR_COUNT_WRITING = 0xffff   # header record count of sector being written
+
+    DefaultCacheDir = '~/.btq1300st'
+    DefaultJournalFile = 'btq1300st.journal'
+
+    # MTK binary packet mode
+    BIN_PREAMBLE = '\x04\x24'
+    BIN_TAIL = '\x0d\x0a'
+    BIN_OVERHEAD = 9        # preamble, length, ID, checksum and tail bytes
+    BIN_ID_LOG = 182        # same command numbers as PMTK182 and PMTK253
+    BIN_ID_SET_MODE = 253
+
+    def __init__(self, device, speed, timeout=Timeout):
         """Initialize the device.
 
-        device  the device to use
-        speed   comms speed
+        device   the device to use
+        speed    comms speed
+        timeout  time to wait for the device to answer, in seconds
         """
 
         self.memory = None
-        self.read_buffer = ''
+        self.read_buffer = PacketBuffer()
+        self.binary = False
+        self.journal = None     # DownloadJournal of the download in progress
+        self.chunk_queue = None # queue passed each chunk stored, see stream_memory()
         self.sane = False
 
         if device is None:
@@ -91,7 +376,7 @@ class BTQ1300ST(object):
             return
         log.debug('****** device %s IS sane' % device)
 
-        ret = self.recv('PMTK001,0,3')
+        ret = self.recv('PMTK001,0,3', timeout)
         if not ret or not ret.startswith('PMTK001,0,'):
             log.debug('device %s is not a BT-Q1300ST device' % device)
             return
@@ -150,14 +435,50 @@ class BTQ1300ST(object):
         if self.sane and hasattr(self, 'serial') and self.serial:
             del self.serial
 
-    def read_memory(self):
-        """Read device memory."""
+    def read_memory(self, depth=None, binary=True, boost=False, cache_dir=None,
+                    journal_path=None, resume=False, utc_from=None, utc_to=None,
+                    chunk_queue=None):
+        """Read device memory.
+
+        depth         number of chunk requests kept in flight (default PipelineDepth)
+        binary        if True (the default), download in MTK binary packet mode
+        boost         if True, raise the link speed for the download
+        cache_dir     if given, keep a sector cache under this directory and
+                      only download what changed since the last sync (see
+                      sync_chunks()), not used in OVERLAP mode
+        journal_path  if given, journal the download in this file (see
+                      DownloadJournal), it is removed when the download is done
+        resume        if True, reuse chunks journaled by an interrupted download
+        utc_from      if given, only download sectors with records from this
+                      UTC time (seconds since the epoch) on
+        utc_to        if given, only download sectors with records up to
+                      this UTC time
+        chunk_queue   if given, a Queue.Queue each chunk of memory is put on
+                      as (offset, data) as soon as it is stored, None is put
+                      on it when the download ends (see stream_memory())
+
+        Binary mode moves chunks as raw bytes instead of hex text.  If the
+        device won't switch to binary mode the download is done in NMEA
+        mode.  The device is always returned to NMEA mode afterwards.
+
+        With 'boost' the link is raised to the fastest speed that works
+        (see boost_speed()) and restored to the original speed afterwards.
+
+        If the download fails with a journal, calling again with 'resume'
+        only downloads the chunks not yet in the journal.
+
+        With 'utc_from' or 'utc_to' only the sectors covering that time
+        range are downloaded (see read_time_window()) and the sector cache
+        isn't used.  In OVERLAP mode old sectors are rewritten with headers
+        like those cached, so the cache can't be trusted and isn't used.
+        """
 
         # compute the memory used by data log, round-up to the entire sector
         if self.rec_method == self.RCD_METHOD_OVF:
-            # in OVERLAP mode we don't know where data ends, read it all
-            log.info('read_memory: OVERLAP mode, read entire memory')
-            bytes_to_read = flash_memory_size(self.model_id)
+            # in OVERLAP mode we don't know where data ends, consider it all
+            # but only download sectors that have data (see probe_sectors())
+            log.info('read_memory: OVERLAP mode, probe entire memory')
+            bytes_to_read = self.flash_memory_size(self.model_id)
         else:
             # in STOP mode we read from zero to NextWriteAddress
             log.info('read_memory: STOP mode, read zero to next write position')
@@ -171,71 +492,711 @@ class BTQ1300ST(object):
 
         log.info('Retrieving %d (0x%08x) bytes of log data from device' % (bytes_to_read, bytes_to_read))
 
-        non_written_sector_found = False
+        # everything from here is undone in the finally clause, which also
+        # ends the chunk queue whatever goes wrong
+        self.chunk_queue = chunk_queue
+        original_speed = None
+        bytes_read = None
+        try:
+            if journal_path is not None:
+                key = '%s,%d,%08x' % (self.model_id, self.rec_method, self.next_write_address)
+                self.journal = DownloadJournal(journal_path, key, resume)
+
+            # decode each chunk straight into its place in one buffer
+            memory = bytearray('\xff') * bytes_to_read
+            if boost:
+                original_speed = self.boost_speed()
+            if binary and not self.set_binary_mode():
+                log.info('read_memory: binary mode refused, using NMEA mode')
+            try:
+                if utc_from is not None or utc_to is not None:
+                    bytes_read = self.read_time_window(memory, bytes_to_read,
+                                                       utc_from, utc_to, depth)
+                elif self.rec_method == self.RCD_METHOD_OVF:
+                    if cache_dir is not None:
+                        log.info('read_memory: OVERLAP mode, sector cache not used')
+                    bytes_read = self.read_written_sectors(memory, bytes_to_read, depth)
+                elif cache_dir is not None:
+                    bytes_read = self.sync_chunks(memory, bytes_to_read, cache_dir, depth)
+                else:
+                    bytes_read = self.read_chunks(memory, [(0, bytes_to_read)], depth)
+            finally:
+                if self.binary:
+                    self.set_nmea_mode()
+        finally:
+            if self.chunk_queue is not None:
+                self.chunk_queue.put(None)
+                self.chunk_queue = None
+            if original_speed is not None and original_speed != self.serial.baudrate:
+                self.set_speed(original_speed)
+            if self.journal is not None:
+                if bytes_read is None:
+                    self.journal.close()
+                    log.critical("read_memory: download journaled in '%s', resume to continue"
+                                 % journal_path)
+                else:
+                    self.journal.remove()
+                self.journal = None
+        if bytes_read is None:
+            log.critical('read_memory: download failed')
+            return False
+        del memory[bytes_read:]
+
+        log.debug('%d bytes read (expected %d)' % (bytes_read, bytes_to_read))
+        self.memory = memory
 
-        offset = 0
-        data = ''
+        with open('debug.bin', 'wb') as fd:
+            fd.write(self.memory)
+        with open('debug.asc', 'wb') as fd:
+            for offset in range(0, len(self.memory), self.SIZEOF_CHUNK):
+                fd.write(binascii.b2a_hex(self.memory[offset:offset+self.SIZEOF_CHUNK]).upper())
+        log.critical("Dumped memory to files 'debug.asc' (%d bytes) and 'debug.bin' (%d bytes)"
+                     % (len(self.memory)*2, len(self.memory)))
 
-        while offset < bytes_to_read:
-            # request the next CHUNK of data
-            self.send('PMTK182,7,%08x,%08x' % (offset, self.SIZEOF_CHUNK))
-            msg = self.recv('PMTK182,8', 10)
-            if msg:
-                (address, buff) = msg.split(',')[2:]
-                data += buff
+        return True
 
-                if (offset % self.SIZEOF_SECTOR) == 0:
-                    if msg[19:19+self.SIZEOF_SEPARATOR*2] == 'FF'*self.SIZEOF_SEPARATOR:
-                        print('WARNING: Sector header at offset 0x%08X is non-written data' % offset)
-                        log.debug('read_memory: Got sector of non-written data at 0x%06x, ending read' % offset)
-                        break
+    def stream_chunks(self, depth=None, binary=True, boost=False, cache_dir=None,
+                      journal_path=None, resume=False, utc_from=None, utc_to=None):
+        """Read device memory, yielding the chunks as they arrive.
 
-                offset += self.SIZEOF_CHUNK
+        Arguments are as for read_memory().
 
-                # update user 'percent read' display
-                percent = offset * 100.0 / bytes_to_read
-                sys.stdout.write('\rSaved log data: %6.2f%%' % percent)
-                sys.stdout.flush()
+        read_memory() runs in a thread and puts each chunk it stores on a
+        queue, the chunks are yielded as they are taken off it.  read_memory()
+        ends the queue however it returns, so this ends with the download.
 
-            self.recv('PMTK001,182,7,3', 10)
+        Yields tuples (offset, data).  When the generator is done
+        self.memory is None if the download failed.
+        """
 
-        print('')   # terminate user 'percent read' display
+        chunks = Queue.Queue()
+        self.memory = None
+        thread = threading.Thread(target=self.read_memory,
+                                  args=(depth, binary, boost, cache_dir, journal_path,
+                                        resume, utc_from, utc_to, chunks))
+        thread.daemon = True
+        thread.start()
+        try:
+            for chunk in iter(chunks.get, None):
+                yield chunk
+        finally:
+            thread.join()
+
+    def stream_memory(self, depth=None, binary=True, boost=False, cache_dir=None,
+                      journal_path=None, resume=False, utc_from=None, utc_to=None,
+                      checksum_separator=True):
+        """Read device memory, yielding the log records as they arrive.
+
+        checksum_separator  as for mtklog.RecordDecoder
+        Other arguments are as for read_memory().
+
+        The chunks from stream_chunks() are decoded by
+        mtklog.stream_records(), so the records of a sector are yielded as
+        soon as the whole sector is downloaded and can be written out while
+        the download goes on.  To have tracks split at the separators, feed
+        stream_chunks() to mtksink.write_stream() instead.
+
+        Yields tuples (record, valid).  When the generator is done
+        self.memory is None if the download failed.
+        """
+
+        chunks = self.stream_chunks(depth, binary, boost, cache_dir, journal_path,
+                                    resume, utc_from, utc_to)
+        return mtklog.stream_records(chunks, checksum_separator)
+
+    def chunk_stored(self, offset, data):
+        """Put chunk 'data' stored at 'offset' on the chunk queue, if any."""
 
-        while offset < bytes_to_read:
-            # request the next CHUNK of data
-            self.send('PMTK182,7,%08x,%08x' % (offset, self.SIZEOF_CHUNK))
-            msg = self.recv('PMTK182,8', 10)
-            if msg:
-                (address, buff) = msg.split(',')[2:]
-                data += buff
+        if self.chunk_queue is not None:
+            self.chunk_queue.put((offset, bytes(data)))
 
-                if (offset % self.SIZEOF_SECTOR) == 0:
-                    if msg[19:19+self.SIZEOF_SEPARATOR*2] == 'FF'*self.SIZEOF_SEPARATOR:
-                        print('WARNING: Sector header at offset 0x%08X is non-written data' % offset)
-                        log.debug('read_memory: Got sector of non-written data at 0x%06x, ending read' % offset)
-                        break
+    def probe_sectors(self, memory, bytes_to_read, depth=None):
+        """Read the header of each sector to find the sectors holding data.
+
+        memory         bytearray to fill, indexed by flash offset
+        bytes_to_read  number of bytes of flash to consider
+        depth          number of chunk requests kept in flight
+
+        Only the SIZEOF_SECTOR_HEADER bytes at the start of each sector are
+        read.  In STOP mode the first non-written sector ends the log, in
+        OVERLAP mode the log wraps so every sector is checked.
+
+        Returns a list of (base, count, extent) for each written sector,
+        where 'base' is the sector offset, 'count' the header record count
+        and 'extent' the number of bytes of the sector in use.  Returns
+        None on failure, or if a written sector has an invalid header.
+        """
 
-                offset += self.SIZEOF_CHUNK
+        overlap = (self.rec_method == self.RCD_METHOD_OVF)
+        headers = [(base, base + self.SIZEOF_SECTOR_HEADER)
+                   for base in range(0, bytes_to_read, self.SIZEOF_SECTOR)]
+        if self.read_chunks(memory, headers, depth, stop_unwritten=not overlap) is None:
+            return None
+
+        result = []
+        for base in range(0, bytes_to_read, self.SIZEOF_SECTOR):
+            if memory[base:base+self.SIZEOF_SEPARATOR] == '\xff'*self.SIZEOF_SEPARATOR:
+                if not overlap:
+                    break
+                continue
+
+            # parse_sector_header() exits on a bad header, a bad read here
+            # must just fail the download
+            end = base + self.SIZEOF_SECTOR_HEADER
+            if memory[end-6:end-5] != '*' or memory[end-4:end] != '\xbb'*4:
+                log.critical('probe_sectors: invalid sector header at 0x%06x: %s'
+                             % (base, binascii.b2a_hex(memory[end-6:end])))
+                return None
+            (count,) = struct.unpack_from('<H', memory, base)
+            extent = self.SIZEOF_SECTOR
+            if (count == self.SECTOR_COUNT_WRITING and
+                    base <= self.next_write_address < base + self.SIZEOF_SECTOR):
+                # the sector being written, in use up to the write position
+                extent = self.next_write_address - base
+                extent += -extent % self.SIZEOF_CHUNK
+                extent = max(extent, self.SIZEOF_SECTOR_HEADER)
+            result.append((base, count, extent))
+
+        log.info('probe_sectors: %d of %d sectors hold data'
+                 % (len(result), len(headers)))
+        return result
+
+    def read_written_sectors(self, memory, bytes_to_read, depth=None):
+        """Read only the sectors of flash memory that hold data.
+
+        memory         bytearray to fill, indexed by flash offset
+        bytes_to_read  number of bytes of flash to consider
+        depth          number of chunk requests kept in flight
+
+        Sectors are found with probe_sectors(), non-written ones are left
+        as 0xFF in 'memory'.
+
+        Returns the offset of the end of the last written sector, None on
+        failure.
+        """
+
+        sectors = self.probe_sectors(memory, bytes_to_read, depth)
+        if sectors is None:
+            return None
+
+        ranges = [(base + self.SIZEOF_SECTOR_HEADER, base + extent)
+                  for (base, _, extent) in sectors
+                  if extent > self.SIZEOF_SECTOR_HEADER]
+        if ranges and self.read_chunks(memory, ranges, depth) is None:
+            return None
+
+        if not sectors:
+            return 0
+        return sectors[-1][0] + self.SIZEOF_SECTOR
+
+    def read_time_window(self, memory, bytes_to_read, utc_from=None, utc_to=None, depth=None):
+        """Read only the sectors of flash memory covering a time range.
+
+        memory         bytearray to fill, indexed by flash offset
+        bytes_to_read  number of bytes of flash to consider
+        utc_from       earliest UTC time wanted, None means the start of the log
+        utc_to         latest UTC time wanted, None means the end of the log
+        depth          number of chunk requests kept in flight
+
+        Sector headers are read with probe_sectors().  Records are written
+        in time order and in OVERLAP mode the sector after the one being
+        written holds the oldest records, so the written sectors are put in
+        ring order and the UTC of the first record of a sector is then
+        increasing.  Two binary searches over those times (see
+        probe_first_utc(), each probe is one small read) find the first and
+        last sectors that can hold records in the range and only they are
+        downloaded.  Other sectors are left with just their header, the
+        bytes probed in them are set back to non-written.
+
+        If the first record of a probed sector has no UTC time the time
+        range can't be searched and all written sectors are downloaded.
+
+        Returns the offset of the end of the last sector read, None on
+        failure.
+        """
+
+        sectors = self.probe_sectors(memory, bytes_to_read, depth)
+        if sectors is None:
+            return None
+        if not sectors:
+            return 0
+
+        if self.rec_method == self.RCD_METHOD_OVF:
+            # the ring starts after the sector being written
+            writing = self.next_write_address - self.next_write_address % self.SIZEOF_SECTOR
+            sectors = ([sector for sector in sectors if sector[0] > writing] +
+                       [sector for sector in sectors if sector[0] <= writing])
+
+        first_utcs = {}         # sector number -> UTC of its first record
+
+        def first_utc(number):
+            if number not in first_utcs:
+                first_utcs[number] = self.probe_first_utc(memory, sectors[number][0], depth)
+            return first_utcs[number]
+
+        def searchable():
+            return not set([None, mtklog.UTC_UNKNOWN]) & set(first_utcs.values())
+
+        def sectors_started_by(utc):
+            """Return the number of sectors whose first record is at or before 'utc'."""
+
+            lo = 0
+            hi = len(sectors)
+            while lo < hi and searchable():
+                mid = (lo + hi) // 2
+                if first_utc(mid) <= utc:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+
+        first = 0
+        last = len(sectors)
+        if utc_from is not None:
+            # the range starts in the last sector started before it
+            first = max(sectors_started_by(utc_from) - 1, 0)
+        if utc_to is not None:
+            last = sectors_started_by(utc_to)
+        if None in first_utcs.values():
+            return None
+        if not searchable():
+            log.info('read_time_window: sector without UTC time, reading all sectors')
+            (first, last) = (0, len(sectors))
+
+        wanted = sectors[first:last]
+        log.info('read_time_window: %d of %d sectors in time range, %d probes'
+                 % (len(wanted), len(sectors), len(first_utcs)))
+
+        # records probed in sectors out of the range must not be parsed
+        for number in first_utcs:
+            if not first <= number < last:
+                start = sectors[number][0] + self.SIZEOF_SECTOR_HEADER
+                memory[start:start+self.SIZEOF_PROBE] = '\xff' * self.SIZEOF_PROBE
+                self.chunk_stored(start, memory[start:start+self.SIZEOF_PROBE])
+        ranges = sorted([(base + self.SIZEOF_SECTOR_HEADER, base + extent)
+                         for (base, _, extent) in wanted
+                         if extent > self.SIZEOF_SECTOR_HEADER])
+        if ranges and self.read_chunks(memory, ranges, depth) is None:
+            return None
+
+        if not wanted:
+            return 0
+        return max([base for (base, _, _) in wanted]) + self.SIZEOF_SECTOR
+
+    def probe_first_utc(self, memory, base, depth=None):
+        """Return the UTC time of the first record in the sector at 'base'.
+
+        memory  bytearray to fill, indexed by flash offset, holding the
+                sector header
+        base    offset of the sector
+        depth   number of chunk requests kept in flight
+
+        The SIZEOF_PROBE bytes after the sector header are read, any
+        separators skipped and the first record decoded.
+
+        Returns mtklog.UTC_UNKNOWN if the sector has no record or the
+        record has no valid UTC time, None on failure.
+        """
+
+        start = base + self.SIZEOF_SECTOR_HEADER
+        end = start + self.SIZEOF_PROBE
+        if self.read_chunks(memory, [(start, end)], depth, stop_unwritten=False) is None:
+            return None
+
+        log_format = mtklog.header_format(memory, base) or self.log_format
+        offset = start
+        match = mtklog.SeparatorPattern.match(memory, offset, end)
+        while match is not None:
+            separator = str(match.group())
+            offset = match.end()
+            if separator.startswith('HOLUX'):
+                if memory[offset:offset+4] == '    ':
+                    offset += 4
+            elif ord(separator[7]) == mtklog.SEP_TYPE_CHANGE_LOG_BITMASK:
+                (log_format,) = struct.unpack_from('<I', separator, 8)
+            match = mtklog.SeparatorPattern.match(memory, offset, end)
+
+        decoder = mtklog.record_decoder(log_format)
+        if (not log_format & self.LOG_FORMAT_UTC or
+                memory[offset:offset+self.SIZEOF_SEPARATOR] == mtklog.NON_WRITTEN or
+                offset + (decoder.size or self.SIZEOF_SEPARATOR) > end):
+            return mtklog.UTC_UNKNOWN
+        try:
+            (record, _, valid) = decoder.decode(memory, offset)
+        except struct.error:
+            return mtklog.UTC_UNKNOWN
+        if not valid:
+            return mtklog.UTC_UNKNOWN
+        return record.utc
+
+    def sync_chunks(self, memory, bytes_to_read, cache_dir, depth=None):
+        """Read flash memory, downloading only what isn't in the sector cache.
+
+        memory         bytearray to fill, indexed by flash offset
+        bytes_to_read  number of bytes of flash to consider
+        cache_dir      directory holding the sector caches
+        depth          number of chunk requests kept in flight
+
+        Sector headers are read first with probe_sectors().  The log is
+        known by the model ID, the log format and the UTC time of the first
+        record in the first sector (see probe_first_utc()), which only
+        change when the log is erased, and each log has its own SectorCache
+        under 'cache_dir'.  So another device of the same model, or a log
+        erased and written again, is never mixed up with the cached one.
+        If the first record has no UTC time the cache isn't used.
+
+        A full sector whose header matches the cached one is taken from the
+        cache.  For the sector being written, or one that has filled up
+        since the last sync, the cached part is used and only the rest is
+        downloaded.  Any other sector is downloaded whole.  This relies on
+        sectors never being rewritten, ie STOP mode.
+
+        Returns the offset of the end of the last written sector, None on
+        failure.
+        """
+
+        sectors = self.probe_sectors(memory, bytes_to_read, depth)
+        if sectors is None:
+            return None
+
+        cache = None
+        if sectors:
+            base = sectors[0][0]
+            utc = self.probe_first_utc(memory, base, depth)
+            if utc is None:
+                return None
+            if utc == mtklog.UTC_UNKNOWN:
+                log.info('sync_chunks: first record has no UTC time, sector cache not used')
+            else:
+                log_format = mtklog.header_format(memory, base) or self.log_format
+                name = '%s-%08x-%08x' % (self.model_id, log_format, utc)
+                cache = SectorCache(os.path.join(os.path.expanduser(cache_dir), name))
+
+        ranges = []             # (start, end) of data to download
+        for (base, count, extent) in sectors:
+            header = memory[base:base+self.SIZEOF_SECTOR_HEADER]
+
+            start = self.SIZEOF_SECTOR_HEADER
+            cached = None
+            if cache is not None:
+                cached = cache.load(base // self.SIZEOF_SECTOR)
+            if cached is not None and cached[2:self.SIZEOF_SECTOR_HEADER] == header[2:]:
+                (cached_count,) = struct.unpack_from('<H', cached)
+                if cached_count == count and count != self.SECTOR_COUNT_WRITING:
+                    start = len(cached)
+                elif cached_count == self.SECTOR_COUNT_WRITING:
+                    # written since, the last cached chunk may have grown
+                    start = max(start, len(cached) - self.SIZEOF_CHUNK)
+                start = min(start, extent)
+                memory[base+self.SIZEOF_SECTOR_HEADER:base+start] = cached[self.SIZEOF_SECTOR_HEADER:start]
+                if start > self.SIZEOF_SECTOR_HEADER:
+                    self.chunk_stored(base + self.SIZEOF_SECTOR_HEADER,
+                                      cached[self.SIZEOF_SECTOR_HEADER:start])
+
+            if start < extent:
+                ranges.append((base + start, base + extent))
+
+        log.info('sync_chunks: %d bytes not in cache'
+                 % sum([end - start for (start, end) in ranges]))
+        if ranges and self.read_chunks(memory, ranges, depth) is None:
+            return None
+
+        if cache is not None:
+            for (base, _, extent) in sectors:
+                cache.store(base // self.SIZEOF_SECTOR, memory[base:base+extent])
+
+        if not sectors:
+            return 0
+        return sectors[-1][0] + self.SIZEOF_SECTOR
+
+    def read_chunks(self, memory, ranges, depth=None, stop_unwritten=True):
+        """Read ranges of flash memory in pieces of at most SIZEOF_CHUNK.
+
+        memory          bytearray to fill, indexed by flash offset
+        ranges          list of (start, end) offsets of the ranges to read
+        depth           number of chunk requests kept in flight (default PipelineDepth)
+        stop_unwritten  if True, stop at a non-written sector header
+
+        Up to 'depth' chunk requests are outstanding at any time and each
+        reply is matched to its request by the address it carries,
+        so replies may arrive in any order.  A request not answered within
+        ChunkTimeout seconds, or answered with a corrupt reply, is sent
+        again, at most ChunkRetries times.  If nothing at all arrives for
+        Timeout seconds the requests in flight are sent again at once, not
+        counted as retries.  Unless 'stop_unwritten' is
+        False, reading stops at the first sector whose header is
+        non-written data.
+
+        Each chunk is decoded directly into its slot in 'memory'.  With a
+        download journal open, chunks already in the journal are taken from
+        it and each chunk read is recorded in it.
+
+        Returns the offset reading stopped at, None on failure.
+        """
+
+        if depth is None:
+            depth = self.PipelineDepth
+
+        view = memoryview(memory)
+        pending = []            # (offset, size) of chunks not yet requested
+        for (start, end) in ranges:
+            for offset in range(start, end, self.SIZEOF_CHUNK):
+                size = min(self.SIZEOF_CHUNK, end - offset)
+                if self.journal is not None:
+                    chunk = self.journal.get(offset, size)
+                    if chunk is not None:
+                        view[offset:offset+size] = chunk
+                        self.chunk_stored(offset, chunk)
+                        continue
+                pending.append((offset, size))
+        pending.reverse()       # so pop() gives the lowest offset
+        end = max([end for (_, end) in ranges] or [0])
+        total = sum([size for (_, size) in pending])
+
+        sizes = dict(pending)   # offset -> size of chunk requested there
+        in_flight = {}          # offset -> time request was sent
+        resent = {}             # offset -> time request was last sent to a quiet link
+        retries = {}            # offset -> number of times re-requested
+        done = set()            # offsets of chunks stored in 'memory'
+        bytes_done = 0
+
+        while pending or in_flight:
+            # keep the pipeline full
+            while pending and len(in_flight) < depth:
+                (offset, size) = pending.pop()
+                self.request_chunk(offset, size)
+                in_flight[offset] = time.time()
+
+            received = self.read_buffer.received
+            reply = self.read_chunk(timeout=self.Timeout)
+
+            # every branch falls through to the timeout sweep below, so a
+            # stream of unwanted replies can't hold up re-requests
+            (address, chunk) = reply or (None, None)
+            if reply is None:
+                pass
+            elif address not in in_flight:
+                # late reply to a request already re-sent, or junk
+                log.debug('read_chunks: unexpected chunk at 0x%06x' % address)
+            elif (stop_unwritten and chunk is not None and
+                    (address % self.SIZEOF_SECTOR) == 0 and
+                    chunk[:self.SIZEOF_SEPARATOR] == '\xff'*self.SIZEOF_SEPARATOR):
+                print('WARNING: Sector header at offset 0x%08X is non-written data' % address)
+                log.debug('read_chunks: Got sector of non-written data at 0x%06x, ending read' % address)
+                end = address
+                pending = [(offset, size) for (offset, size) in pending if offset < end]
+                for offset in in_flight.keys():
+                    if offset >= end:
+                        del in_flight[offset]
+                done = set([offset for offset in done if offset < end])
+                bytes_done = sum([sizes[offset] for offset in done])
+                total = sum([sizes[offset] for offset in sizes if offset < end])
+            elif chunk is None or len(chunk) != sizes[address]:
+                # corrupt, ask again now rather than wait for the timeout
+                log.info('read_chunks: corrupt reply for chunk at 0x%06x' % address)
+                if not self.retry_chunk(address, sizes[address], retries):
+                    return None
+                in_flight[address] = time.time()
+            else:
+                del in_flight[address]
+                view[address:address+len(chunk)] = chunk
+                if self.journal is not None:
+                    self.journal.record(address, chunk)
+                self.chunk_stored(address, chunk)
+                done.add(address)
+                bytes_done += len(chunk)
 
                 # update user 'percent read' display
-                percent = offset * 100.0 / bytes_to_read
+                percent = bytes_done * 100.0 / total
                 sys.stdout.write('\rSaved log data: %6.2f%%' % percent)
                 sys.stdout.flush()
 
-            self.recv('PMTK001,182,7,3', 10)
+            # re-request anything that has waited too long
+            now = time.time()
+            for (offset, sent) in in_flight.items():
+                if now - sent > self.ChunkTimeout:
+                    log.info('read_chunks: no reply for chunk at 0x%06x' % offset)
+                    if not self.retry_chunk(offset, sizes[offset], retries):
+                        return None
+                    in_flight[offset] = now
+
+            # if not a byte arrived for Timeout the replies still awaited
+            # are lost, send those requests again without waiting for
+            # ChunkTimeout or counting a retry
+            if self.read_buffer.received == received:
+                for (offset, sent) in in_flight.items():
+                    if now - max(sent, resent.get(offset, 0)) > self.Timeout:
+                        log.debug('read_chunks: link quiet, re-sending chunk at 0x%06x' % offset)
+                        self.request_chunk(offset, sizes[offset])
+                        resent[offset] = now
 
         print('')   # terminate user 'percent read' display
 
-        log.debug('%d bytes read (expected %d), len(data)=%d' % (offset+self.SIZEOF_CHUNK, bytes_to_read, len(data)))
-        self.memory = data.decode('hex')
-        log.debug('self.memory=%s' % data)
+        return end
 
-        with open('debug.bin', 'wb') as fd:
-            fd.write(self.memory)
-        with open('debug.asc', 'wb') as fd:
-            fd.write(data)
-        log.critical("Dumped memory to files 'debug.asc' (%d bytes) and 'debug.bin' (%d bytes)"
-                     % (len(data), len(self.memory)))
+    def retry_chunk(self, offset, size, retries):
+        """Request the chunk at 'offset' again.
+
+        offset   flash offset of the chunk
+        size     size of the chunk
+        retries  dict mapping offset to number of times re-requested
+
+        Returns False if the chunk has already been re-requested
+        ChunkRetries times.
+        """
+
+        retries[offset] = retries.get(offset, 0) + 1
+        if retries[offset] > self.ChunkRetries:
+            print('')
+            log.critical('read_chunks: giving up on chunk at 0x%06x' % offset)
+            return False
+        log.info('read_chunks: re-requesting chunk at 0x%06x' % offset)
+        self.request_chunk(offset, size)
+        return True
+
+    def request_chunk(self, offset, size):
+        """Ask the device for 'size' bytes of flash memory at 'offset'."""
+
+        if self.binary:
+            return self.send_binary(self.BIN_ID_LOG, struct.pack('<BII', 7, offset, size))
+        return self.send('PMTK182,7,%08x,%08x' % (offset, size))
+
+    def read_chunk(self, timeout):
+        """Read the reply to a chunk request.
+
+        timeout  read timeout in seconds
+
+        Returns a tuple (address, data) with 'data' as binary bytes, or
+        with 'data' None if the reply failed its checksum.  Returns None on
+        timeout or if some other packet was read.
+        """
+
+        if self.binary:
+            result = self.read_binary_pkt(timeout=timeout)
+            if result is None:
+                return None
+            (msg_id, payload, valid) = result
+            if msg_id != self.BIN_ID_LOG or payload[:1] != '\x08' or len(payload) < 5:
+                log.debug('read_chunk: ignoring binary packet, id=%d' % msg_id)
+                return None
+            (address,) = struct.unpack_from('<I', payload, 1)
+            return (address, payload[5:] if valid else None)
+
+        result = self.read_checked_pkt(timeout=timeout)
+        if result is None:
+            return None
+        (pkt, valid) = result
+        if pkt.startswith('PMTK182,8,'):
+            try:
+                (address, buff) = pkt.split(',')[2:]
+                address = int(address, 16)
+            except ValueError:
+                log.info('read_chunk: bad chunk packet: %s' % pkt[:30])
+                return None
+            try:
+                return (address, binascii.unhexlify(buff) if valid else None)
+            except (TypeError, binascii.Error):
+                return (address, None)
+        if pkt.startswith('PMTK001,182,7,') and not pkt.endswith(',3'):
+            log.info('read_chunk: chunk request failed: %s' % pkt)
+        return None
+
+    def set_binary_mode(self):
+        """Switch the device to MTK binary packet mode.
+
+        Returns True if the device acknowledged the switch.
+        """
+
+        self.send('PMTK253,1,0')
+        ret = self.recv('PMTK001,253,')
+        if not ret or not ret.endswith(',3'):
+            log.info('set_binary_mode: device refused PMTK253: %s' % str(ret))
+            return False
+        self.binary = True
+        log.debug('set_binary_mode: binary mode on')
+        return True
+
+    def set_nmea_mode(self):
+        """Switch the device from binary packet mode back to NMEA mode."""
+
+        self.send_binary(self.BIN_ID_SET_MODE, struct.pack('<BI', 0, 0))
+        self.binary = False
+        if not self.recv('PMTK001,253,3'):
+            log.info('set_nmea_mode: device did not acknowledge return to NMEA')
+            return False
+        log.debug('set_nmea_mode: binary mode off')
+        return True
+
+    def boost_speed(self):
+        """Raise the link to the fastest speed in PortSpeeds that works.
+
+        Speeds faster than the current one are tried fastest first, each
+        checked with a PMTK000 handshake.  If none work the link stays at
+        the current speed.
+
+        Returns the original speed, to be given to set_speed() later.
+        """
+
+        original_speed = self.serial.baudrate
+        for speed in reversed(self.PortSpeeds):
+            if speed <= original_speed:
+                break
+            if self.set_speed(speed):
+                log.info('boost_speed: link raised from %d to %d'
+                         % (original_speed, speed))
+                break
+        return original_speed
+
+    def set_speed(self, speed):
+        """Change the link speed with PMTK251.
+
+        speed  the new speed
+
+        The new speed is checked with a PMTK000 handshake.  If that fails
+        the device is told to go back and the old speed is restored.
+        Returns True if the link works at the new speed.
+        """
+
+        old_speed = self.serial.baudrate
+        log.debug('set_speed: %d -> %d' % (old_speed, speed))
+
+        if self.change_speed(speed, old_speed):
+            return True
+
+        # the device may or may not have changed, tell it to go back
+        log.info('set_speed: no handshake at %d, back to %d' % (speed, old_speed))
+        if not self.change_speed(old_speed, speed):
+            log.critical('set_speed: lost the device at speed %d' % old_speed)
+        return False
+
+    def change_speed(self, speed, old_speed):
+        """Send PMTK251 at 'old_speed', move to 'speed' and check the link.
+
+        Returns True if the device answers PMTK000 at 'speed'.
+        """
+
+        self.serial.baudrate = old_speed
+        self.send('PMTK251,%d' % speed)
+        try:
+            self.serial.flush()
+        except serial.SerialException:
+            return False
+        time.sleep(self.SpeedSettleTime)
+
+        self.serial.baudrate = speed
+        self.read_buffer = PacketBuffer()
+        try:
+            self.serial.flushInput()
+        except serial.SerialException:
+            pass
+        return self.handshake()
+
+    def handshake(self):
+        """Check the link with PMTK000, return True if the device answers."""
+
+        if not self.send('PMTK000'):
+            return False
+        return self.recv('PMTK001,0,3') is not None
 
     def set_memory(self, memory):
         """Set device memory."""
@@ -253,20 +1214,36 @@ class BTQ1300ST(object):
         log.debug('BTQ1300ST.send: %s' % msg[:-2])
         return True
 
+    def send_binary(self, msg_id, payload):
+        """Send a binary mode packet.
+
+        msg_id   message ID (the PMTK command number)
+        payload  string of payload bytes
+        """
+
+        body = struct.pack('<HH', len(payload) + self.BIN_OVERHEAD, msg_id) + payload
+        checksum = xor_checksum(bytearray(body), 0, len(body))
+        try:
+            self.serial.write(self.BIN_PREAMBLE + body + chr(checksum) + self.BIN_TAIL)
+        except serial.SerialException:
+            log.debug('BTQ1300ST.send_binary: failed')
+            return False
+        log.debug('BTQ1300ST.send_binary: id=%d, %d payload bytes' % (msg_id, len(payload)))
+        return True
+
     def recv(self, prefix, timeout=Timeout):
         """Receive message with given prefix."""
 
         max_time = time.time() + timeout
 
         while True:
-            pkt = self.read_pkt(timeout=timeout)
+            pkt = self.read_pkt(timeout=max_time - time.time())
             if pkt.startswith(prefix):
                 log.debug('BTQ1300ST.recv: Got desired packet: %s' % prefix)
                 return pkt
             if time.time() > max_time:
                 log.info('##################### packet_wait: timeout')
                 break
-            time.sleep(0.01)
 
         return None
 
@@ -274,42 +1251,89 @@ class BTQ1300ST(object):
         """Read a packet from the device.
 
         timeout  read timeout in seconds
+
+        Blocks in select() on the port until data arrives, so a packet is
+        returned as soon as its terminating newline is read.  Returns ''
+        if no complete packet arrives before the timeout.
+        """
+
+        result = self.read_checked_pkt(timeout)
+        if result is None:
+            return ''
+        return result[0]
+
+    def read_checked_pkt(self, timeout=None):
+        """Read a packet from the device, with the result of its checksum.
+
+        timeout  read timeout in seconds
+
+        Returns a tuple (pkt, valid), None on timeout.
         """
 
         if timeout is None:
-            timeout = TimeoutIdlePort
+            timeout = self.TimeoutIdlePort / 1000.0
         log.debug('read_pkt: timeout=%s' % str(timeout))
 
         then = time.time() + timeout
 
-        pkt = ''
-        while time.time() < then:
-            if '\n' in self.read_buffer:
-                # get complete response
-                result = self.read_buffer[:self.read_buffer.index('\n')+1]
-                self.read_buffer = self.read_buffer[self.read_buffer.index('\n')+1:]
-
-                # get packet, check checksum
-                pkt = result[1:-5]
-                checksum = result[-4:-2]
-                log.debug("BTQ1300ST.read_pkt: pkt='%s', checksum='%s'"
-                          % (str(pkt), checksum))
-                if int(checksum, 16) != self.calc_checksum(pkt):
-                    log.info('Checksum error on read, got %s expected %s' %
-                             (checksum, self.calc_checksum(pkt)))
-#                    raise Exception('Checksum error on read, got %s expected %s' %
-#                                    (checksum, packet_checksum(pkt)))
-                return pkt
-            try:
-                data = self.serial.read(9999)
-            except serial.SerialException:
-                return pkt
-            if len(data) > 0:
-                self.read_buffer += data
-            else:
-                time.sleep(0.05)
+        while True:
+            result = self.read_buffer.packet()
+            if result is not None:
+                break
+            if not self.fill_buffer(then):
+                return None
+
+        (pkt, valid) = result
+        log.debug("BTQ1300ST.read_pkt: pkt='%s'" % pkt)
+        if not valid:
+            log.info('Checksum error on read, pkt=%s' % pkt)
+        return result
 
-        return pkt
+    def read_binary_pkt(self, timeout=None):
+        """Read a binary mode packet from the device.
+
+        timeout  read timeout in seconds
+
+        Returns a tuple (msg_id, payload, valid), None on timeout.
+        """
+
+        if timeout is None:
+            timeout = self.TimeoutIdlePort / 1000.0
+
+        then = time.time() + timeout
+
+        while True:
+            result = self.read_buffer.binary_packet()
+            if result is not None:
+                break
+            if not self.fill_buffer(then):
+                return None
+
+        (msg_id, payload, valid) = result
+        log.debug('BTQ1300ST.read_binary_pkt: id=%d, %d payload bytes' % (msg_id, len(payload)))
+        if not valid:
+            log.info('Checksum error on binary read, id=%d' % msg_id)
+        return result
+
+    def fill_buffer(self, then):
+        """Wait until time 'then' for data from the device and buffer it.
+
+        Blocks in select() on the port, so returns as soon as data arrives.
+        Returns False if nothing was read before 'then'.
+        """
+
+        remaining = then - time.time()
+        if remaining <= 0:
+            return False
+        try:
+            (readable, _, _) = select.select([self.serial], [], [], remaining)
+            if not readable:
+                return False
+            data = self.serial.read(9999)
+        except (select.error, serial.SerialException):
+            return False
+        self.read_buffer.append(data)
+        return True
 
     def calc_checksum(self, msg):
         result = 0
@@ -318,26 +1342,109 @@ class BTQ1300ST(object):
         return result
 
     @staticmethod
-    def find_devices(speed):
+    def find_devices(speeds=None, timeout=None, ports=None):
         """Find any BT-Q1300ST devices.
 
-        Use the given device speed.  Looks under DefaultDevicePath.
-        Return a list of found devices, [] if not found.
+        speeds   list of speeds to try, in order (default DiscoverySpeeds)
+        timeout  time the whole search may take (default one Timeout per
+                 speed plus DiscoveryTimeout)
+        ports    list of ports to probe (default candidate_devices())
+
+        The ports are probed in parallel, all sharing one deadline, each
+        port trying the speeds in turn.  Return a list of (device, speed,
+        model) tuples, [] if none found.
         """
 
-        log.debug('find_devices: speed=%d' % speed)
-        result = []
+        if speeds is None:
+            speeds = BTQ1300ST.DiscoverySpeeds
+        if timeout is None:
+            timeout = len(speeds) * BTQ1300ST.Timeout + BTQ1300ST.DiscoveryTimeout
+        log.debug('find_devices: speeds=%s' % str(speeds))
+
+        candidates = ports
+        if candidates is None:
+            candidates = BTQ1300ST.candidate_devices()
+        if not candidates:
+            return []
+
+        deadline = time.time() + timeout
+        pool = multiprocessing.pool.ThreadPool(min(len(candidates),
+                                                   BTQ1300ST.DiscoveryThreads))
+        try:
+            found = pool.map(lambda device: BTQ1300ST.probe_device(device, speeds, deadline),
+                             candidates)
+        finally:
+            pool.close()
+            pool.join()
+
+        result = [device for device in found if device is not None]
+        log.debug('find_devices: returning: %s' % str(result))
+        return result
+
+    @staticmethod
+    def candidate_devices():
+        """Return paths of ports that may hold a logger, USB ports first.
 
-        for device in glob.glob(BTQ1300ST.DefaultDevicePath):
+        Where sysfs is available, virtual consoles (ports without a
+        'device' link) are dropped and USB serial ports come first.
+        """
+
+        usb = []
+        others = []
+
+        for device in sorted(glob.glob(BTQ1300ST.DefaultDevicePath)):
             if device == '/dev/tty':
                 # don't interrogate the console!
                 continue
 
-            if BTQ1300ST.check_device(device, speed):
-                result.append(device)
+            sysfs = '/sys/class/tty/%s' % os.path.basename(device)
+            if not os.path.isdir(sysfs):
+                # no sysfs entry (eg, OSX), can't tell, so try it
+                others.append(device)
+            elif not os.path.exists(os.path.join(sysfs, 'device')):
+                # a virtual console, no hardware behind it
+                continue
+            elif '/usb' in os.path.realpath(os.path.join(sysfs, 'device')):
+                usb.append(device)
+            else:
+                others.append(device)
 
-        log.debug('find_device: returning: %s' % str(result))
-        return result
+        log.debug('candidate_devices: usb=%s, others=%s' % (str(usb), str(others)))
+        return usb + others
+
+    @staticmethod
+    def probe_device(device, speeds, deadline):
+        """Look for a BT-Q1300ST on one port.
+
+        device    the port to check
+        speeds    list of speeds to try, in order
+        deadline  time.time() value to give up at
+
+        A device at another speed doesn't answer at all, so a silent port
+        is tried at the next speed.  A port that can't be opened isn't
+        tried again.  Return (device, speed, model), None if not found.
+        """
+
+        for speed in speeds:
+            timeout = min(BTQ1300ST.Timeout, deadline - time.time())
+            if timeout <= 0:
+                break
+            log.debug('probe_device: checking device %s at speed %d' % (device, speed))
+
+            gps = BTQ1300ST(device, speed, timeout)
+            if gps.sane:
+                model = None
+                gps.send('PMTK605')
+                ret = gps.recv('PMTK705,', min(BTQ1300ST.Timeout, deadline - time.time()))
+                if ret:
+                    model = ret.split(',')[2]
+                return (device, speed, model)
+
+            if not hasattr(gps, 'serial'):
+                # can't open it
+                break
+
+        return None
 
     @staticmethod
     def check_device(device, speed):
@@ -430,8 +1537,8 @@ class BTQ1300ST(object):
 
         log.debug('sector_header=%s' % binascii.b2a_hex(sector_header))
 
-        separator = sector_header[-6]
-        checksum = sector_header[-5]
+        separator = sector_header[-6:-5]
+        checksum = sector_header[-5:-4]
         header_tail = binascii.b2a_hex(sector_header[-4:])
         if separator != '*' or header_tail != 'bbbbbbbb':
             log('ERROR: Invalid sector header, see above')
@@ -519,8 +1626,8 @@ class BTQ1300ST(object):
         """Unpack byte array into binary (LSB first)."""
 
         result = 0
-        for val in reversed(byte_array):
-            result = result*256 + ord(val)
+        for val in reversed(bytearray(byte_array)):
+            result = result*256 + val
 
         return result
 
@@ -559,31 +1666,24 @@ if __name__ == '__main__':
         global log
         log = log.Log('btq1300st.log', 10)
     
-        # port speeds are sorted lowest to fastest, choose slowest speed
-        test_speed = BTQ1300ST.PortSpeeds[0]
-    
         # find any BT-Q1300ST devices that are out there
-        devices = BTQ1300ST.find_devices(test_speed)
+        devices = BTQ1300ST.find_devices()
         log.debug('Found devices=%s' % str(devices))
         if len(devices) == 0:
             log.debug('No BT-Q1300ST devices found!?')
             print('No BT-Q1300ST devices found!?')
             return 1
         elif len(devices) == 1:
-            device = devices[0]
-            max_speed = test_speed
-            for speed in BTQ1300ST.PortSpeeds[1:]:
-                if not BTQ1300ST.check_device(device, speed):
-                    break
-                max_speed = speed
-            log.debug("Found device '%s', max speed=%s" % (str(device), str(max_speed)))
-            print("Found device '%s', max speed=%s" % (str(device), str(max_speed)))
+            (device, speed, model) = devices[0]
+            log.debug("Found device '%s', speed=%d, model ID %s" % (device, speed, str(model)))
+            print("Found device '%s', speed=%d, model ID %s" % (device, speed, str(model)))
         else:
-            log.debug('Found more than one device: %s' % ', '.join(devices))
-            print('Found more than one device: %s' % ', '.join(devices))
+            names = [device for (device, _, _) in devices]
+            log.debug('Found more than one device: %s' % ', '.join(names))
+            print('Found more than one device: %s' % ', '.join(names))
             return 2
     
-        gps = BTQ1300ST(device, max_speed)
+        gps = BTQ1300ST(device, speed)
         gps.init()
         print('MTK Firmware: Version %s, Release %s, Model ID %s' % (gps.version, gps.release, gps.model_id))
         print('Flash memory size=0x%06x (%d)' % (gps.flash_memory_size(gps.model_id), gps.flash_memory_size(gps.model_id)))
@@ -591,8 +1691,18 @@ if __name__ == '__main__':
         print('Recording method on memory full: %s' % gps.describe_recording_method(gps.rec_method))
         print('Next write address: 0x%04x (%d)' % (gps.next_write_address, gps.next_write_address))
         print('Number of records: %s (%d)' % (gps.expected_records_total, int(gps.expected_records_total, 16)))
-        gps.read_memory()
-        print('%d bytes of memory read' % len(gps.memory))
+        # raise the speed just for the download, only fetch what's new and
+        # pick up where an interrupted download stopped
+        # and decode the records while downloading
+        records = 0
+        for (record, valid) in gps.stream_memory(boost=True, cache_dir=BTQ1300ST.DefaultCacheDir,
+                                                 journal_path=BTQ1300ST.DefaultJournalFile,
+                                                 resume=True):
+            records += 1
+        if gps.memory is None:
+            print('Download failed')
+            return 1
+        print('%d bytes of memory read, %d records' % (len(gps.memory), records))
 #        gps.parse_log_data(gps.memory)
 
     sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Check the GPX files of pymtkbabel against those of mtkbabel.pl.
+
+Usage: check_perl [<binfile>]
+
+Runs 'mtkbabel.pl -b <binfile> -t -w' and 'pymtkbabel.py -b <binfile>
+--tracks ... --waypoints ...' on a copy of <binfile> (default mtkbabel.bin)
+in a temporary directory and compares the track and waypoint files line by
+line.  The <time> in the GPX <metadata> is when the file was written, so
+it is left out.  Exits 0 if the files are the same, 1 if they differ and
+2 if either program fails (mtkbabel.pl needs Device::SerialPort and
+Date::Format).
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+
+# the files written by mtkbabel.pl for 'log.bin' and the options for
+# pymtkbabel.py writing the same
+Outputs = [('log_trk.gpx', '--tracks'), ('log_wpt.gpx', '--waypoints')]
+
+# how many differing lines to show
+MaxDiffs = 10
+
+
+def gpx_lines(path):
+    """Return the lines of GPX file 'path' without the metadata time."""
+
+    with open(path, 'rb') as fd:
+        lines = fd.read().replace('\r\n', '\n').split('\n')
+    if '<metadata>' in lines:
+        start = lines.index('<metadata>')
+        lines = [line for (i, line) in enumerate(lines)
+                 if not (start < i < start + 3 and line.startswith('  <time>'))]
+    return lines
+
+
+def compare(perl_path, python_path):
+    """Print the differences between two GPX files, return True if none."""
+
+    perl = gpx_lines(perl_path)
+    python = gpx_lines(python_path)
+    diffs = [(i, a, b) for (i, (a, b)) in enumerate(zip(perl, python)) if a != b]
+    if len(perl) != len(python):
+        print('%s: %d lines, mtkbabel.pl wrote %d'
+              % (os.path.basename(python_path), len(python), len(perl)))
+    for (i, a, b) in diffs[:MaxDiffs]:
+        print('line %d:\n  mtkbabel.pl: %s\n  pymtkbabel:  %s' % (i + 1, a, b))
+    return not diffs and len(perl) == len(python)
+
+
+def main(argv):
+    if len(argv) > 1:
+        print(__doc__)
+        return 2
+    here = os.path.dirname(os.path.abspath(__file__))
+    bin_path = os.path.abspath(argv[0] if argv else os.path.join(here, 'mtkbabel.bin'))
+
+    directory = tempfile.mkdtemp()
+    try:
+        shutil.copy(bin_path, os.path.join(directory, 'log.bin'))
+        null = open(os.devnull, 'wb')
+        if subprocess.call(['perl', os.path.join(here, 'mtkbabel.pl'), '-b', 'log.bin', '-t', '-w'],
+                           cwd=directory, stdout=null, stderr=null):
+            print('mtkbabel.pl failed')
+            return 2
+        perl_paths = [os.path.join(directory, name) for (name, _) in Outputs]
+        for path in perl_paths:
+            os.rename(path, path + '.perl')
+
+        command = [sys.executable, os.path.join(here, 'pymtkbabel.py'), '-b', 'log.bin']
+        for (name, option) in Outputs:
+            command.extend([option, name])
+        if subprocess.call(command, cwd=directory, stdout=null, stderr=null):
+            print('pymtkbabel.py failed')
+            return 2
+
+        same = True
+        for path in perl_paths:
+            same = compare(path + '.perl', path) and same
+        print('%s: GPX files %s' % (os.path.basename(bin_path), 'match' if same else 'differ'))
+        return 0 if same else 1
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,12 +1,32 @@
 #!/usr/bin/env python
 #<trkpt lat="32.182141790" lon="76.344743429">
 
+import os
 import sys
+import mmap
+import getopt
+from xml.sax.saxutils import escape
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+import log
+import mtklog
+import btq1300st
+from mtksink import TrackSink, Simplifier, BufferSize, utc_time, write_log
+from mtksimplify import simplify
+from btq1300st import BTQ1300ST
 
 def usage(msg=None):
     if msg:
         print('\n%s\n' % msg)
-    print('Usage: data2kml <input file> [<output file>]')
+    print('Usage: data2kml [-s <metres>] <input file> [<output file>]')
+    print('       data2kml [-s <metres>] -d [-p <port>] <output file>')
+    print('')
+    print('<input file> is a GPX file or a BIN flash image.  With -d the log is')
+    print('downloaded from a BT-Q1300ST logger (on <port>, if given).  With -s')
+    print('tracks are simplified, dropping points within <metres> of the track.')
     sys.exit(1)
 
 def print_preamble(fd):
@@ -23,45 +43,260 @@ def print_preamble(fd):
              '        <PolyStyle>\n'
              '            <color>ffb5c500</color>\n'
              '        </PolyStyle>\n'
-             '    </Style>\n'
-             '    <Placemark>\n'
-             '        <name>NAME</name>\n'
-             '        <description>DESCRIPTION</description>\n'
+             '    </Style>\n')
+
+def print_placemark_begin(fd, name='NAME', description='DESCRIPTION'):
+    fd.write('    <Placemark>\n'
+             '        <name>%s</name>\n'
+             '        <description>%s</description>\n'
              '        <styleUrl>#yellowLineGreenPoly</styleUrl>\n'
              '        <LineString>\n'
              '            <altitudeMode>relative</altitudeMode>\n'
-             '            <coordinates>\n')
+             '            <coordinates>\n' % (escape(name), escape(description)))
 
-def print_postamble(fd):
+def print_placemark_end(fd):
     fd.write('            </coordinates>\n'
              '        </LineString>\n'
-             '    </Placemark>\n'
-             '</Document>\n'
+             '    </Placemark>\n')
+
+def print_postamble(fd):
+    fd.write('</Document>\n'
              '</kml>\n')
 
+class LocalNames(dict):
+    """The tag without its '{namespace}' prefix, for each tag seen."""
+
+    def __missing__(self, tag):
+        name = self[tag] = tag.rpartition('}')[2]
+        return name
+
+class GpxToKml(object):
+    """Parser target writing the track points of a GPX file as KML.
+
+    The parser hands over each element as it is read and no tree is built,
+    so memory use doesn't grow with the size of the GPX file.  Each
+    <trkseg> becomes a Placemark, named after its <trk>.
+
+    With a tolerance the points of each <trkseg> are kept until it ends
+    and then simplified (see mtksimplify), so memory use grows with the
+    longest segment.
+    """
+
+    def __init__(self, outfile, tolerance=None):
+        self.outfile = outfile
+        self.tolerance = tolerance
+        self.points = []        # (lat, lon) of the segment, if simplifying
+        self.names = LocalNames()
+        self.path = []          # local names of the open elements
+        self.text = None        # text of a <trk> <name> or <desc>, when in one
+        self.trk_number = 0
+        self.trk_name = None
+        self.trk_desc = None
+        self.seg_number = 0
+        self.in_placemark = False
+        self.count = 0          # points written
+
+    def start(self, tag, attrib):
+        tag = self.names[tag]
+        if tag == 'trkpt':
+            if not self.in_placemark:
+                self.begin_placemark()
+            if self.tolerance:
+                self.points.append((attrib['lat'], attrib['lon']))
+            else:
+                self.outfile.write('%s,%s,0\n' % (attrib['lon'], attrib['lat']))
+                self.count += 1
+        elif tag == 'trk':
+            self.trk_number += 1
+            self.trk_name = self.trk_desc = None
+            self.seg_number = 0
+        elif tag == 'trkseg':
+            self.seg_number += 1
+        elif tag in ('name', 'desc') and self.path and self.path[-1] == 'trk':
+            self.text = []
+        self.path.append(tag)
+
+    def end(self, tag):
+        tag = self.path.pop()
+        if self.text is not None:
+            if tag == 'name':
+                self.trk_name = ''.join(self.text).strip()
+            else:
+                self.trk_desc = ''.join(self.text).strip()
+            self.text = None
+        elif tag == 'trkseg' and self.in_placemark:
+            if self.tolerance:
+                self.write_simplified()
+            print_placemark_end(self.outfile)
+            self.in_placemark = False
+
+    def data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def close(self):
+        return self.count
+
+    def write_simplified(self):
+        points = self.points
+        self.points = []
+        kept = simplify([float(lat) for (lat, _) in points],
+                        [float(lon) for (_, lon) in points], self.tolerance)
+        self.outfile.write(''.join(['%s,%s,0\n' % (points[i][1], points[i][0]) for i in kept]))
+        self.count += len(kept)
+
+    def begin_placemark(self):
+        name = self.trk_name or 'Track %d' % self.trk_number
+        if self.seg_number > 1:
+            name = '%s (%d)' % (name, self.seg_number)
+        print_placemark_begin(self.outfile, name, self.trk_desc or '')
+        self.in_placemark = True
+
+def gpx_to_kml(infile, outfile, tolerance=None):
+    """Convert the GPX file object 'infile' to KML on 'outfile'.
+
+    'infile' is fed to the parser in BufferSize chunks.  If 'tolerance'
+    is given, tracks are simplified to within that many metres.  Returns
+    the number of points written.
+    """
+
+    print_preamble(outfile)
+    parser = ElementTree.XMLParser(target=GpxToKml(outfile, tolerance))
+    while True:
+        chunk = infile.read(BufferSize)
+        if not chunk:
+            break
+        parser.feed(chunk)
+    points = parser.close()
+    print_postamble(outfile)
+    return points
+
+
+class KmlWriter(TrackSink):
+    """Write the track points of decoded log records to a KML file.
+
+    A sink as in mtksink, so pymtkbabel can write KML straight from the
+    log, in the same pass as its other files.  Each track is a Placemark,
+    named like the GPX <trk>, and waypoints are left out.
+    """
+
+    def __init__(self, path, buffer_size=BufferSize):
+        TrackSink.__init__(self)
+        self.fd = open(path, 'wb', buffer_size)
+        self.trk_number = 0
+        print_preamble(self.fd)
+
+    def begin_track(self, record):
+        self.trk_number += 1
+        if hasattr(record, 'utc'):
+            name = utc_time(record.utc)
+        else:
+            name = 'Track %d' % self.trk_number
+        print_placemark_begin(self.fd, name, '')
+
+    def track_point(self, record):
+        self.fd.write('%.9f,%.9f,0\n' % (record.longitude, record.latitude))
+
+    def end_track(self):
+        print_placemark_end(self.fd)
+
+    def close(self):
+        TrackSink.close(self)
+        print_postamble(self.fd)
+        self.fd.close()
+
+
+def is_gpx(path):
+    """True if file 'path' looks like XML rather than a flash image."""
+
+    with open(path, 'rb') as fd:
+        start = fd.read(64)
+    return start.lstrip('\xef\xbb\xbf \t\r\n').startswith(('<?xml', '<gpx'))
+
+def download_memory(port=None):
+    """Download the log memory of a BT-Q1300ST, None if that fails."""
+
+    btq1300st.log = log.Log('data2kml.log', log.Log.INFO)
+    devices = BTQ1300ST.find_devices(ports=None if port is None else [port])
+    if len(devices) != 1:
+        print('Need one BT-Q1300ST device, found %d' % len(devices))
+        return None
+    (device, speed, _) = devices[0]
+    gps = BTQ1300ST(device, speed)
+    if not gps.init() or not gps.read_memory(boost=True):
+        print('Download from %s failed' % device)
+        return None
+    return gps.memory
+
+def bin_to_kml(buff, output_filename, index=None, tolerance=None):
+    """Write the tracks of flash image 'buff' to KML file 'output_filename'.
+
+    The records are decoded straight into the KML writer, no GPX text is
+    made.  If 'tolerance' is given, tracks are simplified to within that
+    many metres.  Returns the number of valid records.
+    """
+
+    writer = KmlWriter(output_filename)
+    if tolerance:
+        writer = Simplifier(writer, tolerance)
+    try:
+        (records, _) = write_log(buff, writer, index)
+    finally:
+        writer.close()
+    return records
+
+def main(argv):
+    # check params
+    try:
+        (opts, args) = getopt.getopt(argv, 'dp:s:')
+    except getopt.error as msg:
+        usage(str(msg))
+    download = False
+    port = None
+    tolerance = None
+    for (opt, param) in opts:
+        if opt == '-s':
+            try:
+                tolerance = float(param)
+            except ValueError:
+                usage("Option '-s' requires a distance in metres")
+        if opt == '-d':
+            download = True
+        if opt == '-p':
+            port = param
+
+    if download:
+        if len(args) != 1:
+            usage()
+        memory = download_memory(port)
+        if memory is None:
+            return 1
+        bin_to_kml(memory, args[0], tolerance=tolerance)
+        return 0
+
+    if len(args) < 1:
+        usage()
+    input_filename = args[0]
+    if len(args) > 1:
+        output_filename = args[1]
+    else:
+        output_filename = input_filename + '.kml'
+
+    # a flash image is decoded straight to KML
+    if not is_gpx(input_filename):
+        with open(input_filename, 'rb') as fd:
+            if os.fstat(fd.fileno()).st_size == 0:
+                usage("File '%s' is empty" % input_filename)
+            buff = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        bin_to_kml(buff, output_filename, mtklog.open_index(input_filename, buff), tolerance)
+        return 0
+
+    # convert file
+    with open(input_filename, 'rb') as infile:
+        with open(output_filename, 'wb', BufferSize) as outfile:
+            gpx_to_kml(infile, outfile, tolerance)
+    return 0
+
 
-# check params
-if len(sys.argv) < 2:
-    usage()
-input_filename = sys.argv[1]
-if len(sys.argv) > 2:
-    output_filename = sys.argv[2]
-else:
-    output_filename = input_filename + '.kml'
-
-# analyse file
-with open(input_filename, 'rb') as fd:
-    lines = fd.readlines()
-
-with open(output_filename, 'wb') as fd:
-    print_preamble(fd)
-    for line in lines:
-        line = line.strip()
-        if line.startswith('<trkpt '):
-            #print(line)
-            fields = line.split('=')
-            lat = fields[1].split('"')[1]
-            lon = fields[2].split('"')[1]
-            fd.write('%s,%s,0\n' % (lon, lat))
-            #print('%s,%s,0' % (lon, lat))
-    print_postamble(fd)
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A stand-in BT-Q1300ST logger on a pseudo-terminal, for testing without hardware.
+
+Usage: fake_device [<options>] <binfile>
+
+Serves the flash image in <binfile> (eg, mtkbabel.bin) and prints the name
+of the pty to use as the device, eg:
+    python fake_device.py mtkbabel.bin > fake.dev &
+    python bench_latency.py $(cat fake.dev)
+
+Where <options> is zero or more of:
+    -c <percent>            corrupt <percent> of chunk replies
+    --corrupt <percent>
+    -d <percent>            drop <percent> of chunk replies
+    --drop <percent>
+    -h                      print help and stop
+    --help
+    -m <model>              report model ID <model> (default 0005)
+    --model <model>
+    -n                      refuse to switch to binary packet mode
+    --nmea-only
+    -o                      report OVERLAP recording method (default STOP)
+    --overlap
+    -r                      send chunk replies out of order
+    --reorder
+    -s <speed>              start at port speed <speed> (default: any speed)
+    --speed <speed>
+    -S <speed>              highest speed PMTK251 will switch to
+    --max-speed <speed>     (default 115200)
+
+The device answers the PMTK commands used by btq1300st.py: PMTK000, PMTK604,
+PMTK605, PMTK182,2 queries and PMTK182,7 log reads.  PMTK253 switches
+between NMEA and MTK binary packet mode.  PMTK251 changes the port speed;
+once a speed is set, input sent at any other speed is treated as garbled.
+"""
+
+import os
+import sys
+import pty
+import tty
+import time
+import getopt
+import random
+import select
+import struct
+import termios
+
+
+SIZEOF_SECTOR = 0x10000
+
+BIN_PREAMBLE = '\x04\x24'
+BIN_TAIL = '\x0d\x0a'
+BIN_OVERHEAD = 9
+BIN_ID_LOG = 182
+BIN_ID_SET_MODE = 253
+
+
+def checksum(data):
+    """Return XOR of the bytes in string 'data'."""
+
+    result = 0
+    for ch in data:
+        result ^= ord(ch)
+    return result
+
+
+class FakeDevice(object):
+    """A pretend BT-Q1300ST logger serving a flash image."""
+
+    def __init__(self, image, model='0005', drop=0, reorder=False, binary=True,
+                 speed=None, max_speed=115200, overlap=False, corrupt=0):
+        """Initialize the device.
+
+        image    string holding the flash memory image
+        model    model ID to report
+        drop     percentage of chunk replies to drop
+        reorder  if True, send chunk replies out of order
+        binary   if True, allow switching to binary packet mode
+        speed    port speed, None means any speed works
+        max_speed  highest speed PMTK251 will switch to
+        overlap  if True, report OVERLAP recording method
+        corrupt  percentage of chunk replies to corrupt
+        """
+
+        self.image = image
+        self.model = model
+        self.drop = drop
+        self.reorder = reorder
+        self.allow_binary = binary
+        self.binary = False
+        self.speed = speed
+        self.max_speed = max_speed
+        self.method = 1 if overlap else 2
+        self.corrupt = corrupt
+        self.buffer = ''
+        self.held = []          # chunk replies held back for reordering
+
+        # the log format and record count come from the sector headers
+        (_, self.log_format) = struct.unpack_from('<HI', image, 0)
+        self.records = 0
+        for offset in range(0, len(image), SIZEOF_SECTOR):
+            (count,) = struct.unpack_from('<H', image, offset)
+            if count != 0xffff:
+                self.records += count
+        self.next_write = len(image.rstrip('\xff'))
+
+        (self.master, slave) = pty.openpty()
+        tty.setraw(slave)
+        self.name = os.ttyname(slave)
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def mangle(self, data):
+        """Return 'data' with one byte in the middle changed."""
+
+        middle = len(data) // 2
+        return data[:middle] + chr(ord(data[middle]) ^ 0x01) + data[middle+1:]
+
+    def send(self, msg):
+        self.write('$%s*%02X\r\n' % (msg, checksum(msg)))
+
+    def send_binary(self, msg_id, payload):
+        body = struct.pack('<HH', len(payload) + BIN_OVERHEAD, msg_id) + payload
+        self.write(BIN_PREAMBLE + body + chr(checksum(body)) + BIN_TAIL)
+
+    def chunk(self, offset, size):
+        """Return 'size' bytes of flash at 'offset', unwritten is 0xFF."""
+
+        data = self.image[offset:offset+size]
+        return data + '\xff' * (size - len(data))
+
+    def reply_chunk(self, offset, size):
+        """Send (or hold back or drop) the reply to a log read."""
+
+        corrupt = random.uniform(0, 100) < self.corrupt
+        if self.binary:
+            payload = struct.pack('<BI', 8, offset) + self.chunk(offset, size)
+            body = struct.pack('<HH', len(payload) + BIN_OVERHEAD, BIN_ID_LOG) + payload
+            packet = BIN_PREAMBLE + body + chr(checksum(body)) + BIN_TAIL
+            if corrupt:
+                packet = self.mangle(packet)
+            reply = lambda: self.write(packet)
+        else:
+            msg = 'PMTK182,8,%08X,%s' % (offset, self.chunk(offset, size).encode('hex').upper())
+            packet = '$%s*%02X\r\n' % (msg, checksum(msg))
+            if corrupt:
+                packet = self.mangle(packet)
+            reply = lambda: (self.write(packet), self.send('PMTK001,182,7,3'))
+
+        if random.uniform(0, 100) < self.drop:
+            return
+        self.held.append(reply)
+        if not self.reorder or len(self.held) > 2:
+            random.shuffle(self.held)
+            for reply in self.held:
+                reply()
+            self.held = []
+
+    def handle(self, msg):
+        """Handle one NMEA command."""
+
+        fields = msg.split(',')
+        if msg == 'PMTK000':
+            self.send('PMTK001,0,3')
+        elif msg == 'PMTK604':
+            self.send('PMTK001,604,3')
+        elif msg == 'PMTK605':
+            self.send('PMTK705,AXN_0.0-B_FAKE,%s,QST1300ST' % self.model)
+        elif msg.startswith('PMTK182,2,'):
+            values = {'2': '%08X' % self.log_format,
+                      '6': '%d' % self.method,
+                      '8': '%08X' % self.next_write,
+                      '10': '%08X' % self.records}
+            self.send('PMTK001,182,2,3')
+            if fields[2] in values:
+                self.send('PMTK182,3,%s,%s' % (fields[2], values[fields[2]]))
+        elif msg.startswith('PMTK182,7,'):
+            self.reply_chunk(int(fields[2], 16), int(fields[3], 16))
+        elif msg.startswith('PMTK251,'):
+            # no reply, the device just changes speed
+            speed = int(fields[1])
+            if speed <= self.max_speed:
+                self.speed = speed
+        elif msg.startswith('PMTK253,1,'):
+            if self.allow_binary:
+                self.send('PMTK001,253,3')
+                self.binary = True
+            else:
+                self.send('PMTK001,253,1')
+        else:
+            self.send('PMTK001,%s,1' % fields[0][4:])
+
+    def handle_binary(self, msg_id, payload):
+        """Handle one binary mode command."""
+
+        if msg_id == BIN_ID_LOG and payload[:1] == '\x07':
+            (offset, size) = struct.unpack_from('<II', payload, 1)
+            self.reply_chunk(offset, size)
+        elif msg_id == BIN_ID_SET_MODE and payload[:1] == '\x00':
+            self.binary = False
+            self.send('PMTK001,253,3')
+
+    def process(self):
+        """Handle all complete commands in the input buffer."""
+
+        while True:
+            if self.binary:
+                start = self.buffer.find(BIN_PREAMBLE)
+                if start < 0 or len(self.buffer) - start < BIN_OVERHEAD:
+                    return
+                (length, msg_id) = struct.unpack_from('<HH', self.buffer, start+2)
+                if len(self.buffer) - start < length:
+                    return
+                packet = self.buffer[start:start+length]
+                self.buffer = self.buffer[start+length:]
+                if ord(packet[-3]) == checksum(packet[2:-3]):
+                    self.handle_binary(msg_id, packet[6:-3])
+            else:
+                if '\n' not in self.buffer:
+                    return
+                (line, self.buffer) = self.buffer.split('\n', 1)
+                start = line.find('$')
+                star = line.rfind('*')
+                if start >= 0 and star > start:
+                    msg = line[start+1:star]
+                    if line[star+1:star+3].upper() == '%02X' % checksum(msg):
+                        self.handle(msg)
+
+    def speed_matches(self):
+        """Return True if the other end of the pty is at our port speed."""
+
+        if self.speed is None:
+            return True
+        ispeed = termios.tcgetattr(self.master)[4]
+        return ispeed == getattr(termios, 'B%d' % self.speed, None)
+
+    def run(self):
+        """Serve commands forever."""
+
+        while True:
+            select.select([self.master], [], [])
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                # nobody has the slave side open, wait for them
+                time.sleep(0.1)
+                continue
+            if not self.speed_matches():
+                # wrong speed, all we see is noise
+                self.buffer = ''
+                continue
+            self.buffer += data
+            self.process()
+
+
+def usage(msg=None):
+    print(__doc__)        # module docstring used
+    if msg:
+        print('-'*80)
+        print(msg)
+        print('-'*80)
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, 'c:d:hm:nors:S:',
+                                   ['corrupt=', 'drop=', 'help', 'max-speed=', 'model=',
+                                    'nmea-only', 'overlap', 'reorder', 'speed='])
+    except getopt.error as msg:
+        usage(str(msg))
+        return 1
+
+    drop = 0
+    corrupt = 0
+    model = '0005'
+    reorder = False
+    binary = True
+    speed = None
+    max_speed = 115200
+    overlap = False
+    for (opt, param) in opts:
+        if opt in ['-c', '--corrupt', '-d', '--drop']:
+            try:
+                percent = float(param)
+            except ValueError:
+                usage("Option '%s' requires a percentage" % opt)
+                return 1
+            if opt in ['-c', '--corrupt']:
+                corrupt = percent
+            else:
+                drop = percent
+        if opt in ['-h', '--help']:
+            usage()
+            return 0
+        if opt in ['-m', '--model']:
+            model = param
+        if opt in ['-n', '--nmea-only']:
+            binary = False
+        if opt in ['-o', '--overlap']:
+            overlap = True
+        if opt in ['-r', '--reorder']:
+            reorder = True
+        if opt in ['-s', '--speed', '-S', '--max-speed']:
+            try:
+                value = int(param)
+            except ValueError:
+                usage("Option '%s' requires integer speed" % opt)
+                return 1
+            if opt in ['-s', '--speed']:
+                speed = value
+            else:
+                max_speed = value
+
+    if len(args) != 1:
+        usage()
+        return 1
+
+    with open(args[0], 'rb') as fd:
+        image = fd.read()
+
+    device = FakeDevice(image, model, drop, reorder, binary, speed, max_speed,
+                        overlap, corrupt)
+    print(device.name)
+    sys.stdout.flush()
+    device.run()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
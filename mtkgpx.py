@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Writing decoded log records as GPX files.
+
+GpxWriter follows gpx_print_trk_begin(), gpx_print_trkpt(),
+gpx_print_wpt() and friends in mtkbabel.pl.  Records are written as they
+are handed over, so memory use doesn't grow with the number of points.
+As in mtkbabel.pl the <trk> and <wpt> elements go to temporary files first
+and each GPX file is put together when the writer is closed, as the
+<bounds> in the GPX header are only known then.
+"""
+
+import time
+import shutil
+import tempfile
+
+from mtksink import TrackSink, utc_time
+
+
+# values of the VALID field
+VALID_NOFIX = 0x0001
+VALID_SPS = 0x0002
+VALID_DGPS = 0x0004
+VALID_PPS = 0x0008
+VALID_RTK = 0x0010
+VALID_FRTK = 0x0020
+VALID_ESTIMATED = 0x0040
+VALID_MANUAL = 0x0080
+VALID_SIMULATOR = 0x0100
+
+# values of the RCR field
+RCR_TIME = 0x01
+RCR_SPEED = 0x02
+RCR_DISTANCE = 0x04
+RCR_BUTTON = 0x08
+
+GPX_EOL = '\n'
+
+BufferSize = 1024 * 1024    # write buffer size of each GPX and temporary file
+
+# description of VALID for the <mtk:valid> element
+ValidMtk = {VALID_NOFIX: 'nofix', VALID_SPS: 'sps', VALID_DGPS: 'dgps',
+            VALID_PPS: 'pps', VALID_RTK: 'rtk', VALID_FRTK: 'frtk',
+            VALID_ESTIMATED: 'estimated', VALID_MANUAL: 'manual',
+            VALID_SIMULATOR: 'simulator'}
+
+# description of VALID for the GPX <fix> element
+ValidGpx = {VALID_NOFIX: 'none', VALID_SPS: '3d', VALID_DGPS: 'dgps', VALID_PPS: 'pps'}
+
+# (bit, name) of the RCR bits for the GPX <type> element
+RcrNames = [(RCR_TIME, 'TIME'), (RCR_SPEED, 'SPEED'),
+            (RCR_DISTANCE, 'DISTANCE'), (RCR_BUTTON, 'BUTTON')]
+
+# format of each satellite field in <mtk:satdata>
+SatelliteFormats = {'elevation': '%d', 'azimuth': '%u', 'snr': '%u'}
+
+# the fields that put an <extensions> element in a point
+ExtensionFields = ('speed', 'heading', 'nsat_in_view', 'millisecond', 'distance', 'satellites')
+
+
+def describe_rcr_gpx(rcr):
+    """Return RCR as for the GPX <type> element, None if no bits are set."""
+
+    return ','.join([name for (bit, name) in RcrNames if rcr & bit]) or None
+
+
+def describe_valid_mtk(valid):
+    """Return VALID as for the <mtk:valid> element."""
+
+    return ValidMtk.get(valid, 'Unknown')
+
+
+def type_element(rcr):
+    """Return the <type> element for RCR 'rcr', '' if no bits are set."""
+
+    description = describe_rcr_gpx(rcr)
+    if description is None:
+        return ''
+    return '  <type>%s</type>%s' % (description, GPX_EOL)
+
+
+def fix_element(valid):
+    """Return the <fix> element for VALID 'valid', '' if there is none."""
+
+    fix = ValidGpx.get(valid)
+    if fix is None:
+        return ''
+    return '  <fix>%s</fix>%s' % (fix, GPX_EOL)
+
+
+class ElementCache(dict):
+    """The element for each value of a field, made on first use."""
+
+    def __init__(self, make):
+        """make  function returning the element for a value"""
+
+        dict.__init__(self)
+        self.make = make
+
+    def __missing__(self, value):
+        element = self[value] = self.make(value)
+        return element
+
+
+def hundredths(value):
+    return value / 100.0
+
+
+# the <type>, <fix> and <mtk:valid> elements are looked up, not formatted
+TypeElements = ElementCache(type_element)
+FixElements = ElementCache(fix_element)
+ValidMtkNames = ElementCache(describe_valid_mtk)
+
+
+class Bounds(object):
+    """Latitude and longitude bounds of the points written."""
+
+    def __init__(self):
+        self.minlat = 90.0
+        self.minlon = 180.0
+        self.maxlat = -90.0
+        self.maxlon = -180.0
+
+    def add(self, latitude, longitude):
+        if latitude < self.minlat:
+            self.minlat = latitude
+        if latitude > self.maxlat:
+            self.maxlat = latitude
+        if longitude < self.minlon:
+            self.minlon = longitude
+        if longitude > self.maxlon:
+            self.maxlon = longitude
+
+    def union(self, other):
+        """Return the Bounds holding both self and 'other'."""
+
+        result = Bounds()
+        result.minlat = min(self.minlat, other.minlat)
+        result.minlon = min(self.minlon, other.minlon)
+        result.maxlat = max(self.maxlat, other.maxlat)
+        result.maxlon = max(self.maxlon, other.maxlon)
+        return result
+
+
+class PointFormat(object):
+    """Formats the <trkpt> and <wpt> elements for one Record class.
+
+    Which fields a record has only depends on its log format, so the
+    elements of a point are put together once per Record class into one
+    format string and a function returning the tuple of values for it
+    (made like collections.namedtuple() makes its classes).  A point is
+    then written with one % operation.
+    """
+
+    def __init__(self, cls):
+        """cls  the Record class, see mtklog.RecordDecoder"""
+
+        self.fields = set(cls._fields)
+        self.satellite_fields = getattr(cls, 'satellite_fields', ())
+        self.index = dict([(name, i) for (i, name) in enumerate(cls._fields)])
+
+        # gpx_print_pt_attributes() in mtkbabel.pl
+        attributes = []
+        self.add(attributes, 'rcr', '%s', TypeElements.__getitem__)
+        self.add(attributes, 'valid', '%s', FixElements.__getitem__)
+        self.add(attributes, 'nsat_in_use', '  <sat>%u</sat>' + GPX_EOL)
+        self.add(attributes, 'hdop', '  <hdop>%.2f</hdop>' + GPX_EOL, hundredths)
+        self.add(attributes, 'vdop', '  <vdop>%.2f</vdop>' + GPX_EOL, hundredths)
+        self.add(attributes, 'pdop', '  <pdop>%.2f</pdop>' + GPX_EOL, hundredths)
+        self.add(attributes, 'dage', '  <ageofdgpsdata>%u</ageofdgpsdata>' + GPX_EOL)
+        self.add(attributes, 'dsta', '  <dgpsid>%u</dgpsid>' + GPX_EOL)
+        if self.fields.intersection(ExtensionFields):
+            attributes.append(('  <extensions>' + GPX_EOL + '    <mtk:wptExtension>' + GPX_EOL, None, None))
+            self.add(attributes, 'valid', '      <mtk:valid>%s</mtk:valid>' + GPX_EOL,
+                     ValidMtkNames.__getitem__)
+            self.add(attributes, 'speed', '      <mtk:speed>%.6f</mtk:speed>' + GPX_EOL)
+            self.add(attributes, 'heading', '      <mtk:heading>%.6f</mtk:heading>' + GPX_EOL)
+            self.add(attributes, 'nsat_in_view', '      <mtk:satinview>%u</mtk:satinview>' + GPX_EOL)
+            self.add(attributes, 'satellites', '%s', self.satdata)
+            self.add(attributes, 'millisecond', '      <mtk:msec>%u</mtk:msec>' + GPX_EOL)
+            self.add(attributes, 'distance', '      <mtk:distance>%.9f</mtk:distance>' + GPX_EOL)
+            attributes.append(('    </mtk:wptExtension>' + GPX_EOL + '  </extensions>' + GPX_EOL, None, None))
+        (self.attributes_template, self.attributes_values) = self.compile(attributes)
+
+        # gpx_print_trkpt() in mtkbabel.pl
+        trkpt = [('<trkpt lat="%.9f" lon="%.9f">' + GPX_EOL, None, None)]
+        self.add(trkpt, 'latitude', '')
+        self.add(trkpt, 'longitude', '')
+        self.add(trkpt, 'height', '  <ele>%.6f</ele>' + GPX_EOL)
+        self.add(trkpt, 'utc', '  <time>%s</time>' + GPX_EOL, utc_time)
+        trkpt.extend(attributes)
+        trkpt.append(('</trkpt>' + GPX_EOL, None, None))
+        (self.trkpt_template, self.trkpt_values) = self.compile(trkpt)
+
+    def add(self, parts, name, template, conversion=None):
+        """Append the element 'template' for field 'name' to 'parts', if
+        the record has that field."""
+
+        if name in self.index:
+            parts.append((template, self.index[name], conversion))
+
+    @staticmethod
+    def compile(parts):
+        """Return (format string, values function) for 'parts'."""
+
+        template = ''.join([template for (template, _, _) in parts])
+        namespace = {}
+        values = []
+        for (_, index, conversion) in parts:
+            if index is None:
+                continue
+            if conversion is None:
+                values.append('record[%d]' % index)
+            else:
+                name = 'conversion%d' % len(namespace)
+                namespace[name] = conversion
+                values.append('%s(record[%d])' % (name, index))
+        function = eval('lambda record: (%s)' % ''.join([value + ', ' for value in values]), namespace)
+        return (template, function)
+
+    def satdata(self, satellites):
+        """Return the <mtk:satdata> elements for 'satellites'."""
+
+        out = []
+        for satellite in satellites:
+            # (sid, in_use, in_view, [elevation, azimuth, snr])
+            out.append('      <mtk:satdata sid="%u" inuse="%u">%s'
+                       % (satellite[0], satellite[1], GPX_EOL))
+            for (name, value) in zip(self.satellite_fields, satellite[3:]):
+                out.append('        <mtk:%s>%s</mtk:%s>%s'
+                           % (name, SatelliteFormats[name] % value, name, GPX_EOL))
+            out.append('      </mtk:satdata>%s' % GPX_EOL)
+        return ''.join(out)
+
+    def trkpt(self, record):
+        """Return the <trkpt> element of 'record'."""
+
+        return self.trkpt_template % self.trkpt_values(record)
+
+    def attributes(self, record):
+        """Return the elements common to <trkpt> and <wpt> of 'record'."""
+
+        return self.attributes_template % self.attributes_values(record)
+
+
+class GpxWriter(TrackSink):
+    """Write log records to GPX track and waypoint files as they come.
+
+    Call record() for each valid record in log order, track_break() where
+    the log has a separator or non-written space and next_waypoint() for a
+    Holux waypoint separator, then close().  Records are sorted into <trk>
+    and <wpt> elements by mtksink.TrackSink, as in mtkbabel.pl.
+    """
+
+    def __init__(self, gpx_path=None, tracks_path=None, waypoints_path=None,
+                 buffer_size=BufferSize):
+        """Make the writer.
+
+        gpx_path        if given, write tracks and waypoints to this file
+        tracks_path     if given, write only tracks to this file
+        waypoints_path  if given, write only waypoints to this file
+        buffer_size     size of the write buffer of each file
+        """
+
+        TrackSink.__init__(self)
+        self.gpx_path = gpx_path
+        self.tracks_path = tracks_path
+        self.waypoints_path = waypoints_path
+        self.buffer_size = buffer_size
+
+        self.trk = None
+        self.wpt = None
+        if gpx_path or tracks_path:
+            self.trk = tempfile.TemporaryFile(bufsize=buffer_size)
+        if gpx_path or waypoints_path:
+            self.wpt = tempfile.TemporaryFile(bufsize=buffer_size)
+
+        self.trk_bounds = Bounds()
+        self.wpt_bounds = Bounds()
+        self.trk_number = 0
+        self.wpt_number = 0
+        self.formats = {}       # Record class -> PointFormat
+
+    def point_format(self, record):
+        cls = type(record)
+        result = self.formats.get(cls)
+        if result is None:
+            result = self.formats[cls] = PointFormat(cls)
+        return result
+
+    def begin_track(self, record):
+        self.write_trk_begin(record)
+
+    def track_point(self, record):
+        if self.trk is not None:
+            fmt = self.formats.get(type(record)) or self.point_format(record)
+            self.trk.write(fmt.trkpt(record))
+            self.trk_bounds.add(record.latitude, record.longitude)
+
+    def end_track(self):
+        if self.trk is not None:
+            self.trk.write('</trkseg>%s</trk>%s' % (GPX_EOL, GPX_EOL))
+
+    def waypoint(self, record):
+        self.write_wpt(record)
+
+    def write_trk_begin(self, record):
+        """gpx_print_trk_begin() in mtkbabel.pl"""
+
+        if self.trk is not None:
+            out = ['<trk>%s' % GPX_EOL]
+            if hasattr(record, 'utc'):
+                out.append('  <name>%s</name>%s' % (utc_time(record.utc), GPX_EOL))
+            if self.trk_number > 0:
+                out.append('  <number>%u</number>%s' % (self.trk_number, GPX_EOL))
+            out.append('<trkseg>%s' % GPX_EOL)
+            self.trk.write(''.join(out))
+        self.trk_number += 1
+
+    def write_wpt(self, record):
+        """gpx_print_wpt() in mtkbabel.pl"""
+
+        self.wpt_number += 1
+        if self.wpt is None:
+            return
+        fmt = self.point_format(record)
+        out = ['<wpt lat="%.9f" lon="%.9f">%s' % (record.latitude, record.longitude, GPX_EOL)]
+        if 'height' in fmt.fields:
+            out.append('  <ele>%.6f</ele>%s' % (record.height, GPX_EOL))
+        if 'utc' in fmt.fields:
+            out.append('  <time>%s</time>%s' % (utc_time(record.utc), GPX_EOL))
+        out.append('  <name>%03d</name>%s' % (self.wpt_number, GPX_EOL))
+        out.append('  <cmt>%03d</cmt>%s' % (self.wpt_number, GPX_EOL))
+        if 'utc' in fmt.fields:
+            out.append('  <desc>%s</desc>%s' % (utc_time(record.utc), GPX_EOL))
+        out.append('  <sym>Flag</sym>%s' % GPX_EOL)
+        out.append(fmt.attributes(record))
+        out.append('</wpt>%s' % GPX_EOL)
+        self.wpt.write(''.join(out))
+        self.wpt_bounds.add(record.latitude, record.longitude)
+
+    def close(self):
+        """End the last <trk> and write the GPX files."""
+
+        TrackSink.close(self)
+        now = time.time()
+        if self.gpx_path:
+            bounds = self.trk_bounds.union(self.wpt_bounds)
+            self.write_gpx(self.gpx_path, now, bounds, [self.trk, self.wpt])
+        if self.tracks_path:
+            self.write_gpx(self.tracks_path, now, self.trk_bounds, [self.trk])
+        if self.waypoints_path:
+            self.write_gpx(self.waypoints_path, now, self.wpt_bounds, [self.wpt])
+        for fd in (self.trk, self.wpt):
+            if fd is not None:
+                fd.close()
+        self.trk = self.wpt = None
+
+    def write_gpx(self, path, now, bounds, parts):
+        """Write GPX file 'path' holding the temporary files 'parts'.
+
+        This is gpx_print_gpx_begin() and gpx_print_gpx_end() in
+        mtkbabel.pl around the copied parts.
+        """
+
+        with open(path, 'wb', self.buffer_size) as fd:
+            fd.write(GPX_EOL.join([
+                    '<?xml version="1.0" encoding="UTF-8"?>',
+                    '<gpx',
+                    '  version="1.1"',
+                    '  creator="MTKBabel - http://www.rigacci.org/"',
+                    '  xmlns="http://www.topografix.com/GPX/1/1"',
+                    '  xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"',
+                    '  xmlns:mtk="http://www.rigacci.org/gpx/MtkExtensions/v1"',
+                    '  xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd',
+                    '                      http://www.rigacci.org/gpx/MtkExtensions/v1 http://www.rigacci.org/gpx/MtkExtensions/v1/MtkExtensionsv1.xsd">',
+                    '<metadata>',
+                    '  <time>%s</time>' % utc_time(now),
+                    '  <bounds minlat="%.9f" minlon="%.9f" maxlat="%.9f" maxlon="%.9f"/>'
+                            % (bounds.minlat, bounds.minlon, bounds.maxlat, bounds.maxlon),
+                    '</metadata>', '']))
+            for part in parts:
+                part.flush()
+                part.seek(0)
+                shutil.copyfileobj(part, fd, self.buffer_size)
+            fd.write('</gpx>%s' % GPX_EOL)
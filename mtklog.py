@@ -0,0 +1,1081 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Decoding of the log records in an MTK logger flash image.
+
+Which fields a log record holds depends on the log format bitmask in force
+when it was written.  record_decoder() builds a RecordDecoder for each
+bitmask once and caches it, so a record is decoded with one struct
+unpack_from() call (plus one per satellite if the SID bit is set).
+
+scan_segments() splits a flash image into sector headers, record runs,
+separators and non-written space, so records are only decoded where there
+are records.
+
+If NumPy is installed, decode_sector() decodes a whole sector of fixed
+size records (no SID bit) at once, see RecordDecoder.decode_array().
+
+parse_parallel() decodes the sectors of an image file in a pool of
+processes, one sector per task.
+
+LogView gives random access to the records of an image, only decoding the
+records that are looked at.  LogView.between() finds the records in a
+time range by binary search on the UTC times.
+
+StreamParser decodes an image as it arrives in chunks, yielding the
+records of each sector as soon as the whole sector is there.
+
+open_index() keeps the scan results for an image file in an index file
+next to it, keyed by a hash of the image, so an unchanged image is never
+scanned twice.
+"""
+
+import os
+import re
+import mmap
+import array
+import hashlib
+import bisect
+import struct
+import operator
+import itertools
+import functools
+import collections
+import multiprocessing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+LOG_FORMAT_UTC = 0x00000001
+LOG_FORMAT_VALID = 0x00000002
+LOG_FORMAT_LATITUDE = 0x00000004
+LOG_FORMAT_LONGITUDE = 0x00000008
+LOG_FORMAT_HEIGHT = 0x00000010
+LOG_FORMAT_SPEED = 0x00000020
+LOG_FORMAT_HEADING = 0x00000040
+LOG_FORMAT_DSTA = 0x00000080
+LOG_FORMAT_DAGE = 0x00000100
+LOG_FORMAT_PDOP = 0x00000200
+LOG_FORMAT_HDOP = 0x00000400
+LOG_FORMAT_VDOP = 0x00000800
+LOG_FORMAT_NSAT = 0x00001000
+LOG_FORMAT_SID = 0x00002000
+LOG_FORMAT_ELEVATION = 0x00004000
+LOG_FORMAT_AZIMUTH = 0x00008000
+LOG_FORMAT_SNR = 0x00010000
+LOG_FORMAT_RCR = 0x00020000
+LOG_FORMAT_MILLISECOND = 0x00040000
+LOG_FORMAT_DISTANCE = 0x00080000
+
+# (bit, field names, struct format) of the record fields, in the order they
+# are stored.  Satellite data (SID, ELEVATION, AZIMUTH, SNR) sits between
+# NSAT and RCR and is repeated for each satellite in view.
+RecordFields = [
+    (LOG_FORMAT_UTC, ('utc',), 'I'),
+    (LOG_FORMAT_VALID, ('valid',), 'H'),
+    (LOG_FORMAT_LATITUDE, ('latitude',), 'd'),
+    (LOG_FORMAT_LONGITUDE, ('longitude',), 'd'),
+    (LOG_FORMAT_HEIGHT, ('height',), 'f'),
+    (LOG_FORMAT_SPEED, ('speed',), 'f'),
+    (LOG_FORMAT_HEADING, ('heading',), 'f'),
+    (LOG_FORMAT_DSTA, ('dsta',), 'H'),
+    (LOG_FORMAT_DAGE, ('dage',), 'I'),
+    (LOG_FORMAT_PDOP, ('pdop',), 'H'),
+    (LOG_FORMAT_HDOP, ('hdop',), 'H'),
+    (LOG_FORMAT_VDOP, ('vdop',), 'H'),
+    (LOG_FORMAT_NSAT, ('nsat_in_view', 'nsat_in_use'), 'BB'),
+    (LOG_FORMAT_RCR, ('rcr',), 'H'),
+    (LOG_FORMAT_MILLISECOND, ('millisecond',), 'H'),
+    (LOG_FORMAT_DISTANCE, ('distance',), 'd'),
+]
+
+# satellite ID, in use flag and count of satellites in view, always present
+SatelliteHeader = struct.Struct('<BBH')
+
+# optional satellite data, only present if satellites are in view
+SatelliteFields = [
+    (LOG_FORMAT_ELEVATION, ('elevation',), 'h'),
+    (LOG_FORMAT_AZIMUTH, ('azimuth',), 'H'),
+    (LOG_FORMAT_SNR, ('snr',), 'H'),
+]
+
+SIZEOF_SECTOR = 0x10000
+SIZEOF_SECTOR_HEADER = 0x200
+SIZEOF_SEPARATOR = 0x10
+
+SEP_TYPE_CHANGE_LOG_BITMASK = 0x02
+
+NON_WRITTEN = '\xff' * SIZEOF_SEPARATOR
+
+# a record separator is 0xAA * 7, type, argument, 0xBB * 4, or a Holux one
+SeparatorPattern = re.compile(r'\xaa{7}.{5}\xbb{4}|HOLUX.{11}', re.DOTALL)
+
+# a separator changing the log format, the new format is in bytes 8 to 11
+FormatChangePattern = re.compile(r'\xaa{7}\x02.{4}\xbb{4}', re.DOTALL)
+
+SEGMENT_HEADER = 'header'           # sector header
+SEGMENT_RECORDS = 'records'         # run of log records
+SEGMENT_SEPARATOR = 'separator'     # record separator
+SEGMENT_HOLUX = 'holux'             # Holux separator
+SEGMENT_FREE = 'free'               # non-written space
+
+Segment = collections.namedtuple('Segment', 'start end log_format kind sep_type')
+
+# NumPy types of the struct format characters used in RecordFields
+NumpyTypes = {'B': 'u1', 'c': 'S1', 'h': '<i2', 'H': '<u2',
+              'I': '<u4', 'f': '<f4', 'd': '<f8'}
+
+Decoders = {}           # (log format, checksum separator) -> RecordDecoder
+
+WorkerImage = None      # image file mapped by a parse_parallel() worker
+
+# the sector header fields: count, format, status, period, distance, speed
+SectorHeaderFields = struct.Struct('<HIHIII')
+
+SectorSummary = collections.namedtuple('SectorSummary',
+        'count log_format status period distance speed first_record records first_utc last_utc')
+
+UTC_UNKNOWN = 0xffffffff    # sector has no records with a UTC time
+
+SECTOR_COUNT_WRITING = 0xffff   # header record count of the sector being written
+
+# the index file: a header, a SectorSummary per sector, a segment table and
+# the record offsets, all little endian so the file can be used mapped
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = 'MTKIDX01'
+# magic, SHA-1 of image, image size, checksum separator, sector, segment
+# and record counts
+IndexHeader = struct.Struct('<8s20sIB3xIII')
+IndexSector = struct.Struct('<HIHIIIIIII')
+# start, end, log format, kind, separator type, index of first record
+IndexSegment = struct.Struct('<IIIBB2xI')
+IndexOffset = struct.Struct('<I')
+
+# segment kinds by their number in the index file
+SegmentKinds = [SEGMENT_HEADER, SEGMENT_RECORDS, SEGMENT_SEPARATOR, SEGMENT_HOLUX, SEGMENT_FREE]
+
+
+def xor_checksum(buff, start, end):
+    """Return XOR of the bytes buff[start:end].
+
+    'buff' may be a string, bytearray or memoryview.  Bytes are XORed eight
+    at a time straight out of 'buff', then folded.
+    """
+
+    result = 0
+    words = (end - start) // 8
+    if words:
+        result = functools.reduce(operator.xor,
+                                  struct.unpack_from('<%dQ' % words, buff, start))
+        result ^= result >> 32
+        result ^= result >> 16
+        result ^= result >> 8
+        result &= 0xff
+    rest = end - start - words*8
+    if rest:
+        result = functools.reduce(operator.xor,
+                                  struct.unpack_from('%dB' % rest, buff, start + words*8),
+                                  result)
+
+    return result
+
+
+class RecordDecoder(object):
+    """Decoder for the log records of one log format bitmask."""
+
+    def __init__(self, log_format, checksum_separator=True):
+        """Build the decoder.
+
+        log_format          the log format bitmask
+        checksum_separator  True if a '*' comes before the record checksum
+                            (MTK loggers), False if not (Holux loggers)
+
+        Values are decoded as stored, eg the DOP fields are hundredths.
+        """
+
+        self.log_format = log_format
+        self.checksum_separator = checksum_separator
+        self.has_satellites = bool(log_format & LOG_FORMAT_SID)
+
+        head = [(names, fmt) for (bit, names, fmt) in RecordFields
+                if bit & log_format and bit < LOG_FORMAT_SID]
+        tail = [(names, fmt) for (bit, names, fmt) in RecordFields
+                if bit & log_format and bit > LOG_FORMAT_SNR]
+        trailer = 'cB' if checksum_separator else 'B'
+        self.trailer_size = len(trailer)
+
+        names = [name for (field, _) in head for name in field]
+        if self.has_satellites:
+            names.append('satellites')
+        names.extend([name for (field, _) in tail for name in field])
+        self.Record = collections.namedtuple('Record', names)
+        # names of the fields after (sid, in_use, in_view) in each satellite
+        self.Record.satellite_fields = tuple([names[0] for (bit, names, _) in SatelliteFields
+                                              if bit & log_format and self.has_satellites])
+
+        if self.has_satellites:
+            # variable size, decode in pieces around the satellite data
+            self.head = struct.Struct('<' + ''.join([fmt for (_, fmt) in head]))
+            self.tail = struct.Struct('<' + ''.join([fmt for (_, fmt) in tail]) + trailer)
+            self.satellite = struct.Struct('<' + ''.join([fmt for (bit, _, fmt) in SatelliteFields
+                                                          if bit & log_format]))
+            self.size = None
+        else:
+            self.record = struct.Struct('<' + ''.join([fmt for (_, fmt) in head + tail]) + trailer)
+            self.size = self.record.size
+
+        self.dtype = None
+        if numpy is not None and not self.has_satellites:
+            # one column per field, in the same layout as the struct
+            columns = [(name, NumpyTypes[code])
+                       for (field, fmt) in head + tail
+                       for (name, code) in zip(field, fmt)]
+            if checksum_separator:
+                columns.append(('separator', NumpyTypes['c']))
+            columns.append(('checksum', NumpyTypes['B']))
+            self.dtype = numpy.dtype(columns)
+            assert self.dtype.itemsize == self.size
+
+    def decode(self, buff, offset):
+        """Decode the record at 'offset' in 'buff'.
+
+        buff    string, bytearray or memoryview holding the record
+        offset  offset of the record in 'buff'
+
+        Returns a tuple (record, end, valid) where 'record' is a Record
+        named tuple, 'end' the offset just past the record and 'valid' True
+        if the checksum (and separator) are correct.  If the SID bit is set
+        the 'satellites' field is a list of tuples (sid, in_use, in_view,
+        [elevation, azimuth, snr]) holding the fields that were logged.
+        """
+
+        if not self.has_satellites:
+            values = self.record.unpack_from(buff, offset)
+            end = offset + self.size
+        else:
+            values = self.head.unpack_from(buff, offset)
+            end = offset + self.head.size
+            satellites = []
+            while True:
+                # even with no satellites in view there is one header
+                satellite = SatelliteHeader.unpack_from(buff, end)
+                end += SatelliteHeader.size
+                in_view = satellite[2]
+                if in_view:
+                    satellite += self.satellite.unpack_from(buff, end)
+                    end += self.satellite.size
+                    satellites.append(satellite)
+                if len(satellites) >= in_view:
+                    break
+            tail = self.tail.unpack_from(buff, end)
+            end += self.tail.size
+            values = values + (satellites,) + tail
+
+        checksum = values[-1]
+        valid = checksum == xor_checksum(buff, offset, end - self.trailer_size)
+        if self.checksum_separator:
+            valid = valid and values[-2] == '*'
+        return (self.Record._make(values[:-self.trailer_size]), end, valid)
+
+
+    def decode_array(self, buff, offset, count):
+        """Decode 'count' consecutive records starting at 'offset' in 'buff'.
+
+        buff    string, bytearray or memoryview holding the records
+        offset  offset of the first record in 'buff'
+        count   number of records
+
+        Needs NumPy and a log format without the SID bit, ie fixed size
+        records.  The records are viewed in place as a NumPy structured
+        array and checksums are computed column-wise, with no Python loop
+        per record.
+
+        Returns a tuple (records, valid) where 'records' is the structured
+        array, indexed by field name for a column (eg records['latitude'])
+        and 'valid' a boolean array, True where the checksum is correct.
+        """
+
+        if self.dtype is None:
+            raise ValueError('log format 0x%08x needs NumPy and fixed size records'
+                             % self.log_format)
+
+        records = numpy.frombuffer(buff, dtype=self.dtype, count=count, offset=offset)
+        raw = numpy.frombuffer(buff, dtype=numpy.uint8, count=count*self.size, offset=offset)
+        raw = raw.reshape(count, self.size)[:, :self.size-self.trailer_size]
+        valid = numpy.bitwise_xor.reduce(raw, axis=1) == records['checksum']
+        if self.checksum_separator:
+            valid &= records['separator'] == '*'
+        return (records, valid)
+
+
+def find_free(buff, start, end, size=None):
+    """Return offset of the non-written space in buff[start:end].
+
+    size  record size, if given the space must start on a record boundary
+
+    Returns None if there is none.
+    """
+
+    found = buff.find(NON_WRITTEN, start, end)
+    while found >= 0 and size and (found - start) % size:
+        found = buff.find(NON_WRITTEN, found + 1, end)
+    if found < 0:
+        return None
+    return found
+
+
+def header_format(buff, base):
+    """Return the log format in the header of the sector at 'base'.
+
+    Returns None if the header doesn't hold a log format, eg the sector
+    isn't written.
+    """
+
+    (log_format,) = struct.unpack_from('<I', buff, base + 2)
+    if log_format in (0, 0xffffffff):
+        return None
+    return log_format
+
+
+def sector_formats(buff, start=0, end=None):
+    """Find the log format in force at the start of each sector.
+
+    buff   string, bytearray or mmap holding the flash image
+    start  offset of the first sector
+    end    offset to stop at (default: end of 'buff')
+
+    This is the format in the sector header.  If a header has no format
+    the format is carried over from the previous sector, ie its header
+    format or the last format change separator in it.  Only headers and
+    format change separators are looked at, so this is cheap.
+
+    Returns a list of tuples (base, log_format), log_format is None if
+    not known.
+    """
+
+    if end is None:
+        end = len(buff)
+
+    result = []
+    log_format = None
+    for base in range(start, end, SIZEOF_SECTOR):
+        log_format = header_format(buff, base) or log_format
+        result.append((base, log_format))
+        for match in FormatChangePattern.finditer(buff, base, min(base + SIZEOF_SECTOR, end)):
+            (log_format,) = struct.unpack_from('<I', match.group(), 8)
+    return result
+
+
+def scan_sector(buff, base, checksum_separator=True, log_format=None):
+    """Split the log sector at 'base' in 'buff' into segments.
+
+    buff                string, bytearray or mmap holding the flash image
+    base                offset of the sector in 'buff'
+    checksum_separator  as for RecordDecoder
+    log_format          log format at the start of the sector, used if the
+                        header has none (see sector_formats())
+
+    Separators are found with one regular expression search over the
+    sector and the non-written space with find(), so record data is never
+    looked at byte by byte.  The log is written in order, so once
+    non-written space is found the rest of the sector is free.  With fixed
+    size records a separator or free space must be on a record boundary,
+    a match inside record data is ignored.
+
+    Returns a list of Segment tuples in offset order, see scan_segments().
+    """
+
+    end = min(base + SIZEOF_SECTOR, len(buff))
+    if buff[base:base+SIZEOF_SEPARATOR] == NON_WRITTEN:
+        return [Segment(base, end, None, SEGMENT_FREE, None)]
+
+    log_format = header_format(buff, base) or log_format
+    if log_format is None:
+        return [Segment(base, end, None, SEGMENT_FREE, None)]
+    segments = [Segment(base, base + SIZEOF_SECTOR_HEADER, log_format, SEGMENT_HEADER, None)]
+
+    run_start = base + SIZEOF_SECTOR_HEADER
+    for match in itertools.chain(SeparatorPattern.finditer(buff, run_start, end), [None]):
+        run_end = end if match is None else match.start()
+        if run_end < run_start:
+            # in the trailing spaces of a Holux separator
+            continue
+        size = record_decoder(log_format, checksum_separator).size
+        if match is not None and size and (run_end - run_start) % size:
+            # separator pattern in record data
+            continue
+
+        free = find_free(buff, run_start, run_end, size)
+        if free is None and match is None and size:
+            # the sector doesn't hold a whole number of records
+            free = run_end - (run_end - run_start) % size
+            if free == run_end:
+                free = None
+        if free is not None:
+            if free > run_start:
+                segments.append(Segment(run_start, free, log_format, SEGMENT_RECORDS, None))
+            segments.append(Segment(free, end, log_format, SEGMENT_FREE, None))
+            break
+        if run_end > run_start:
+            segments.append(Segment(run_start, run_end, log_format, SEGMENT_RECORDS, None))
+        if match is None:
+            break
+
+        separator = str(match.group())
+        run_start = match.end()
+        if separator.startswith('HOLUX'):
+            # newer Holux firmware adds four spaces
+            if buff[run_start:run_start+4] == '    ':
+                run_start += 4
+            segments.append(Segment(match.start(), run_start, log_format, SEGMENT_HOLUX, None))
+        else:
+            sep_type = ord(separator[7])
+            if sep_type == SEP_TYPE_CHANGE_LOG_BITMASK:
+                (log_format,) = struct.unpack_from('<I', separator, 8)
+            segments.append(Segment(match.start(), run_start, log_format, SEGMENT_SEPARATOR, sep_type))
+
+    return segments
+
+
+def scan_segments(buff, start=0, end=None, checksum_separator=True):
+    """Split the flash image in 'buff' into segments.
+
+    buff                string, bytearray or mmap holding the flash image
+    start               offset of the first sector to scan
+    end                 offset to stop scanning at (default: end of 'buff')
+    checksum_separator  as for RecordDecoder
+
+    Returns a list of Segment tuples (start, end, log_format, kind,
+    sep_type) in offset order.  'kind' is one of SEGMENT_HEADER,
+    SEGMENT_RECORDS, SEGMENT_SEPARATOR, SEGMENT_HOLUX or SEGMENT_FREE,
+    'log_format' is the log format in force and 'sep_type' the separator
+    type for a SEGMENT_SEPARATOR, None otherwise.
+    """
+
+    if end is None:
+        end = len(buff)
+
+    segments = []
+    log_format = None
+    for base in range(start, end, SIZEOF_SECTOR):
+        segments.extend(scan_sector(buff, base, checksum_separator, log_format))
+        log_format = segments[-1].log_format
+    return segments
+
+
+def sector_records(buff, base, checksum_separator=True, log_format=None):
+    """Decode the records of the log sector at 'base' in 'buff'.
+
+    Arguments are as for scan_sector().
+
+    Returns a list of tuples (log_format, record, valid), see
+    RecordDecoder.decode().
+    """
+
+    result = []
+    for segment in scan_sector(buff, base, checksum_separator, log_format):
+        if segment.kind != SEGMENT_RECORDS:
+            continue
+        decoder = record_decoder(segment.log_format, checksum_separator)
+        offset = segment.start
+        while offset < segment.end:
+            (record, offset, valid) = decoder.decode(buff, offset)
+            result.append((segment.log_format, record, valid))
+    return result
+
+
+class StreamParser(object):
+    """Scan and decode the records of a flash image arriving in chunks.
+
+    Chunks may arrive in any order and may overlap.  They are put in place
+    in one buffer and the bytes received are counted per sector, in units
+    of SIZEOF_SEPARATOR (every chunk starts and ends on such a boundary).
+    When every sector up to and including a sector is complete it is
+    scanned, in flash order, carrying the log format from one sector to
+    the next as scan_segments() does.  Sectors never completed, eg the
+    sector being written, are scanned by finish().
+
+    add() and rest() hand on the segments of each sector scanned, with
+    the separators and free space, feed() and finish() just the records.
+    """
+
+    def __init__(self, checksum_separator=True):
+        """checksum_separator  as for RecordDecoder"""
+
+        self.checksum_separator = checksum_separator
+        self.buffer = bytearray()   # image so far, non-written where not received
+        self.received = bytearray() # one byte per SIZEOF_SEPARATOR, 1 if received
+        self.next_sector = 0        # offset of the next sector to scan
+        self.log_format = None      # log format at the end of the last sector scanned
+
+    def add(self, offset, data):
+        """Add the chunk 'data' received from flash offset 'offset'.
+
+        Returns a list of tuples (base, segments) for the sectors completed,
+        'segments' as returned by scan_sector().
+        """
+
+        end = offset + len(data)
+        if end > len(self.buffer):
+            size = end + (-end % SIZEOF_SECTOR)
+            self.buffer.extend('\xff' * (size - len(self.buffer)))
+            self.received.extend('\x00' * (size // SIZEOF_SEPARATOR - len(self.received)))
+        self.buffer[offset:end] = data
+        first = offset // SIZEOF_SEPARATOR
+        last = (end + SIZEOF_SEPARATOR - 1) // SIZEOF_SEPARATOR
+        self.received[first:last] = '\x01' * (last - first)
+
+        result = []
+        units = SIZEOF_SECTOR // SIZEOF_SEPARATOR
+        while self.next_sector < len(self.buffer):
+            unit = self.next_sector // SIZEOF_SEPARATOR
+            if self.received.find('\x00', unit, unit + units) >= 0:
+                break
+            result.append(self.scan_next())
+        return result
+
+    def rest(self):
+        """Scan the sectors not yet completed, return as for add()."""
+
+        result = []
+        while self.next_sector < len(self.buffer):
+            result.append(self.scan_next())
+        return result
+
+    def feed(self, offset, data):
+        """Add a chunk as add(), return a list of tuples (record, valid)
+        for the sectors completed."""
+
+        return self.decode(self.add(offset, data))
+
+    def finish(self):
+        """Decode the sectors not yet completed and return their records."""
+
+        return self.decode(self.rest())
+
+    def scan_next(self):
+        """Scan the next sector, return a tuple (base, segments)."""
+
+        base = self.next_sector
+        segments = scan_sector(self.buffer, base, self.checksum_separator, self.log_format)
+        self.log_format = segments[-1].log_format
+        self.next_sector += SIZEOF_SECTOR
+        return (base, segments)
+
+    def decode(self, sectors):
+        """Decode the records of 'sectors', return list of tuples (record, valid)."""
+
+        result = []
+        for (_, segments) in sectors:
+            for segment in segments:
+                if segment.kind != SEGMENT_RECORDS:
+                    continue
+                decoder = record_decoder(segment.log_format, self.checksum_separator)
+                offset = segment.start
+                while offset < segment.end:
+                    (record, offset, valid) = decoder.decode(self.buffer, offset)
+                    result.append((record, valid))
+        return result
+
+
+def stream_records(chunks, checksum_separator=True):
+    """Yield (record, valid) tuples as the chunks of an image arrive.
+
+    chunks              iterable of (offset, data) chunks of the image,
+                        eg from a queue being filled by a download
+    checksum_separator  as for RecordDecoder
+
+    See StreamParser.
+    """
+
+    parser = StreamParser(checksum_separator)
+    for (offset, data) in chunks:
+        for result in parser.feed(offset, data):
+            yield result
+    for result in parser.finish():
+        yield result
+
+
+def stream_sectors(chunks, checksum_separator=True):
+    """Yield (buff, base, segments) tuples as the chunks of an image arrive.
+
+    chunks              iterable of (offset, data) chunks of the image
+    checksum_separator  as for RecordDecoder
+
+    'segments' are those of the sector at 'base' in 'buff', the image so
+    far, as returned by scan_sector().  'buff' grows as chunks arrive, so
+    the segments must be used before the next tuple is taken.  See
+    StreamParser.
+    """
+
+    parser = StreamParser(checksum_separator)
+    for (offset, data) in chunks:
+        for (base, segments) in parser.add(offset, data):
+            yield (parser.buffer, base, segments)
+    for (base, segments) in parser.rest():
+        yield (parser.buffer, base, segments)
+
+
+def init_worker(path):
+    """Map the image file 'path' in a parse_parallel() worker process."""
+
+    global WorkerImage
+    with open(path, 'rb') as fd:
+        WorkerImage = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def worker_sector_records(task):
+    """Decode one sector in a parse_parallel() worker process.
+
+    task  tuple (base, log_format, checksum_separator)
+
+    Records are returned as plain tuples, the Record classes are made on
+    the fly and can't be pickled.
+    """
+
+    (base, log_format, checksum_separator) = task
+    return [(log_format, tuple(record), valid)
+            for (log_format, record, valid)
+            in sector_records(WorkerImage, base, checksum_separator, log_format)]
+
+
+def parse_parallel(path, processes=None, checksum_separator=True):
+    """Decode all the records of the flash image file 'path' in parallel.
+
+    path                path of the image file
+    processes           number of worker processes (default: one per CPU)
+    checksum_separator  as for RecordDecoder
+
+    Sectors are independent once the log format at each sector start is
+    known, so a pre-pass finds it with sector_formats() and the sectors
+    are then decoded in a multiprocessing.Pool.  Each worker maps the file
+    itself, so the image isn't copied to the workers.
+
+    Returns a list of tuples (record, valid) in flash order.
+    """
+
+    if os.path.getsize(path) == 0:
+        return []
+
+    with open(path, 'rb') as fd:
+        image = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        tasks = [(base, log_format, checksum_separator)
+                 for (base, log_format) in sector_formats(image)]
+    finally:
+        image.close()
+
+    pool = multiprocessing.Pool(processes, init_worker, (path,))
+    try:
+        sectors = pool.map(worker_sector_records, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    result = []
+    for sector in sectors:
+        for (log_format, values, valid) in sector:
+            result.append((record_decoder(log_format, checksum_separator).Record._make(values), valid))
+    return result
+
+
+def decode_sector(buff, base, checksum_separator=True):
+    """Decode the log sector at 'base' in 'buff' with NumPy.
+
+    buff                string, bytearray or mmap holding the flash image
+    base                offset of the sector in 'buff'
+    checksum_separator  as for RecordDecoder
+
+    The records between separators all have the same size, so each run of
+    records found by scan_sector() is decoded with
+    RecordDecoder.decode_array().
+
+    Returns a list of tuples (offset, log_format, records, valid), one per
+    run of records, see RecordDecoder.decode_array().  Raises ValueError if
+    a run has a log format with the SID bit.
+    """
+
+    runs = []
+    for segment in scan_sector(buff, base, checksum_separator):
+        if segment.kind != SEGMENT_RECORDS:
+            continue
+        decoder = record_decoder(segment.log_format, checksum_separator)
+        if decoder.size is None:
+            raise ValueError('log format 0x%08x has variable size records' % segment.log_format)
+        count = (segment.end - segment.start) // decoder.size
+        (records, valid) = decoder.decode_array(buff, segment.start, count)
+        runs.append((segment.start, segment.log_format, records, valid))
+
+    return runs
+
+
+class LogView(object):
+    """Lazy, random access view of the log records in a flash image.
+
+    The view indexes the records on first use: the image is split with
+    scan_segments() and the offset of each record noted.  Records are
+    only decoded when they are accessed, eg view[-1] decodes just the last
+    record.  The view supports len(), indexing, slicing and iteration.
+    """
+
+    def __init__(self, buff, checksum_separator=True, index=None):
+        """Make a view of the image in 'buff'.
+
+        buff                string, bytearray or mmap holding the image
+        checksum_separator  as for RecordDecoder
+        index               ImageIndex of the image, if given the image
+                            isn't scanned (see open_index())
+        """
+
+        self.buff = buff
+        self.checksum_separator = checksum_separator
+        self.index = index
+        self.segments = None    # list of Segment tuples
+        self.offsets = None     # array of record offsets, in flash order
+        self.run_starts = None  # index of first record of each run
+        self.run_decoders = None    # RecordDecoder of each run
+
+    def build_index(self):
+        """Build the record offset index, if not already built."""
+
+        if self.offsets is not None:
+            return
+
+        if self.index is not None:
+            self.segments = self.index.segments()
+            runs = self.index.runs()
+            self.run_starts = [first for (first, log_format) in runs]
+            self.run_decoders = [record_decoder(log_format, self.checksum_separator)
+                                 for (first, log_format) in runs]
+            self.offsets = self.index.offsets
+            return
+
+        offsets = array.array('L')
+        self.segments = scan_segments(self.buff, checksum_separator=self.checksum_separator)
+        self.run_starts = []
+        self.run_decoders = []
+        for segment in self.segments:
+            if segment.kind != SEGMENT_RECORDS:
+                continue
+            decoder = record_decoder(segment.log_format, self.checksum_separator)
+            self.run_starts.append(len(offsets))
+            self.run_decoders.append(decoder)
+            if decoder.size is not None:
+                # fixed size records, no need to look at them
+                offsets.extend(xrange(segment.start, segment.end, decoder.size))
+            else:
+                offset = segment.start
+                while offset < segment.end:
+                    offsets.append(offset)
+                    (_, offset, _) = decoder.decode(self.buff, offset)
+        self.offsets = offsets
+
+    def __len__(self):
+        self.build_index()
+        return len(self.offsets)
+
+    def decode(self, index):
+        """Decode record number 'index'.
+
+        Returns a tuple (record, valid), see RecordDecoder.decode().
+        """
+
+        self.build_index()
+        if index < 0:
+            index += len(self.offsets)
+        if not 0 <= index < len(self.offsets):
+            raise IndexError('LogView index out of range')
+        decoder = self.run_decoders[bisect.bisect_right(self.run_starts, index) - 1]
+        (record, _, valid) = decoder.decode(self.buff, self.offsets[index])
+        return (record, valid)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.decode(i)[0] for i in xrange(*index.indices(len(self)))]
+        return self.decode(index)[0]
+
+    def sectors(self):
+        """Return a list of SectorSummary tuples, one per sector.
+
+        Only the first and last record of each sector are decoded.
+        """
+
+        if self.index is not None:
+            return self.index.sectors()
+
+        self.build_index()
+        result = []
+        for base in range(0, len(self.buff), SIZEOF_SECTOR):
+            header = SectorHeaderFields.unpack_from(self.buff, base)
+            first = bisect.bisect_left(self.offsets, base)
+            last = bisect.bisect_left(self.offsets, base + SIZEOF_SECTOR)
+            if last > first:
+                utcs = (getattr(self[first], 'utc', UTC_UNKNOWN),
+                        getattr(self[last - 1], 'utc', UTC_UNKNOWN))
+            else:
+                utcs = (UTC_UNKNOWN, UTC_UNKNOWN)
+            result.append(SectorSummary._make(header + (first, last - first) + utcs))
+        return result
+
+    def utc(self, index):
+        """Return the UTC time of record number 'index'."""
+
+        return getattr(self[index], 'utc', UTC_UNKNOWN)
+
+    def valid_utc(self, index, end):
+        """Return the UTC time of the first valid record with a UTC time
+        from number 'index' up to 'end', None if there is none."""
+
+        for index in range(index, end):
+            (record, valid) = self.decode(index)
+            utc = getattr(record, 'utc', None)
+            if valid and utc is not None:
+                return utc
+        return None
+
+    def window(self, utc_from=None):
+        """Return the sectors holding records from 'utc_from' on.
+
+        utc_from  earliest UTC time (seconds since the epoch), None means
+                  from the start of the log
+
+        Records are written in time order, so within a sector and from
+        sector to sector the UTC times increase.  In OVERLAP mode the log
+        is a ring and wraps to the first sector when the flash is full, so
+        the sector holding the oldest record is found first and the sectors
+        are taken in ring order from there.  The sector holding utc_from is
+        then found by a binary search on the last UTC of each sector.
+
+        Sectors without records with a UTC time are left out.  Returns a
+        list of tuples (base, SectorSummary) in time order.
+        """
+
+        sectors = [(number * SIZEOF_SECTOR, sector)
+                   for (number, sector) in enumerate(self.sectors())
+                   if sector.records and sector.first_utc != UTC_UNKNOWN]
+        if not sectors:
+            return []
+
+        # start the ring at the oldest sector
+        oldest = min(range(len(sectors)), key=lambda i: sectors[i][1].first_utc)
+        sectors = sectors[oldest:] + sectors[:oldest]
+
+        start = 0
+        if utc_from is not None:
+            start = bisect.bisect_left([sector.last_utc for (_, sector) in sectors], utc_from)
+        return sectors[start:]
+
+    def between(self, utc_from=None, utc_to=None):
+        """Yield the valid records with utc_from <= UTC <= utc_to.
+
+        utc_from  earliest UTC time (seconds since the epoch), None means
+                  from the start of the log
+        utc_to    latest UTC time, None means to the end of the log
+
+        The sectors are taken in time order from the one holding utc_from
+        (see window()) and the first record is found by a binary search in
+        that sector, so only the records in the range (and a few probes)
+        are decoded.  Records with bad checksums are skipped, so a garbled
+        UTC time neither ends the range nor misleads the search.
+
+        Records without a UTC field are never yielded.
+        """
+
+        for (number, (_, sector)) in enumerate(self.window(utc_from)):
+            lo = sector.first_record
+            end = hi = sector.first_record + sector.records
+            if number == 0 and utc_from is not None:
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    utc = self.valid_utc(mid, hi)
+                    if utc is not None and utc < utc_from:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+            for index in range(lo, end):
+                (record, valid) = self.decode(index)
+                utc = getattr(record, 'utc', None)
+                if not valid or utc is None:
+                    continue
+                if utc_to is not None and utc > utc_to:
+                    return
+                if utc_from is None or utc >= utc_from:
+                    yield record
+
+    def __iter__(self):
+        self.build_index()
+        run = 0
+        for (index, offset) in enumerate(self.offsets):
+            while run + 1 < len(self.run_starts) and self.run_starts[run + 1] <= index:
+                run += 1
+            yield self.run_decoders[run].decode(self.buff, offset)[0]
+
+
+class IndexTable(object):
+    """Read only sequence of 'count' unsigned ints at 'offset' in 'buff'.
+
+    The values are unpacked when looked at, so a mapped index file isn't
+    read into memory.
+    """
+
+    def __init__(self, buff, offset, count):
+        self.buff = buff
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('IndexTable index out of range')
+        return IndexOffset.unpack_from(self.buff, self.offset + index * IndexOffset.size)[0]
+
+
+class ImageIndex(object):
+    """The index of a flash image, see build_index()."""
+
+    def __init__(self, buff):
+        """Use the index in 'buff', a string or mmap.
+
+        Raises ValueError if 'buff' doesn't hold an index.
+        """
+
+        if len(buff) < IndexHeader.size:
+            raise ValueError('index is truncated')
+        (magic, self.digest, self.image_size, checksum_separator, self.sector_count,
+                self.segment_count, self.record_count) = IndexHeader.unpack_from(buff, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError('not an image index')
+        self.checksum_separator = bool(checksum_separator)
+
+        self.buff = buff
+        self.sector_offset = IndexHeader.size
+        self.segment_offset = self.sector_offset + self.sector_count * IndexSector.size
+        offsets_offset = self.segment_offset + self.segment_count * IndexSegment.size
+        if len(buff) != offsets_offset + self.record_count * IndexOffset.size:
+            raise ValueError('index is truncated')
+        self.offsets = IndexTable(buff, offsets_offset, self.record_count)
+
+    def matches(self, digest, image_size, checksum_separator):
+        """Return True if this is the index of the given image."""
+
+        return (self.digest == digest and self.image_size == image_size
+                and self.checksum_separator == bool(checksum_separator))
+
+    def sectors(self):
+        """Return a list of SectorSummary tuples, one per sector."""
+
+        return [SectorSummary._make(IndexSector.unpack_from(self.buff, offset))
+                for offset in range(self.sector_offset, self.segment_offset, IndexSector.size)]
+
+    def segment_table(self):
+        """Yield (start, end, log_format, kind, sep_type, first_record) tuples."""
+
+        for i in range(self.segment_count):
+            (start, end, log_format, kind, sep_type, first_record) = \
+                    IndexSegment.unpack_from(self.buff, self.segment_offset + i * IndexSegment.size)
+            yield (start, end, log_format or None, SegmentKinds[kind], sep_type or None, first_record)
+
+    def segments(self):
+        """Return the list of Segment tuples, as from scan_segments()."""
+
+        return [Segment(*entry[:5]) for entry in self.segment_table()]
+
+    def runs(self):
+        """Return a list of (first_record, log_format) for each record run."""
+
+        return [(entry[5], entry[2]) for entry in self.segment_table()
+                if entry[3] == SEGMENT_RECORDS]
+
+
+def image_digest(buff):
+    """Return the SHA-1 digest of the image in 'buff' (string or mmap)."""
+
+    return hashlib.sha1(buff).digest()
+
+
+def build_index(buff, checksum_separator=True, digest=None):
+    """Scan the image in 'buff' and return its index as a string.
+
+    buff                string, bytearray or mmap holding the image
+    checksum_separator  as for RecordDecoder
+    digest              image_digest() of 'buff', if already known
+
+    The index holds a SectorSummary for each sector (the header fields,
+    the records in the sector and the UTC of the first and last of them),
+    the segments found by scan_segments() and the offset of every record.
+    """
+
+    if digest is None:
+        digest = image_digest(buff)
+    view = LogView(buff, checksum_separator)
+    view.build_index()
+    offsets = view.offsets
+
+    sectors = [IndexSector.pack(*sector) for sector in view.sectors()]
+
+    segments = []
+    for segment in view.segments:
+        first = bisect.bisect_left(offsets, segment.start)
+        segments.append(IndexSegment.pack(segment.start, segment.end, segment.log_format or 0,
+                                          SegmentKinds.index(segment.kind),
+                                          segment.sep_type or 0, first))
+
+    header = IndexHeader.pack(INDEX_MAGIC, digest, len(buff), checksum_separator,
+                              len(sectors), len(segments), len(offsets))
+    return (header + ''.join(sectors) + ''.join(segments)
+            + struct.pack('<%dI' % len(offsets), *offsets))
+
+
+def open_index(path, buff=None, checksum_separator=True):
+    """Return the ImageIndex of the image file 'path'.
+
+    path                path of the image file
+    buff                the image, if already read or mapped
+    checksum_separator  as for RecordDecoder
+
+    The index is kept in the file 'path' + INDEX_SUFFIX, mapped read only.
+    If there is no index file or it is for other image contents it is
+    built and written.  If the index file can't be written the index is
+    only kept in memory.
+    """
+
+    if buff is None:
+        with open(path, 'rb') as fd:
+            buff = fd.read()
+    digest = image_digest(buff)
+    index_path = path + INDEX_SUFFIX
+
+    try:
+        with open(index_path, 'rb') as fd:
+            index = ImageIndex(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+        if index.matches(digest, len(buff), checksum_separator):
+            return index
+    except (IOError, OSError, ValueError, mmap.error):
+        pass
+
+    data = build_index(buff, checksum_separator, digest)
+    try:
+        with open(index_path + '.tmp', 'wb') as fd:
+            fd.write(data)
+        os.rename(index_path + '.tmp', index_path)
+    except (IOError, OSError):
+        pass
+    return ImageIndex(data)
+
+
+def record_decoder(log_format, checksum_separator=True):
+    """Return the RecordDecoder for 'log_format', building it only once."""
+
+    key = (log_format, checksum_separator)
+    decoder = Decoders.get(key)
+    if decoder is None:
+        decoder = Decoders[key] = RecordDecoder(log_format, checksum_separator)
+    return decoder
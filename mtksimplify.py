@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Track simplification for KML output.
+
+simplify() drops the points of a track that lie within a tolerance (in
+metres) of the line through the points kept, by the Douglas-Peucker
+algorithm.  The ranges still to look at are kept on a list instead of
+recursing, so there is no recursion limit however long the track is.
+Each range costs one pass over its points and GPS tracks split into
+ranges of similar size, so a track is simplified in about n log n time.
+
+If NumPy is installed the distances over a range are computed as arrays,
+else in plain Python.
+
+Latitude and longitude are projected to metres on a plane through the
+middle latitude of the track, which is close enough for tracks of a few
+hundred kilometres.
+"""
+
+import math
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+EarthRadius = 6371000.0     # metres, mean radius
+
+MetresPerDegree = EarthRadius * math.pi / 180.0
+
+# ranges shorter than this are done in plain Python, even with NumPy
+MinNumpyRange = 64
+
+
+def project(latitudes, longitudes):
+    """Return the points as (x, y) arrays in metres."""
+
+    middle = (min(latitudes) + max(latitudes)) / 2.0
+    scale_x = MetresPerDegree * math.cos(math.radians(middle))
+    xs = array.array('d', [longitude * scale_x for longitude in longitudes])
+    ys = array.array('d', [latitude * MetresPerDegree for latitude in latitudes])
+    return (xs, ys)
+
+
+def farthest(xs, ys, first, last):
+    """Return (index, squared distance) of the point between 'first' and
+    'last' farthest from the segment joining them."""
+
+    (x1, y1) = (xs[first], ys[first])
+    dx = xs[last] - x1
+    dy = ys[last] - y1
+    length2 = dx * dx + dy * dy
+    best = first
+    best_distance2 = -1.0
+    for i in xrange(first + 1, last):
+        px = xs[i] - x1
+        py = ys[i] - y1
+        if length2 > 0.0:
+            t = (px * dx + py * dy) / length2
+            if t < 0.0:
+                t = 0.0
+            elif t > 1.0:
+                t = 1.0
+            px -= t * dx
+            py -= t * dy
+        distance2 = px * px + py * py
+        if distance2 > best_distance2:
+            best = i
+            best_distance2 = distance2
+    return (best, best_distance2)
+
+
+def farthest_numpy(xs, ys, first, last):
+    """farthest() with NumPy arrays 'xs' and 'ys'."""
+
+    (x1, y1) = (xs[first], ys[first])
+    dx = xs[last] - x1
+    dy = ys[last] - y1
+    length2 = dx * dx + dy * dy
+    px = xs[first+1:last] - x1
+    py = ys[first+1:last] - y1
+    if length2 > 0.0:
+        t = numpy.clip((px * dx + py * dy) / length2, 0.0, 1.0)
+        px -= t * dx
+        py -= t * dy
+    distance2 = px * px + py * py
+    i = int(distance2.argmax())
+    return (first + 1 + i, float(distance2[i]))
+
+
+def simplify(latitudes, longitudes, tolerance):
+    """Simplify a track.
+
+    latitudes   sequence of the latitudes of the points, in degrees
+    longitudes  sequence of the longitudes of the points, in degrees
+    tolerance   largest distance in metres a dropped point may be from
+                the simplified track
+
+    The first and last points are always kept.  Returns the list of the
+    indexes of the points kept, in order.
+    """
+
+    count = len(latitudes)
+    if count < 3 or tolerance <= 0:
+        return range(count)
+
+    (xs, ys) = project(latitudes, longitudes)
+    if numpy is not None:
+        (np_xs, np_ys) = (numpy.frombuffer(xs), numpy.frombuffer(ys))
+    tolerance2 = float(tolerance) * tolerance
+
+    keep = bytearray(count)
+    keep[0] = keep[-1] = 1
+    ranges = [(0, count - 1)]
+    while ranges:
+        (first, last) = ranges.pop()
+        if last - first < 2:
+            continue
+        if numpy is not None and last - first >= MinNumpyRange:
+            (i, distance2) = farthest_numpy(np_xs, np_ys, first, last)
+        else:
+            (i, distance2) = farthest(xs, ys, first, last)
+        if distance2 > tolerance2:
+            keep[i] = 1
+            ranges.append((i, last))
+            ranges.append((first, i))
+
+    return [i for i in xrange(count) if keep[i]]
@@ -0,0 +1,553 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Outputs fed with decoded log records, all in one pass over the log.
+
+A sink has the methods:
+    record(record)   a valid decoded record, in log order
+    track_break()    the log has a separator or non-written space here
+    next_waypoint()  a Holux waypoint separator, the next record is a waypoint
+    close()          the log is done, finish the output
+
+TrackSink sorts records into tracks and waypoints the way mtkbabel.pl
+does, the GPX and KML writers are built on it.  Fanout passes every call
+on to any number of sinks, so one download and one parse of the log can
+write a BIN dump, GPX, KML and CSV files at the same time, each record
+decoded once.  write_log() feeds a sink from a flash image, splitting
+tracks as mtkbabel.pl does, write_log_parallel() does the same for an
+image file in worker processes, write_stream() does the same from an
+image still being downloaded, TimeWindow keeps only the records in a time
+range and Simplifier thins out the tracks on the way to a sink.
+"""
+
+import os
+import csv
+import mmap
+import time
+import itertools
+import multiprocessing
+
+import mtklog
+import mtksimplify
+
+
+VALID_NOFIX = 0x0001        # VALID field, no fix
+RCR_BUTTON = 0x08           # RCR field, record made with the button
+
+BufferSize = 1024 * 1024    # write buffer size of each output file
+
+# images smaller than this are parsed serially by write_log_parallel(),
+# starting the worker processes would take longer than the parse
+ParallelMinSize = 1024 * 1024
+
+# the time up to the minute of the last utc_time(), as [minute, prefix]
+MinutePrefix = [None, None]
+
+# CSV columns, all the record fields except the satellite data
+CsvColumns = ['time', 'valid', 'latitude', 'longitude', 'height', 'speed',
+              'heading', 'dsta', 'dage', 'pdop', 'hdop', 'vdop',
+              'nsat_in_view', 'nsat_in_use', 'rcr', 'millisecond', 'distance']
+
+
+def utc_time(utc):
+    """Return the UTC time 'utc' (seconds since the epoch) as a GPX time.
+
+    Records come in time order, so the time up to the minute is kept from
+    the last call and usually only the seconds are formatted.
+    """
+
+    (minute, second) = divmod(utc, 60)
+    if minute != MinutePrefix[0]:
+        MinutePrefix[:] = [minute, time.strftime('%Y-%m-%dT%H:%M:', time.gmtime(utc))]
+    return '%s%02dZ' % (MinutePrefix[1], second)
+
+
+def sector_segments(segments):
+    """Group 'segments' (in offset order) by sector.
+
+    Yields tuples (base, segments of the sector at 'base').
+    """
+
+    for (number, group) in itertools.groupby(segments, lambda segment: segment.start // mtklog.SIZEOF_SECTOR):
+        yield (number * mtklog.SIZEOF_SECTOR, list(group))
+
+
+def write_sector(buff, base, segments, sink, checksum_separator=True):
+    """Feed the log in one sector of a flash image to 'sink'.
+
+    buff                string, bytearray or mmap holding the flash image
+    base                offset of the sector in 'buff'
+    segments            the segments of the sector, see mtklog.scan_sector()
+    sink                the sink, see above
+    checksum_separator  as for mtklog.RecordDecoder
+
+    This follows the parse loop of mtkbabel.pl: only as many records as
+    the sector header counts are read and the rest of the sector is
+    skipped, separators end a track and non-written space ends a track
+    only in the sector being written (header count SECTOR_COUNT_WRITING),
+    as the space after the last record of a full sector is just padding.
+    A sector without a header ends a track.
+
+    Returns a tuple (valid, invalid), the number of records with good and
+    bad checksums.
+    """
+
+    if not segments or segments[0].kind != mtklog.SEGMENT_HEADER:
+        sink.track_break()
+        return (0, 0)
+    expected = mtklog.SectorHeaderFields.unpack_from(buff, base)[0]
+    writing = (expected == mtklog.SECTOR_COUNT_WRITING)
+    count = 0
+    valid_count = 0
+    for segment in segments[1:]:
+        if count >= expected:
+            break
+        if segment.kind == mtklog.SEGMENT_SEPARATOR:
+            sink.track_break()
+        elif segment.kind == mtklog.SEGMENT_FREE:
+            if writing:
+                sink.track_break()
+        elif segment.kind == mtklog.SEGMENT_HOLUX:
+            if buff[segment.start+10:segment.start+16] == 'WAYPNT':
+                sink.next_waypoint()
+        elif segment.kind == mtklog.SEGMENT_RECORDS:
+            decoder = mtklog.record_decoder(segment.log_format, checksum_separator)
+            offset = segment.start
+            while offset < segment.end and count < expected:
+                (record, offset, valid) = decoder.decode(buff, offset)
+                count += 1
+                if valid:
+                    valid_count += 1
+                    sink.record(record)
+    return (valid_count, count - valid_count)
+
+
+def write_log(buff, sink, index=None, checksum_separator=True, segments=None,
+              utc_from=None, utc_to=None):
+    """Feed the log in a flash image to 'sink'.
+
+    buff                string, bytearray or mmap holding the flash image
+    sink                the sink, see above
+    index               mtklog.ImageIndex of 'buff', if known
+    checksum_separator  as for mtklog.RecordDecoder
+    segments            the segments of 'buff', if already scanned
+    utc_from            if given, only pass on records from this UTC time on
+    utc_to              if given, only pass on records up to this UTC time
+
+    The image is split into segments by mtklog.scan_segments() (unless
+    they are given or taken from 'index') and each sector is fed to the
+    sink with write_sector().  Records are decoded where they lie in
+    'buff' and handed on one at a time.  The sink isn't closed.
+
+    With a time range only the sectors mtklog.LogView.window() finds for
+    it are walked, in time order, and the records go through a TimeWindow.
+    Separators are still passed on, so tracks are split the same way with
+    or without a time range.
+
+    Returns a tuple (valid, invalid), the number of records with good
+    checksums passed on and the number with bad checksums.
+    """
+
+    if utc_from is None and utc_to is None:
+        if segments is None and index is not None:
+            segments = index.segments()
+        elif segments is None:
+            segments = mtklog.scan_segments(buff, checksum_separator=checksum_separator)
+        sectors = sector_segments(segments)
+    else:
+        view = mtklog.LogView(buff, checksum_separator, index)
+        window = view.window(utc_from)
+        view.build_index()
+        by_base = dict(sector_segments(view.segments))
+        sectors = [(base, by_base[base]) for (base, summary) in window
+                   if utc_to is None or summary.first_utc <= utc_to]
+        sink = TimeWindow(sink, utc_from, utc_to)
+
+    valid = invalid = 0
+    for (base, sector) in sectors:
+        (good, bad) = write_sector(buff, base, sector, sink, checksum_separator)
+        valid += good
+        invalid += bad
+    if isinstance(sink, TimeWindow):
+        valid = sink.records
+    return (valid, invalid)
+
+
+class EventSink(object):
+    """Sink keeping the calls made to it as a list of events.
+
+    A record is kept as (log_format, values), a track break as None and a
+    Holux waypoint separator as WAYPOINT_EVENT, so the events can be
+    pickled and sent back from a worker process by worker_write_sector().
+    """
+
+    WAYPOINT_EVENT = ()
+
+    def __init__(self, formats):
+        """formats  dict mapping each Record class to its log format"""
+
+        self.formats = formats
+        self.events = []
+
+    def record(self, record):
+        self.events.append((self.formats[type(record)], tuple(record)))
+
+    def track_break(self):
+        self.events.append(None)
+
+    def next_waypoint(self):
+        self.events.append(self.WAYPOINT_EVENT)
+
+    def close(self):
+        pass
+
+
+def worker_write_sector(task):
+    """Run write_sector() on one sector in a write_log_parallel() worker.
+
+    task  tuple (base, log_format, checksum_separator)
+
+    Returns a tuple (events, valid, invalid), 'events' as kept by
+    EventSink.
+    """
+
+    (base, log_format, checksum_separator) = task
+    segments = mtklog.scan_sector(mtklog.WorkerImage, base, checksum_separator, log_format)
+    formats = dict([(mtklog.record_decoder(segment.log_format, checksum_separator).Record,
+                     segment.log_format)
+                    for segment in segments if segment.kind == mtklog.SEGMENT_RECORDS])
+    sink = EventSink(formats)
+    (valid, invalid) = write_sector(mtklog.WorkerImage, base, segments, sink, checksum_separator)
+    return (sink.events, valid, invalid)
+
+
+def write_log_parallel(path, sink, processes=None, checksum_separator=True):
+    """Feed the log in flash image file 'path' to 'sink', decoding in parallel.
+
+    path                path of the image file
+    sink                the sink, see above
+    processes           number of worker processes (default: one per CPU)
+    checksum_separator  as for mtklog.RecordDecoder
+
+    As for mtklog.parse_parallel(), a pre-pass finds the log format at
+    the start of each sector and each worker maps the file itself.  Each
+    sector is fed to an EventSink by write_sector() in a worker and the
+    events are played to 'sink' in flash order, so tracks are split as by
+    write_log().  An image smaller than ParallelMinSize, or with only one
+    process, is parsed with write_log() instead.  The sink isn't closed.
+
+    Returns a tuple (valid, invalid) as for write_log().
+    """
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            return (0, 0)
+        image = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if len(image) < ParallelMinSize or processes < 2:
+            return write_log(image, sink, checksum_separator=checksum_separator)
+        tasks = [(base, log_format, checksum_separator)
+                 for (base, log_format) in mtklog.sector_formats(image)]
+    finally:
+        image.close()
+
+    pool = multiprocessing.Pool(processes, mtklog.init_worker, (path,))
+    try:
+        sectors = pool.imap(worker_write_sector, tasks)
+        valid = invalid = 0
+        for (events, good, bad) in sectors:
+            for event in events:
+                if event is None:
+                    sink.track_break()
+                elif event == EventSink.WAYPOINT_EVENT:
+                    sink.next_waypoint()
+                else:
+                    (log_format, values) = event
+                    sink.record(mtklog.record_decoder(log_format, checksum_separator).Record._make(values))
+            valid += good
+            invalid += bad
+    finally:
+        pool.close()
+        pool.join()
+    return (valid, invalid)
+
+
+def write_stream(chunks, sink, checksum_separator=True, utc_from=None, utc_to=None):
+    """Feed the log in a flash image arriving in chunks to 'sink'.
+
+    chunks              iterable of (offset, data) chunks of the image, eg
+                        from BTQ1300ST.stream_chunks()
+    sink                the sink, see above
+    checksum_separator  as for mtklog.RecordDecoder
+    utc_from            if given, only pass on records from this UTC time on
+    utc_to              if given, only pass on records up to this UTC time
+
+    Each sector is fed to the sink with write_sector() as soon as it and
+    every sector before it have arrived (see mtklog.stream_sectors()), so
+    tracks are split as by write_log() and can be written out while the
+    download goes on.  With a time range the records go through a
+    TimeWindow.  The sink isn't closed.
+
+    Returns a tuple (valid, invalid) as for write_log().
+    """
+
+    if utc_from is not None or utc_to is not None:
+        sink = TimeWindow(sink, utc_from, utc_to)
+    valid = invalid = 0
+    for (buff, base, segments) in mtklog.stream_sectors(chunks, checksum_separator):
+        (good, bad) = write_sector(buff, base, segments, sink, checksum_separator)
+        valid += good
+        invalid += bad
+    if isinstance(sink, TimeWindow):
+        valid = sink.records
+    return (valid, invalid)
+
+
+class RecordLayout(object):
+    """Where TrackSink finds the fields it looks at in one Record class."""
+
+    def __init__(self, cls):
+        fields = cls._fields
+        self.has_position = 'latitude' in fields and 'longitude' in fields
+        self.valid_index = fields.index('valid') if 'valid' in fields else None
+        self.rcr_index = fields.index('rcr') if 'rcr' in fields else None
+
+
+class TrackSink(object):
+    """Base of the sinks writing tracks and waypoints.
+
+    Records are sorted as in mtkbabel.pl:
+
+        a record with RCR BUTTON set (or after a Holux waypoint
+        separator) is a waypoint,
+        other records with a fix are track points,
+        a track ends at a separator, non-written space or a record
+        without a fix.
+
+    Subclasses override begin_track(), track_point(), end_track() and
+    waypoint(), which do nothing here.
+    """
+
+    def __init__(self):
+        self.in_trk = False
+        self.force_waypoint = False
+        self.layouts = {}       # Record class -> RecordLayout
+
+    def record(self, record):
+        """Take one decoded record."""
+
+        layout = self.layouts.get(type(record))
+        if layout is None:
+            layout = self.layouts[type(record)] = RecordLayout(type(record))
+        valid = None if layout.valid_index is None else record[layout.valid_index]
+
+        # start a new track on satellite lost
+        if valid == VALID_NOFIX:
+            self.track_break()
+
+        if not layout.has_position:
+            return
+        if self.force_waypoint:
+            self.waypoint(record)
+            self.force_waypoint = False
+            return
+        if valid == VALID_NOFIX:
+            return
+        if layout.rcr_index is not None and record[layout.rcr_index] & RCR_BUTTON:
+            self.waypoint(record)
+        else:
+            if not self.in_trk:
+                self.in_trk = True
+                self.begin_track(record)
+            self.track_point(record)
+
+    def track_break(self):
+        """End the current track, if any."""
+
+        if self.in_trk:
+            self.in_trk = False
+            self.end_track()
+
+    def next_waypoint(self):
+        """Make the next record a waypoint (Holux WAYPNT separator)."""
+
+        self.force_waypoint = True
+
+    def close(self):
+        """End the last track."""
+
+        self.track_break()
+
+    def begin_track(self, record):
+        """Start a track, 'record' is its first point."""
+
+    def track_point(self, record):
+        """Add 'record' to the current track."""
+
+    def end_track(self):
+        """End the current track."""
+
+    def waypoint(self, record):
+        """Write 'record' as a waypoint."""
+
+
+class Simplifier(TrackSink):
+    """Pass records on to a sink with each track simplified.
+
+    The points of a track are kept until the track ends, then only those
+    mtksimplify.simplify() keeps are passed on, followed by a track break.
+    Waypoints are passed on as they come, each after a next_waypoint() so
+    the sink takes it as one.  Records without a position or fix aren't
+    passed on, so put this in front of track writers only.
+    """
+
+    def __init__(self, sink, tolerance):
+        """sink       the sink to pass records on to
+        tolerance  largest distance in metres from a dropped point to the
+                   simplified track
+        """
+
+        TrackSink.__init__(self)
+        self.sink = sink
+        self.tolerance = tolerance
+        self.points = []
+
+    def track_point(self, record):
+        self.points.append(record)
+
+    def end_track(self):
+        points = self.points
+        self.points = []
+        kept = mtksimplify.simplify([point.latitude for point in points],
+                                    [point.longitude for point in points],
+                                    self.tolerance)
+        for i in kept:
+            self.sink.record(points[i])
+        self.sink.track_break()
+
+    def waypoint(self, record):
+        self.sink.next_waypoint()
+        self.sink.record(record)
+
+    def close(self):
+        TrackSink.close(self)
+        self.sink.close()
+
+
+class TimeWindow(object):
+    """Pass on to a sink only the records in a UTC time range.
+
+    Track breaks are always passed on.  A Holux waypoint separator is
+    passed on just before the record it applies to, and dropped with the
+    record if that is out of the range.  Records without a UTC time are
+    dropped.
+    """
+
+    def __init__(self, sink, utc_from=None, utc_to=None):
+        """sink      the sink to pass records on to
+        utc_from  earliest UTC time, None means no limit
+        utc_to    latest UTC time, None means no limit
+        """
+
+        self.sink = sink
+        self.utc_from = utc_from
+        self.utc_to = utc_to
+        self.force_waypoint = False
+        self.records = 0        # records passed on
+
+    def record(self, record):
+        utc = getattr(record, 'utc', None)
+        force_waypoint = self.force_waypoint
+        self.force_waypoint = False
+        if (utc is None or (self.utc_from is not None and utc < self.utc_from) or
+                (self.utc_to is not None and utc > self.utc_to)):
+            return
+        if force_waypoint:
+            self.sink.next_waypoint()
+        self.records += 1
+        self.sink.record(record)
+
+    def track_break(self):
+        self.sink.track_break()
+
+    def next_waypoint(self):
+        self.force_waypoint = True
+
+    def close(self):
+        self.sink.close()
+
+
+class Fanout(object):
+    """Pass each record and event on to all of a list of sinks."""
+
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def record(self, record):
+        for sink in self.sinks:
+            sink.record(record)
+
+    def track_break(self):
+        for sink in self.sinks:
+            sink.track_break()
+
+    def next_waypoint(self):
+        for sink in self.sinks:
+            sink.next_waypoint()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class CsvWriter(object):
+    """Write every record to a CSV file, one row per record.
+
+    The columns are CsvColumns.  'time' is the UTC time as in GPX files,
+    the DOP fields are in units as in GPX files (not hundredths), other
+    fields are as decoded and fields not in the log format are empty.
+    """
+
+    def __init__(self, path, buffer_size=BufferSize):
+        self.fd = open(path, 'wb', buffer_size)
+        self.writer = csv.writer(self.fd)
+        self.writer.writerow(CsvColumns)
+        self.rows = {}          # Record class -> list of (index, conversion)
+
+    def row(self, cls):
+        """Return the list of (index, conversion) for the columns of 'cls'."""
+
+        fields = cls._fields
+        result = []
+        for column in CsvColumns:
+            name = 'utc' if column == 'time' else column
+            if name not in fields:
+                result.append((None, None))
+            elif column == 'time':
+                result.append((fields.index(name), utc_time))
+            elif column.endswith('dop'):
+                result.append((fields.index(name), lambda value: value / 100.0))
+            else:
+                result.append((fields.index(name), None))
+        return result
+
+    def record(self, record):
+        row = self.rows.get(type(record))
+        if row is None:
+            row = self.rows[type(record)] = self.row(type(record))
+        self.writer.writerow([('' if index is None else
+                               record[index] if conversion is None else
+                               conversion(record[index]))
+                              for (index, conversion) in row])
+
+    def track_break(self):
+        pass
+
+    def next_waypoint(self):
+        pass
+
+    def close(self):
+        self.fd.close()
@@ -7,44 +7,82 @@ Program to interact with the GPS chip in a QStarz 1300ST logger.
 Usage: pymtkbabel [<options>]
 
 Where <options> is zero or more of:
-    -b    <binfile>         read data from BIN file and continue
-    --bin <binfile>
-    -d     <binfile>        dump memory to file and stop
+    -b    <binfile>         read data from BIN file instead of the device
+    --bin <binfile>         and continue
+    --boost                 raise the port speed for the download and continue
+    --cache                 only download what changed since the last download
+                            and continue
+    --csv <csvfile>         create CSV file (all records) and continue
+    -d     <binfile>        dump memory to file and continue
     --dump <binfile>
     --debug <level>         set debug to number <level> and continue
     --erase                 erase data logger memory and stop
+    --from <time>           only use records from UTC <time> and continue
     --full stop|overlap     set handling of "memory full" and continue
-    -g <gpxfile>            create GPX file (tracks and waypoints) and stop
+    -g <gpxfile>            create GPX file (tracks and waypoints) and continue
     --gpx <gpxfile>
     -h                      print help and stop
     --help
+    --kml <kmlfile>         create KML file (tracks) and continue
     --log <time>:<distance>:<speed>
                             set logging criteria (zero to disable) and stop:
                                <time>       0.10 -> 9999999.90 seconds
                                <distance>   0.10 -> 9999999.90 meters
                                <speed>      0.10 -> 9999999.90 km/hour
+    --nmea                  download in NMEA mode, not binary, and continue
     -p <port>               set serial communication port and continue
+    --parallel              decode a BIN file in a process per CPU and continue
     --port <port>
+    --resume                continue an interrupted download
     -s <speed>              set port speed and continue
+    --simplify <metres>     simplify KML tracks, dropping points within
+                            <metres> of the track, and continue
     --speed <speed>
-    --tracks <gpxfile>      create a GPX file with only tracks and stop
+    --to <time>             only use records up to UTC <time> and continue
+    --tracks <gpxfile>      create a GPX file with only tracks and continue
     -v                      print version and stop
     --version
-    --waypoints <gpxfile>   create a GPX file with only waypoints and stop
+    --waypoints <gpxfile>   create a GPX file with only waypoints and continue
 
 For example, download tracks and waypoints and create a BIN and two GPX files:
     mtkbabel --tracks gpsdata_trk.gpx --waypoints gpsdata_wpt.gpx -d gpsdata.bin
+
+The memory is downloaded and the log parsed only once, however many files
+are created.
+
+A <time> is YYYY-MM-DD, YYYY-MM-DDTHH:MM:SS or seconds since the epoch, in UTC.
+
+A BIN file is indexed in the file <binfile>.idx, so later runs on the same
+file don't scan it again.  With --parallel the sectors of a large BIN file
+are decoded by worker processes instead, a file under 1 MB is still decoded
+in one process.
+
+Downloads are journaled in the file 'mtkbabel.journal'.  If a download is
+interrupted, run again with --resume and only the missing data is read.
+
+The log is downloaded in MTK binary packet mode, about twice as fast as NMEA
+mode, unless the device refuses it or --nmea is given.  With --cache the
+sectors downloaded are kept under ~/.btq1300st and only new data is read
+next time.
 """
 
+import os
 import sys
-import glob
 import getopt
 import time
+import calendar
+import mmap
+import struct
 import array
 import binascii
 import serial
 
 import log
+import mtklog
+import mtkgpx
+import mtksink
+import data2kml
+import btq1300st
 
 
 # program name and version
@@ -53,8 +91,6 @@ Version = 'pymtkbabel 0.1'
 # serial port and speed defauts
 MinPortSpeed = 300
 MaxPortSpeed = 115200
-DefaultPortSpeed = MaxPortSpeed
-DefaultPortPrefix = '/dev/tty*'
 
 # debug level stuff
 DefaultDebugLevel = 20
@@ -73,9 +109,12 @@ MaxDebugLevel = 50
 
 
 
-Timeout = 5             # sec
 TimeoutPktPreamble = 20 # sec
-TimeoutIdlePort = 5000  # msec
+
+DefaultJournalFile = 'mtkbabel.journal'
+
+# formats accepted by --from and --to, besides seconds since the epoch
+TimeFormats = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
 
 #port = '/dev/ttyACM0'
 read_buffer = ''
@@ -123,249 +162,10 @@ SIZEOF_SECTOR = 0x10000
 SIZEOF_SECTOR_HEADER = 0x200
 SIZEOF_SEPARATOR = 0x10
 
-class QStarz(object):
-    """Class to handle comms with chip in QStarz logger."""
-
-    def __init__(self, device, speed):
-        """Initialize the device.
-
-        device  the device to use
-        speed   comms speed
-        """
-
-        self.memory = None
-        self.read_buffer = ''
-        self.sane = True
+# count, format, status, period, distance, speed, failed sectors and
+# unused space, then separator, checksum and tail
+SectorHeader = struct.Struct('<HIHIII32x454xcB4s')
 
-        if device is None:
-            log.debug('QStartz object must be given a valid port, not None')
-            raise RuntimeError('QStartz object must be given a valid port, not None')
-        try:
-            self.serial = serial.Serial(port=device, baudrate=speed, timeout=0)
-        except OSError:
-            log.debug('device %s is not sane' % device)
-            self.sane = False
-            return
-        except serial.SerialException:
-            log.debug('device %s is not readable' % device)
-            self.sane = False
-            return
-            
-        if not self.send('PMTK000'):
-            log.debug('device %s is not sane' % device)
-            self.sane = False
-            return
-        log.debug('****** device %s IS sane' % device)
-
-        ret = self.recv('PMTK001,0,')
-        if not ret or not ret.startswith('PMTK001,0,'):
-            log.debug('device %s is not a QStarz device' % device)
-            self.sane = False
-            return
-
-        log.debug('device %s is a QStarz device, created' % device)
-
-    def init(self):
-        if not self.sane:
-            return False
-
-        self.send('PMTK604')
-        ret = self.recv('PMTK001,604,')
-        self.version = ret.split(',')[2]
-    
-        self.send('PMTK605')
-        ret = self.recv('PMTK705,')
-        ret_list = ret.split(',')
-        self.release = ret_list[1]
-        self.model_id = ret_list[2]
-    
-        log.info('QStarz: MTK Firmware: Version %s, Release %s, Model ID %s' % (self.version, self.release, self.model_id))
-    
-        # query log format
-        self.send('PMTK182,2,2')
-        ret = self.recv('PMTK182,3,2,')
-        fmt = ret.split(',')[3]
-        self.log_format = int(fmt, 16)
-        log.info('QStarz: Log format: %s' % describe_log_format(self.log_format))
-    
-        self.send('PMTK182,2,6')
-        self.recv('PMTK001,182,2,3')
-        method = self.recv('PMTK182,3,6,')
-        self.rec_method = int(method.split(',')[3])
-        log.info('QStarz: Recording method on memory full: %s' % describe_recording_method(self.rec_method))
-    
-        # query RCD_ADDR data
-        self.send('PMTK182,2,8')
-        ret = self.recv('PMTK182,3,8')
-        self.recv('PMTK001,182,2,3')
-        if ret:
-            self.next_write_address = int(ret.split(',')[3], 16)
-            log.info('QStarz: Next write address: 0x%04x (%d)' % (self.next_write_address, self.next_write_address))
-    
-        # query number of records written
-        self.send('PMTK182,2,10')
-        ret = self.recv('PMTK182,3,10')
-        self.send('PMTK001,182,2,3')
-        if ret:
-            self.expected_records_total = ret.split(',')[3]
-            log.info('QStarz: Number of records: %s (%d)' % (self.expected_records_total, int(self.expected_records_total, 16)))
-
-        return True
-
-#    def __del__(self):
-#        if self.serial:
-#            del self.serial
-
-    def read_memory(self):
-        """Read device memory."""
-
-        # bomb out if device data already read
-        if self.memory is not None:
-            return
-
-        # read data
-        if self.rec_method == RCD_METHOD_OVF:
-            # in OVERLAP mode we don't know where data ends, read it all
-            bytes_to_read = flash_memory_size(self.model_id)
-        else:
-            # in STOP mode read from zero to NextWriteAddress
-            sectors = int(self.next_write_address / SIZEOF_SECTOR)
-            if self.next_write_address % SIZEOF_SECTOR:
-                sectors += 1
-            bytes_to_read = sectors * SIZEOF_SECTOR
-    
-        log.info('Retrieving %d (0x%08x) bytes of log data from device' % (bytes_to_read, bytes_to_read))
-    
-        non_written_sector_found = False
-    
-        offset = 0
-        data = ''
-        while offset < bytes_to_read:
-            self.send('PMTK182,7,%08x,%08x' % (offset, SIZEOF_CHUNK))
-            msg = self.recv('PMTK182,8', 10)
-            if msg:
-                (address, buff) = msg.split(',')[2:]
-                #print('len=%d, buff=%s' % (len(buff), buff))
-                data += buff
-                offset += SIZEOF_CHUNK
-            self.recv('PMTK001,182,7,3', 10)
-    
-        data = data.decode('hex')
-        log.debug('%d bytes read (expected %d), len(data)=%d' % (offset, bytes_to_read, len(data)))
-        self.memory = data
-
-    def get_memory(self):
-        """Get device memory."""
-
-        if self.memory is None:
-            self.read_memory()
-        return self.memory
-
-    def set_memory(self, memory):
-        """Set device memory."""
-
-        self.memory = memory
-
-    def send(self, msg):
-        checksum = self.msg_checksum(msg)
-        msg = '$%s*%02x\r\n' % (msg, checksum)
-        try:
-            self.serial.write(msg)
-        except serial.SerialException:
-            log.debug('QStarz.send: failed')
-            return False
-        log.debug('QStarz.send: %s' % msg[:-2])
-        return True
-
-    def recv(self, prefix, timeout=Timeout):
-        """Receive message with given prefix."""
-
-        max_time = time.time() + timeout
-    
-        while True:
-            pkt = self.read_pkt(timeout=timeout)
-            log.debug("QStarz.recv: prefix='%s', pkt='%-40s'" % (prefix, pkt))
-            if pkt.startswith(prefix):
-                log.debug('QStarz.recv: Got desired packet: %s' % prefix)
-                return pkt
-            if time.time() > max_time:
-                log.info('##################### packet_wait: timeout')
-                break
-            time.sleep(0.01)
-    
-        return None
-
-    def read_pkt(self, timeout=None):
-        """Read a packet from the device.
-        
-        timeout  read timeout in seconds
-        """
-
-        if timeout is None:
-            timeout = TimeoutIdlePort
-        log.debug('read_pkt: timeout=%s' % str(timeout))
-
-        then = time.time() + timeout
-
-        pkt = ''
-        while time.time() < then:
-            if '\n' in self.read_buffer:
-                result = self.read_buffer[:self.read_buffer.index('\n')+1]
-                self.read_buffer = self.read_buffer[self.read_buffer.index('\n')+1:]
-                # get packet, check checksum
-                pkt = result[1:-5]
-                checksum = result[-4:-2]
-                log.debug("QStarz.read_pkt: pkt='%s', checksum='%s'" % (pkt, checksum))
-                if checksum != self.msg_checksum(pkt):
-                    log.info('Checksum error on read, got %s expected %s' %
-                             (checksum, self.msg_checksum(pkt)))
-#                    raise Exception('Checksum error on read, got %s expected %s' %
-#                                    (checksum, packet_checksum(pkt)))
-                return pkt
-            try:
-                data = self.serial.read(9999)
-            except serial.SerialException:
-                return pkt
-            log.debug('read_pkt: read data=%s' % str(data))
-            if len(data) > 0:
-                self.read_buffer += data
-                log.debug('read_pkt: appended to buffer=%s' % str(data))
-            else:
-                log.debug('read_pkt: sleeping')
-                time.sleep(0.1)
-
-        return pkt
-
-    def msg_checksum(self, msg):
-        result = 0
-        for ch in msg:
-            result ^= ord(ch)
-        log.debug("msg='%s', checksum=0x%02x" % (msg, result))
-        return result
-
-
-def find_device(speed):
-    """Find the device amongst /dev/*.
-
-    Use the given device speed.  Looks under DefaultDevicePath.
-    Return None if not found.
-    """
-
-    log.debug('find_device: speed=%d' % speed)
-    for port in get_tty_port():
-        log.debug('find_device: checking device %s' % port)
-        gps = QStarz(port, speed)
-        if not gps.init():
-        #if gps is None:
-            log.debug('find_device: device %s was invalid' % port)
-            del gps
-            continue
-        log.debug('find_device: returning device %s' % port)
-        del gps
-        return port
-
-    log.debug('find_device: No port found')
-    return None
 
 def describe_log_format(log_format):
     result = ''
@@ -416,103 +216,102 @@ def describe_recording_method(method):
         return 'STOP'
 
 
-def unpack(byte_array):
-    """Unpack byte array into binary (LSB first)."""
-
-#    print('unpack, byte_array=%s' % binascii.b2a_hex(byte_array))
-    result = 0
-    byte_array.reverse()
-    for val in byte_array:
-#        print('val=%d' % val)
-        result = result*256 + val
+def parse_sector_header(data, offset=0):
+    """Parse a log sector header.
 
-    return result
+    data    string, bytearray or mmap holding the header
+    offset  offset of the header in 'data'
 
+    Fields are unpacked in place, the header isn't copied.
+    """
 
-def parse_sector_header(sector_header):
-    """Parse a log sector header."""
-
-    log.debug('sector_header=%s' % binascii.b2a_hex(sector_header))
-
-    separator = chr(sector_header[-6])
-    checksum = sector_header[-5]
-    header_tail = binascii.b2a_hex(sector_header[-4:])
-    if separator != '*' or header_tail != 'bbbbbbbb':
-#        print('ERROR: Invalid datalog sector header, see log')
-        log('ERROR: Invalid sector header, see above')
+    (log_count, log_format, log_status, log_period, log_distance, log_speed,
+            separator, checksum, header_tail) = SectorHeader.unpack_from(data, offset)
+    if separator != '*' or header_tail != '\xbb' * 4:
+        log.critical('ERROR: Invalid sector header at offset 0x%06x' % offset)
         sys.exit(1)
 
-    offset = 0
-    log_count = sector_header[offset:SIZEOF_WORD]
-    offset += SIZEOF_WORD
-    log_format = sector_header[offset:offset+SIZEOF_LONG]
-    offset += SIZEOF_LONG
-    log_status = sector_header[offset:offset+SIZEOF_WORD]
-    offset += SIZEOF_WORD
-    log_period = sector_header[offset:offset+SIZEOF_LONG]
-    offset += SIZEOF_LONG
-    log_distance = sector_header[offset:offset+SIZEOF_LONG]
-    offset += SIZEOF_LONG
-    log_speed = sector_header[offset:offset+SIZEOF_LONG]
-    offset += SIZEOF_LONG
-    log_failsect = sector_header[offset:offset+SIZEOF_BYTE*32]
-
-    log.debug('log_count=%s' % binascii.b2a_hex(log_count))
-    log.debug('log_format=%s' % binascii.b2a_hex(log_format))
-    log.debug('log_status=%s' % binascii.b2a_hex(log_status))
-    log.debug('log_period=%s' % binascii.b2a_hex(log_period))
-    log.debug('log_distance=%s' % binascii.b2a_hex(log_distance))
-    log.debug('log_speed=%s' % binascii.b2a_hex(log_speed))
-    log.debug('log_failsect=%s' % binascii.b2a_hex(log_failsect))
-
-    log.debug('len(log_count)=%d' % len(log_count))
-    log.debug('len(log_format)=%d' % len(log_format))
-
-    log_count = unpack(log_count)
-    log_format = unpack(log_format)
-
-    log.debug('log_count=%s' % str(log_count))
-    log.debug('log_format=%s' % str(log_format))
+    log.debug('log_count=%d, log_format=0x%08x, log_status=0x%04x'
+              % (log_count, log_format, log_status))
+    log.debug('log_period=%d, log_distance=%d, log_speed=%d'
+              % (log_period, log_distance, log_speed))
 
     return (log_count, log_format)
 
 
-def parse_log_data(data):
+def parse_log_data(data, index=None, writer=None):
     """Parse log data.
 
-    data  bytearray of log data
+    data    string, bytearray or mmap of log data
+    index   mtklog.ImageIndex of 'data', if known
+    writer  if given, the valid records are passed to writer.record() as
+            they are decoded, separators and non-written space to
+            writer.track_break() and Holux waypoint separators to
+            writer.next_waypoint() (see mtksink)
+
+    The sector headers are checked, then the log is fed to 'writer' by
+    mtksink.write_log(), which splits tracks as mtkbabel.pl does.
+    Records are decoded where they lie, nothing is sliced out of 'data',
+    and aren't kept, so memory use doesn't grow with the size of the log.
+
+    Returns the number of valid records.
     """
 
-    fp = 0
-    size = len(data)
+    if index is not None:
+        segments = index.segments()
+    else:
+        segments = mtklog.scan_segments(data)
+    for segment in segments:
+        if segment.kind == mtklog.SEGMENT_HEADER:
+            parse_sector_header(data, segment.start)
 
-    while True:
-#        print('>> Reading offset %08x' % fp)
+    if writer is None:
+        writer = mtksink.TrackSink()
+    (records, bad_records) = mtksink.write_log(data, writer, segments=segments)
 
-        if (fp % SIZEOF_SECTOR) == 0:
-            # reached the beginning of a log sector (every 0x10000 bytes),
-            # get header (0x200 bytes)
-            header = data[fp:fp+SIZEOF_SECTOR_HEADER]
-            (expected_records_sector, log_format) = parse_sector_header(header)
-#            print('expected_records_sector=%04x' % expected_records_sector)
-#            print('log_format=%08x' % log_format)
+    log.info('parse_log_data: %d records, %d with bad checksums' % (records, bad_records))
+    return records
 
-            record_count_sector = 0
 
-        if record_count_total >= expected_records_total:
-#            print('Total record count: %d' % record_count_total)
-            break
+def select_log_data(data, utc_from=None, utc_to=None, index=None, writer=None):
+    """Parse the log data in a time range.
 
-        if record_count_sector >= expected_records_sector:
-            new_offset = SIZEOF_SECTOR * (fp/SIZEOF_SECTOR + 1)
-            if new_offset < log_len:
-                fp = new_offset
-                continue
-            else:
-                # end of file
-                pass
-#                print('Total record count: %d' % record_count_total)
-            break
+    data      string, bytearray or mmap of log data
+    utc_from  earliest UTC time, None means from the start
+    utc_to    latest UTC time, None means to the end
+    index     mtklog.ImageIndex of 'data', if known
+    writer    if given, the records are passed on as by parse_log_data()
+
+    Only the sectors holding the range are decoded, see
+    mtksink.write_log().  Separators are passed on as without a range, so
+    tracks are split the same way.
+
+    Returns the number of valid records in the range.
+    """
+
+    if writer is None:
+        writer = mtksink.TrackSink()
+    (records, _) = mtksink.write_log(data, writer, index, utc_from=utc_from, utc_to=utc_to)
+    log.info('select_log_data: %d records in range' % records)
+    return records
+
+
+def parse_utc(param):
+    """Return the UTC time 'param' as seconds since the epoch.
+
+    Returns None if 'param' isn't in one of TimeFormats or a number.
+    """
+
+    try:
+        return int(param)
+    except ValueError:
+        pass
+    for fmt in TimeFormats:
+        try:
+            return calendar.timegm(time.strptime(param, fmt))
+        except ValueError:
+            pass
+    return None
 
 
 #ser = serial.Serial(port=port, baudrate=115200, timeout=0)
@@ -636,17 +435,6 @@ def parse_log_data(data):
 #ser.close()
 
 
-def get_tty_port():
-    """Guess the logger port.
-
-    Return ports found.
-    """
-
-    ports = glob.glob(DefaultPortPrefix)
-    log.debug('get_tty_port() returns:\n%s' % str(ports))
-    return ports
-
-
 def read_memory(port, speed):
     """Read memory data.
 
@@ -715,23 +503,40 @@ def read_memory(port, speed):
 
     non_written_sector_found = False
 
+    # decode each chunk straight into its place in one buffer
+    data = bytearray(bytes_to_read)
+    view = memoryview(data)
     offset = 0
-    data = ''
     while offset < bytes_to_read:
         packet_send(ser, 'PMTK182,7,%08x,%08x' % (offset, SIZEOF_CHUNK))
         msg = packet_wait(ser, 'PMTK182,8', 10)
         if msg:
             (address, buff) = msg.split(',')[2:]
 #            print('len=%d, buff=%s' % (len(buff), buff))
-            data += buff
+            address = int(address, 16)
+            chunk = binascii.unhexlify(buff)
+            view[address:address+len(chunk)] = chunk
             offset += SIZEOF_CHUNK
         packet_wait(ser, 'PMTK001,182,7,3', 10)
+    del view
 
-    data = data.decode('hex')
     print('%d bytes read (expected %d), len(data)=%d' % (offset, bytes_to_read, len(data)))
 
     return data
 
+def map_bin_file(path):
+    """Return the contents of BIN file 'path', memory mapped.
+
+    The file is mapped read-only, so pages are only read as the parser
+    touches them and nothing is copied into the process.
+    """
+
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+
 def usage(msg=None):
     print(__doc__)        # module docstring used
     if msg:
@@ -750,9 +555,10 @@ def main(argv=None):
 
     try:
         opts, args = getopt.getopt(argv, 'b:d:g:hp:s:v',
-                                   ['bin=', 'dump=', 'debug=', 'erase', 'full=',
-                                    'gpx=', 'help', 'log=', 'port=', 'speed=',
-                                    'tracks=', 'version', 'waypoints='])
+                                   ['bin=', 'boost', 'cache', 'csv=', 'dump=', 'debug=', 'erase',
+                                    'from=', 'full=', 'gpx=', 'help', 'kml=', 'log=', 'nmea',
+                                    'parallel', 'port=', 'resume',
+                                    'simplify=', 'speed=', 'to=', 'tracks=', 'version', 'waypoints='])
     except getopt.error as msg:
         usage(str(msg))
         return 1
@@ -779,17 +585,21 @@ def main(argv=None):
                     return 1
     global log
     log = log.Log('mtkbabel.log', debug_level)
+    btq1300st.log = log
     if debug_level != DefaultDebugLevel:
         log.critical('Debug level set to %d' % debug_level)
     log.critical('main: argv=%s' % str(argv))
 
     # set default values
     port = None
-    ports = get_tty_port()
-    log.debug('get_tty_port() returned:\n%s' % str(ports))
-    if len(ports) == 1:
-        port = ports[0]
-    speed = DefaultPortSpeed
+    speed = None            # found with the device if not given
+    resume = False
+    binary = True
+    boost = False
+    parallel = False
+    cache_dir = None
+    utc_from = None
+    utc_to = None
     log.debug('port=%s, speed=%s' % (str(port), str(speed)))
 
     # pick out help, device, speed and version options
@@ -800,6 +610,26 @@ def main(argv=None):
         if opt in ['-p', '--port']:
             port = param
             log.info('Set port to %s' % port)
+        if opt in ['--resume']:
+            resume = True
+        if opt in ['--nmea']:
+            binary = False
+        if opt in ['--parallel']:
+            parallel = True
+        if opt in ['--boost']:
+            boost = True
+        if opt in ['--cache']:
+            cache_dir = btq1300st.BTQ1300ST.DefaultCacheDir
+        if opt in ['--from', '--to']:
+            utc = parse_utc(param)
+            if utc is None:
+                usage("Option '%s' requires a time, eg 2015-08-31T04:30:00" % opt)
+                return 1
+            if opt == '--from':
+                utc_from = utc
+            else:
+                utc_to = utc
+            log.info('Set %s time to %d' % (opt[2:], utc))
         if opt in ['-s', '--speed']:
             try:
                 speed = int(param)
@@ -812,35 +642,44 @@ def main(argv=None):
             print(Version)
             return 0
 
-    # create QStarz object, if possible
-    if port is None:
-        print('Calling find_device(%d)' % speed)
-        port = find_device(speed)
-        if port is None:
-            log.critical('No port specified & none found, choices: %s' % ', '.join(ports))
-            print('No port specified & none found, choices: %s' % ', '.join(ports))
-            return 1
-
-    gps = QStarz(port, speed)
-    if not gps.init():
-        log.debug('Device is %s, speed %d is not a QStarz device' % (str(port), speed))
-        return 1
-    log.debug('Device is %s, speed %d' % (str(port), speed))
-
-    # now handle remaining options
+    # a BIN file stands in for the device memory, no device is needed
+    memory = None
+    index = None
+    bin_path = None
     for (opt, param) in opts:
         if opt in ['-b', '--bin']:
-            with open(param, 'rb') as fd:
-                memory = fd.read()
-            gps.set_memory(memory)
+            bin_path = param
+            memory = map_bin_file(param)
+            log.info('Mapped %d bytes from file %s' % (len(memory), param))
+            index = mtklog.open_index(param, memory)
+
+    # find the device, or its speed, if not given
+    if memory is None:
+        if port is None or speed is None:
+            devices = btq1300st.BTQ1300ST.find_devices(speeds=None if speed is None else [speed],
+                                                       ports=None if port is None else [port])
+            if len(devices) != 1:
+                names = ', '.join([device for (device, _, _) in devices])
+                log.critical('Need one device, found %d: %s' % (len(devices), names))
+                print('Need one device, found %d: %s' % (len(devices), names))
+                return 1
+            (port, speed, _) = devices[0]
+
+        gps = btq1300st.BTQ1300ST(port, speed)
+        if not gps.init():
+            log.debug('Device is %s, speed %d is not a QStarz device' % (str(port), speed))
+            return 1
+        log.debug('Device is %s, speed %d' % (str(port), speed))
+
+    # now handle remaining options, collecting the files to write
+    dump_path = None
+    gpx_paths = {}
+    kml_path = None
+    csv_path = None
+    tolerance = None
+    for (opt, param) in opts:
         if opt in ['-d', '--dump']:
-            log.debug('Dumping memory to file %s' % param)
-            memory = gps.get_memory()
-            log.info('Read %d bytes' % len(memory))
-            with open(param, 'wb') as fd:
-                fd.write(memory)
-            log.info('Wrote %d bytes to file %s' % (len(memory), param))
-            return 0
+            dump_path = param
         if opt in ['--erase']:
             not_yet_implemented('erase memory')
             return 0
@@ -848,20 +687,80 @@ def main(argv=None):
             not_yet_implemented('memory full handling')
             return 0
         if opt in ['-g', '--gpx']:
-            log.debug('Got --gpx option')
-            data = gps.get_memory()
-            parse_log_data(data)
-            #self.write_gpx(param)
-        if opt in ['--log']:
-            not_yet_implemented('set logging criteria')
-            return 0
+            gpx_paths['gpx_path'] = param
         if opt in ['--tracks']:
-            not_yet_implemented('write tracks GPX')
-            return 0
+            gpx_paths['tracks_path'] = param
         if opt in ['--waypoints']:
-            not_yet_implemented('write waypoints GPX')
+            gpx_paths['waypoints_path'] = param
+        if opt in ['--kml']:
+            kml_path = param
+        if opt in ['--simplify']:
+            try:
+                tolerance = float(param)
+            except ValueError:
+                usage("Option '%s' requires a distance in metres" % opt)
+                return 1
+        if opt in ['--csv']:
+            csv_path = param
+        if opt in ['--log']:
+            not_yet_implemented('set logging criteria')
             return 0
 
+    if dump_path is None and not gpx_paths and kml_path is None and csv_path is None:
+        return 0
+
+    # the log is parsed once, each record going to all the writers
+    sinks = []
+    if gpx_paths:
+        sinks.append(mtkgpx.GpxWriter(**gpx_paths))
+    if kml_path is not None:
+        if tolerance:
+            sinks.append(mtksink.Simplifier(data2kml.KmlWriter(kml_path), tolerance))
+        else:
+            sinks.append(data2kml.KmlWriter(kml_path))
+    if csv_path is not None:
+        sinks.append(mtksink.CsvWriter(csv_path))
+    writer = mtksink.Fanout(sinks)
+
+    if memory is None:
+        # the memory is read once for all files and each sector is parsed
+        # as soon as it arrives, a dump needs all the memory
+        if dump_path is None:
+            (window_from, window_to) = (utc_from, utc_to)
+        else:
+            (window_from, window_to) = (None, None)
+        chunks = gps.stream_chunks(binary=binary, boost=boost, cache_dir=cache_dir,
+                                   journal_path=DefaultJournalFile, resume=resume,
+                                   utc_from=window_from, utc_to=window_to)
+        (count, _) = mtksink.write_stream(chunks, writer, utc_from=utc_from, utc_to=utc_to)
+        memory = gps.memory
+        if memory is None:
+            writer.close()
+            print('Download failed, use --resume to continue it')
+            return 1
+        log.info('Read %d bytes' % len(memory))
+    elif utc_from is None and utc_to is None and parallel:
+        (count, bad_count) = mtksink.write_log_parallel(bin_path, writer)
+        log.info('write_log_parallel: %d records, %d with bad checksums' % (count, bad_count))
+    elif utc_from is None and utc_to is None:
+        count = parse_log_data(memory, index, writer)
+    else:
+        count = select_log_data(memory, utc_from, utc_to, index, writer)
+    writer.close()
+
+    if dump_path is not None:
+        log.debug('Dumping memory to file %s' % dump_path)
+        with open(dump_path, 'wb') as fd:
+            fd.write(memory)
+        log.info('Wrote %d bytes to file %s' % (len(memory), dump_path))
+
+    if sinks:
+        log.info('Parsed %d records' % count)
+        for path in gpx_paths.values() + [kml_path, csv_path]:
+            if path is not None:
+                log.info('Wrote file %s' % path)
+
+    return 0
 
 
 if __name__ == '__main__':
@@ -6,6 +6,8 @@ import time
 import struct
 import binascii
 
+import mtklog
+
 
 LOG_HAS_CHECKSUM_SEPARATOR = True
 
@@ -85,15 +87,6 @@ def utc_time(t):
 #    return time2str('%Y-%m-%dT%H:%M:%SZ', t, 'GMT')
 
 
-def unpack(byte_array):
-    """Unpack byte array into binary (LSB first)."""
-
-    result = 0
-    for val in reversed(byte_array):
-        result = result*256 + ord(val)
-
-    return result
-
 def parse_sector_header(hdr):
     """Parse a log sector header.
    
@@ -129,43 +122,38 @@ def parse_log_data(data):
     """Parse log data.
 
     data  bytearray of log data
+
+    The log is first split into sector headers, runs of records, separators
+    and non-written space by mtklog.scan_segments(), so records are only
+    decoded inside record runs.
     """
 
-    fp = 0
     log_len = len(data)
     record_count_total = 0
+    view = memoryview(data)
 
     print('parse_log_data: log_len=0x%06x (%d)' % (log_len, log_len))
 
-    while True:
-        print('>> Reading offset %08x' % fp)
-
-        print('fp %% SIZEOF_SECTOR=%d' % (fp % SIZEOF_SECTOR))
-        if (fp % SIZEOF_SECTOR) == 0:
+    for segment in mtklog.scan_segments(data, checksum_separator=LOG_HAS_CHECKSUM_SEPARATOR):
+        fp = segment.start
+        if segment.kind == mtklog.SEGMENT_HEADER:
             # reached the beginning of a log sector (every 0x10000 bytes),
             # get header (0x200 bytes)
             header = data[fp:fp + SIZEOF_SECTOR_HEADER]
             (expected_records_sector, log_format) = parse_sector_header(header)
-            print('expected_records_sector=0x%06x' % expected_records_sector)
+            print('>> Sector at offset %08x: expected_records_sector=0x%06x'
+                  % (fp, expected_records_sector))
 
             record_count_sector = 0
+            continue
 
 #        if record_count_total >= self.expected_records_total:
 #            print('Total record count: %d' % record_count_total)
 #            break
 
-        print('???: record_count_sector=%d, expected_records_sector=%d' % (record_count_sector, expected_records_sector))
         if record_count_sector >= expected_records_sector:
-            print('Calculating new offset')
-            new_offset = SIZEOF_SECTOR * (fp/SIZEOF_SECTOR + 1)
-            if new_offset < log_len:
-                fp = new_offset
-                continue
-            else:
-                # end of file
-                print('Total record count: %d' % record_count_total)
-                print('Total record count: %d' % record_count_total)
-                break
+            # rest of the sector is unused, on to the next header
+            continue
 
 #        #------------------------------------------------------------------
 #        # Check for:
@@ -180,21 +168,15 @@ def parse_log_data(data):
 #        # - Holux GPSport GR-245 sep.: "HOLUXGR245LOGGER    "
 #        #                              "HOLUXGR245WAYPNT    "
 #        #------------------------------------------------------------------
-        if (log_len - fp) >= SIZEOF_SEPARATOR:
+        if segment.kind != mtklog.SEGMENT_RECORDS:
 #        if (($log_len - tell($fp)) >= $SIZEOF_SEPARATOR) {
 #
 #            $buffer = my_read($fp, $SIZEOF_SEPARATOR);
-            # room enough for a record separator, check if we have one
-            buffer = data[fp:fp+SIZEOF_SEPARATOR]
-            print('len(buffer)=%d' % len(buffer))
-            print('buffer hex:\n%s' % binascii.b2a_hex(buffer))
-            (buff_hdr, buff_data, buff_tail) = struct.unpack('7s5s4s', buffer)
-            print('buff_hdr hex:=%s' % binascii.b2a_hex(buff_hdr))
+            # the scanner has found what kind of separator it is
 #
 #            if ((substr($buffer, 0, 7) eq (chr(0xaa) x 7)) and (substr($buffer, -4) eq (chr(0xbb) x 4))) {
-            if buff_hdr == chr(0xaa) * 7 and buff_tail == chr(0xbb) * 4:
+            if segment.kind == mtklog.SEGMENT_SEPARATOR:
                 # Found a record separator.
-                print('Found a record separator')
 #                #----------------------------------------------------------
 #                # Found a record separator.
 #                #----------------------------------------------------------
@@ -206,8 +188,12 @@ def parse_log_data(data):
 #                my $separator_type = ord(substr($buffer, 7, $SIZEOF_BYTE));
 #                my $separator_arg  = mtk2long(substr($buffer, 8, $SIZEOF_LONG));
 #                printf("Separator: %s, type: %s\n", uc(unpack('H*', $buffer)), describe_separator_type($separator_type)) if ($debug >= $LOG_INFO);
-                separator_type = ord(buffer[7])
-                print('separator_type=%s' % str(separator_type))
+                separator_type = segment.sep_type
+                print('Separator at offset %08x, separator_type=%d' % (fp, separator_type))
+                if separator_type == SEP_TYPE_CHANGE_LOG_BITMASK:
+                    log_format = segment.log_format
+                    print('New log bitmask: 0x%08X' % log_format)
+                continue
 #                if ($separator_type == $SEP_TYPE_CHANGE_LOG_BITMASK) {
 #                    $log_format = $separator_arg;
 #                    printf("New log bitmask: %s (0x%08X = %s)\n", $separator_arg, $log_format, describe_log_format($log_format)) if ($debug >= $LOG_INFO);
@@ -215,8 +201,9 @@ def parse_log_data(data):
 #                next; # Search for the next record or record separator.
 #
 #            } elsif (substr($buffer, 0, 5) eq 'HOLUX') {
-            if buff_hdr.startswith('HOLUX'):
+            if segment.kind == mtklog.SEGMENT_HOLUX:
                 print('found Holux separator')
+                continue
 #                #----------------------------------------------------------
 #                # Found Holux separator.
 #                #----------------------------------------------------------
@@ -252,8 +239,14 @@ def parse_log_data(data):
 #                next;
 #
 #            } elsif ($buffer eq (chr(0xff) x $SIZEOF_SEPARATOR)) {
-            elif buff_hdr == chr(0xff) * SIZEOF_SEPARATOR:
+            elif segment.kind == mtklog.SEGMENT_FREE:
                 print('found non-written space')
+                if expected_records_sector != 0xffff:
+                    print('ERROR: Non written space! Read %u records, expected %u'
+                          % (record_count_sector, expected_records_sector))
+                    break
+                # the sector being written, the free space runs to its end
+                continue
 #                #----------------------------------------------------------
 #                # Found non-written space.
 #                #----------------------------------------------------------
@@ -287,8 +280,6 @@ def parse_log_data(data):
 #                }
 #
 #            } else {
-            else:
-                print('Found record data')
 
 #                # None of above, should be record data: rewind the file pointer so we can read it.
 #                seek($fp, -$SIZEOF_SEPARATOR, 1);
@@ -302,344 +293,19 @@ def parse_log_data(data):
 #        $record_count_total++;
 #        $checksum = 0;
 #        printf("Reading log sector: record %u (%u/%u total)\n", $record_count_sector, $record_count_total, $expected_records_total) if ($debug >= $LOG_INFO);
-        record_count_sector += 1
-        record_count_total += 1
-        checksum = 0
-        fp_offset = fp
-
-#        # Read each record field.
-#        undef($record_utc);
-#        if ($log_format & $LOG_FORMAT_UTC) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_UTC);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_utc = utc_time(mtk2long($buffer));
-#            printf("Record UTC: %s %s\n", uc(unpack('H*', $buffer)), $record_utc) if ($debug >= $LOG_DEBUG);
-#        }
-        record_utc = None
-        if log_format and LOG_FORMAT_UTC:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_UTC]
-            fp_offset += SIZEOF_LOG_UTC
-#            checksum ^= packet_checksum(buffer)
-            record_utc = utc_time(time.gmtime(unpack(buffer)))
-            print('DATA: record_utc=%s' % record_utc)
-
-#        undef($record_valid);
-#        if ($log_format & $LOG_FORMAT_VALID) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_VALID);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_valid = mtk2unsignedword($buffer);
-#            printf("Record VALID: %s (0x%04X = %s)\n", uc(unpack('H*', $buffer)), $record_valid, describe_valid_mtk($record_valid)) if ($debug >= $LOG_DEBUG);
-#         }
-        record_valid = None
-        if log_format & LOG_FORMAT_VALID:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_VALID]
-            fp_offset += SIZEOF_LOG_VALID
-#            checksum ^= packet_checksum(buffer)
-            record_valid = unpack(buffer)
-            print('DATA: record_valid=%06x' % record_valid)
-
-#        undef($record_latitude);
-#        if ($log_format & $LOG_FORMAT_LATITUDE) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_LATITUDE);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_latitude = mtk2number($buffer, $SIZEOF_LOG_LATITUDE);
-#            printf("Record LATITUDE: %s (%.9f)\n", uc(unpack('H*', $buffer)), $record_latitude) if ($debug >= $LOG_DEBUG);
-#        }
-        record_latitude = None
-        if log_format & LOG_FORMAT_LATITUDE:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_LATITUDE]
-            fp_offset += SIZEOF_LOG_LATITUDE
-#            checksum ^= packet_checksum(buffer)
-            record_latitude = unpack(buffer)
-            print('DATA: record_latitude=%d' % record_latitude)
-
-#        undef($record_longitude);
-#        if ($log_format & $LOG_FORMAT_LONGITUDE) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_LONGITUDE);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_longitude = mtk2number($buffer, $SIZEOF_LOG_LONGITUDE);
-#            printf("Record LONGITUDE: %s (%.9f)\n", uc(unpack('H*', $buffer)), $record_longitude) if ($debug >= $LOG_DEBUG);
-#        }
-        record_longitude = None
-        if log_format & LOG_FORMAT_LONGITUDE:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_LONGITUDE]
-            fp_offset += SIZEOF_LOG_LONGITUDE
-#            checksum ^= packet_checksum(buffer)
-            record_longitude = unpack(buffer)
-            print('DATA: record_longitude=%d' % record_longitude)
-
-#
-#        undef($record_height);
-#        if ($log_format & $LOG_FORMAT_HEIGHT) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_HEIGHT);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_height = mtk2number($buffer, $SIZEOF_LOG_HEIGHT);
-#            printf("Record HEIGHT: %s (%.6f)\n", uc(unpack('H*', $buffer)), $record_height) if ($debug >= $LOG_DEBUG);
-#        }
-
-        record_height = None
-        if log_format & LOG_FORMAT_HEIGHT:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_HEIGHT]
-            fp_offset += SIZEOF_LOG_HEIGHT
-#            checksum ^= packet_checksum(buffer)
-            record_height = unpack(buffer)
-            print('DATA: record_height=%d' % record_height)
-
-#        undef($record_speed);
-#        if ($log_format & $LOG_FORMAT_SPEED) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_SPEED);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_speed = mtk2number($buffer, $SIZEOF_LOG_SPEED);
-#            printf("Record SPEED: %s (%.6f)\n", uc(unpack('H*', $buffer)), $record_speed) if ($debug >= $LOG_DEBUG);
-#        }
-        record_speed = None
-        if log_format & LOG_FORMAT_SPEED:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_SPEED]
-            fp_offset += SIZEOF_LOG_SPEED
-#            checksum ^= packet_checksum(buffer)
-            record_speed = unpack(buffer)
-            print('DATA: record_speed=%d' % record_speed)
-
-#
-#        undef($record_heading);
-#        if ($log_format & $LOG_FORMAT_HEADING) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_HEADING);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_heading = mtk2number($buffer, $SIZEOF_LOG_HEADING);
-#            printf("Record HEADING: %s (%.6f)\n", uc(unpack('H*', $buffer)), $record_heading) if ($debug >= $LOG_DEBUG);
-#        }
-        record_heading = None
-        if log_format & LOG_FORMAT_HEADING:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_HEADING]
-            fp_offset += SIZEOF_LOG_HEADING
-#            checksum ^= packet_checksum(buffer)
-            record_heading = unpack(buffer)
-            print('DATA: record_heading=%d' % record_heading)
-
-#
-#        undef($record_dsta);
-#        if ($log_format & $LOG_FORMAT_DSTA) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_DSTA);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_dsta = mtk2unsignedword($buffer);
-#            printf("Record DSTA: %s (%u)\n", uc(unpack('H*', $buffer)), $record_dsta) if ($debug >= $LOG_DEBUG);
-#        }
-        record_dsta = None
-        if log_format & LOG_FORMAT_DSTA:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_DSTA]
-            fp_offset += SIZEOF_LOG_DSTA
-#            checksum ^= packet_checksum(buffer)
-            record_dsta = unpack(buffer)
-            print('DATA: record_dsta=%u' % record_dsta)
-
-#        undef($record_dage);
-#        if ($log_format & $LOG_FORMAT_DAGE) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_DAGE);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_dage = mtk2long($buffer);
-#            printf("Record DAGE: %s (%u)\n", uc(unpack('H*', $buffer)), $record_dage) if ($debug >= $LOG_DEBUG);
-#        }
-        record_dage = None
-        if log_format & LOG_FORMAT_DAGE:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_DAGE]
-            fp_offset += SIZEOF_LOG_DAGE
-#            checksum ^= packet_checksum(buffer)
-            record_dage = unpack(buffer)
-            print('DATA: record_dage=%u' % record_dage)
-
-#        undef($record_pdop);
-#        if ($log_format & $LOG_FORMAT_PDOP) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_PDOP);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_pdop = mtk2unsignedword($buffer) / 100;
-#            printf("Record PDOP: %s (%.2f)\n", uc(unpack('H*', $buffer)), $record_pdop) if ($debug >= $LOG_DEBUG);
-#        }
-        record_pdop = None
-        if log_format & LOG_FORMAT_PDOP:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_PDOP]
-            fp_offset += SIZEOF_LOG_PDOP
-#            checksum ^= packet_checksum(buffer)
-            record_pdop = unpack(buffer) / 100.0
-            print('DATA: record_pdop=%.2f' % record_pdop)
-
-#        undef($record_hdop);
-#        if ($log_format & $LOG_FORMAT_HDOP) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_HDOP);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_hdop = mtk2unsignedword($buffer) / 100;
-#            printf("Record HDOP: %s (%.2f)\n", uc(unpack('H*', $buffer)), $record_hdop) if ($debug >= $LOG_DEBUG);
-#        }
-        record_hdop = None
-        if log_format & LOG_FORMAT_HDOP:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_HDOP]
-            fp_offset += SIZEOF_LOG_HDOP
-#            checksum ^= packet_checksum(buffer)
-            record_hdop = unpack(buffer) / 100.0
-            print('DATA: record_hdop=%.2f' % record_hdop)
-
-#        undef($record_vdop);
-#        if ($log_format & $LOG_FORMAT_VDOP) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_VDOP);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_vdop = mtk2unsignedword($buffer) / 100;
-#            printf("Record VDOP: %s (%.2f)\n", uc(unpack('H*', $buffer)), $record_vdop) if ($debug >= $LOG_DEBUG);
-#        }
-        record_vdop = None
-        if log_format & LOG_FORMAT_VDOP:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_VDOP]
-            fp_offset += SIZEOF_LOG_VDOP
-#            checksum ^= packet_checksum(buffer)
-            record_vdop = unpack(buffer) / 100.0
-            print('DATA: record_vdop=%.2f' % record_vdop)
-
-#        undef($record_nsat_in_use);
-#        undef($record_nsat_in_view);
-#        if ($log_format & $LOG_FORMAT_NSAT) {
-#            $buffer = my_read($fp, $SIZEOF_BYTE);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_nsat_in_view = mtk2byte($buffer);
-#            $buffer = my_read($fp, $SIZEOF_BYTE);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_nsat_in_use = mtk2byte($buffer);
-#            printf("Record NSAT: in view %u, in use %u\n", $record_nsat_in_view, $record_nsat_in_use) if ($debug >= $LOG_DEBUG);
-#        }
-        record_nsat_in_use = None
-        record_nsat_in_view = None
-        if log_format & LOG_FORMAT_NSAT:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_NSAT]
-            (record_nsat_in_use, record_nsat_in_view) = struct.unpack('<BB', buffer)
-            fp_offset += SIZEOF_LOG_NSAT
-#            checksum ^= packet_checksum(buffer)
-            print('DATA: record_nsat_in_use=%u, record_nsat_in_view=%u' % (record_nsat_in_use, record_nsat_in_view))
-
-#
-#        undef($record_satdata);
-#        if ($log_format & $LOG_FORMAT_SID) {
-#            my $satdata_count = 0;
-#            my $satdata_sid;
-#            my $satdata_inuse;
-#            my $satdata_inview;
-#            my $satdata_elevation;
-#            my $satdata_azimuth;
-#            my $satdata_snr;
-#            while (1) {
-#                # Even with zero satellites in view, we have at least one bunch of data.
-#                $buffer = my_read($fp, $SIZEOF_LOG_SID);
-#                $checksum ^= packet_checksum($buffer);
-#                $satdata_sid = mtk2byte($buffer);
-#                $buffer = my_read($fp, $SIZEOF_LOG_SIDINUSE);
-#                $checksum ^= packet_checksum($buffer);
-#                $satdata_inuse = mtk2byte($buffer);
-#                $buffer = my_read($fp, $SIZEOF_LOG_SATSINVIEW);
-#                $checksum ^= packet_checksum($buffer);
-#                $satdata_inview = mtk2unsignedword($buffer);
-#                if ($satdata_inview == 0) {
-#                    printf("No satellites in view\n") if ($debug >= $LOG_DEBUG);
-#                } else {
-#                    # Read data for this satellite.
-#                    printf("Sats in view: %u, SatID %u in use: %u\n", $satdata_inview, $satdata_sid, $satdata_inuse) if ($debug >= $LOG_DEBUG);
-#                    undef($satdata_elevation);
-#                    if ($log_format & $LOG_FORMAT_ELEVATION) {
-#                        $buffer = my_read($fp, $SIZEOF_LOG_ELEVATION);
-#                        $checksum ^= packet_checksum($buffer);
-#                        $satdata_elevation = mtk2signedword($buffer);
-#                        printf("Satellite ELEVATION: %s (%d)\n", uc(unpack('H*', $buffer)), $satdata_elevation) if ($debug >= $LOG_DEBUG);
-#                    }
-#                    undef($satdata_azimuth);
-#                    if ($log_format & $LOG_FORMAT_AZIMUTH) {
-#                        $buffer = my_read($fp, $SIZEOF_LOG_AZIMUTH);
-#                        $checksum ^= packet_checksum($buffer);
-#                        $satdata_azimuth = mtk2unsignedword($buffer);
-#                        printf("Satellite AZIMUTH:   %s (%u)\n", uc(unpack('H*', $buffer)), $satdata_azimuth) if ($debug >= $LOG_DEBUG);
-#                    }
-#                    undef($satdata_snr);
-#                    if ($log_format & $LOG_FORMAT_SNR) {
-#                        $buffer = my_read($fp, $SIZEOF_LOG_SNR);
-#                        $checksum ^= packet_checksum($buffer);
-#                        $satdata_snr = mtk2unsignedword($buffer);
-#                        printf("Satellite SNR:       %s (%u)\n", uc(unpack('H*', $buffer)), $satdata_snr) if ($debug >= $LOG_DEBUG);
-#                    }
-#                    $record_satdata .= "\n" if ($record_satdata ne '');
-#                    $record_satdata .= $satdata_sid       . "\t";
-#                    $record_satdata .= $satdata_inuse     . "\t";
-#                    $record_satdata .= $satdata_elevation . "\t";
-#                    $record_satdata .= $satdata_azimuth   . "\t";
-#                    $record_satdata .= $satdata_snr;
-#                    $satdata_count++;
-#                }
-#                last if ($satdata_count >= $satdata_inview);
-#            }
-#        }
-#
-#        undef($record_rcr);
-#        if ($log_format & $LOG_FORMAT_RCR) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_RCR);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_rcr = mtk2unsignedword($buffer);
-#            printf("Record RCR: %s (%s)\n", uc(unpack('H*', $buffer)), describe_rcr_mtk($record_rcr)) if ($debug >= $LOG_DEBUG);
-#        }
-        record_rcr = None
-        if log_format & LOG_FORMAT_RCR:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_RCR]
-            fp_offset += SIZEOF_LOG_RCR
-#            checksum ^= packet_checksum(buffer)
-            record_rcr = unpack(buffer)
-            print('DATA: record_rcr=%u' % record_rcr)
+        decoder = mtklog.record_decoder(log_format, LOG_HAS_CHECKSUM_SEPARATOR)
+        while fp < segment.end and record_count_sector < expected_records_sector:
+            record_count_sector += 1
+            record_count_total += 1
+
+#            # Read each record field, the separator and the checksum.
+#            # (one field at a time, see mtkbabel.pl; here mtklog decodes the
+#            # whole record with one struct unpack)
+            (record, end, valid) = decoder.decode(view, fp)
+            if not valid:
+                abort('ERROR: Record checksum error at offset 0x%06x' % fp)
+            fp = end
 
-#
-#        undef($record_millisecond);
-#        if ($log_format & $LOG_FORMAT_MILLISECOND) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_MILLISECOND);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_millisecond = mtk2unsignedword($buffer);
-#            printf("Record MILLISECOND: %s (%u)\n", uc(unpack('H*', $buffer)), $record_millisecond) if ($debug >= $LOG_DEBUG);
-#        }
-        record_millisecond = None
-        if log_format & LOG_FORMAT_MILLISECOND:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_MILLISECOND]
-            fp_offset += SIZEOF_LOG_MILLISECOND
-#            checksum ^= packet_checksum(buffer)
-            record_millisecond = unpack(buffer)
-            print('DATA: record_millisecond=%u' % record_millisecond)
-
-#
-#        undef($record_distance);
-#        if ($log_format & $LOG_FORMAT_DISTANCE) {
-#            $buffer = my_read($fp, $SIZEOF_LOG_DISTANCE);
-#            $checksum ^= packet_checksum($buffer);
-#            $record_distance = mtk2number($buffer, $SIZEOF_LOG_DISTANCE);
-#            printf("Record DISTANCE: %s (%.9f)\n", uc(unpack('H*', $buffer)), $record_distance) if ($debug >= $LOG_DEBUG);
-#        }
-        record_distance = None
-        if log_format & LOG_FORMAT_DISTANCE:
-            buffer = data[fp_offset:fp_offset+SIZEOF_LOG_DISTANCE]
-            fp_offset += SIZEOF_LOG_DISTANCE
-#            checksum ^= packet_checksum(buffer)
-            record_distance = unpack(buffer)
-            print('DATA: record_distance=%u' % record_distance)
-
-#
-#        if ($LOG_HAS_CHECKSUM_SEPARATOR) {
-#            # Read separator between data and checksum.
-#            $buffer = my_read($fp, $SIZEOF_BYTE);
-#            if ($buffer ne '*') {
-#                printf("ERROR: Checksum separator error: expected char 0x%02X, found 0x%02X\n", ord('*'), ord($buffer));
-#                last if (! $opt_i);
-#                next if (! $opt_I);
-#            }
-#        }
-        if LOG_HAS_CHECKSUM_SEPARATOR:
-            buffer = data[fp_offset:fp_offset+SIZEOF_BYTE]
-            if buffer != '*':
-                abort('ERROR: Checksum separator error: expected char 0x%02X, found 0x%02X' % (ord('*'), ord(buffer)))
-
-#        # Read and verify checksum.
-#        $buffer = my_read($fp, $SIZEOF_BYTE);
-#        if ($checksum != ord($buffer)) {
-#            printf("ERROR: Record checksum error: expected 0x%02X, computed 0x%02X\n", ord($buffer), $checksum);
-#            last if (! $opt_i);
-#            next if (! $opt_I);
-#        }
 #
 #        # Start a new GPX <trkseg> on satellite lost.
 #        if (($record_valid == $VALID_NOFIX) and $gpx_in_trk) {
@@ -726,7 +392,38 @@ def parse_log_data(data):
 #    unlink($gpx_wpt_tmp_fname) if ($opt_w or $opt_c);
 
 
+    print('Total record count: %d' % record_count_total)
+
+
 with open('debug.bin', 'rb') as fd:
     memory = fd.read()
 
+start = time.time()
 parse_log_data(memory)
+print('Parsed in %.3f sec' % (time.time() - start))
+
+if mtklog.numpy is not None:
+    # the same again, a sector at a time with NumPy
+    start = time.time()
+    record_count_total = 0
+    for base in range(0, len(memory), SIZEOF_SECTOR):
+        for (offset, log_format, records, valid) in mtklog.decode_sector(memory, base):
+            if not valid.all():
+                abort('ERROR: Record checksum error in run at offset 0x%06x' % offset)
+            record_count_total += len(records)
+    print('NumPy: Total record count: %d, parsed in %.3f sec'
+          % (record_count_total, time.time() - start))
+
+# and a sector per process
+start = time.time()
+records = mtklog.parse_parallel('debug.bin', checksum_separator=LOG_HAS_CHECKSUM_SEPARATOR)
+if not all([valid for (record, valid) in records]):
+    abort('ERROR: Record checksum error')
+print('Parallel: Total record count: %d, parsed in %.3f sec'
+      % (len(records), time.time() - start))
+
+# random access, only the records looked at are decoded
+start = time.time()
+view = mtklog.LogView(memory, checksum_separator=LOG_HAS_CHECKSUM_SEPARATOR)
+print('LogView: %d records, last at UTC %d, in %.3f sec'
+      % (len(view), view[-1].utc, time.time() - start))